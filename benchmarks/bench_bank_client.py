@@ -0,0 +1,75 @@
+"""Compare a per-request httpx client with the shared pooled client against the bank simulator.
+
+Start the simulator first (``docker compose up``) then run::
+
+    poetry run python -m benchmarks.bench_bank_client --requests 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+from payment_gateway_api.clients import BankClient, create_http_client
+from payment_gateway_api.models import BankPaymentRequest
+from payment_gateway_api.settings import payment_settings
+
+PAYMENT = BankPaymentRequest(card_number="2222405343248877", expiry_date="04/2036",
+                             currency="GBP", amount=100, cvv="123")
+
+
+class PerRequestBankClient:
+    # the behaviour before the shared pool: one client, and one handshake, per payment
+    async def process_payment(self, payment: BankPaymentRequest):
+        async with httpx.AsyncClient(timeout=payment_settings.bank_timeout) as client:
+            return await BankClient(client).process_payment(payment)
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+async def run(client, requests: int, concurrency: int) -> list[float]:
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await client.process_payment(PAYMENT)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return latencies
+
+
+def report(name: str, latencies: list[float], elapsed: float) -> None:
+    print(f"{name:<12} n={len(latencies)} rps={len(latencies) / elapsed:8.1f} "
+          f"p50={percentile(latencies, 0.50) * 1000:7.2f}ms "
+          f"p99={percentile(latencies, 0.99) * 1000:7.2f}ms "
+          f"mean={statistics.fmean(latencies) * 1000:7.2f}ms")
+
+
+async def main(requests: int, concurrency: int) -> None:
+    print(f"bank_url={payment_settings.bank_url} requests={requests} concurrency={concurrency}")
+
+    start = time.perf_counter()
+    latencies = await run(PerRequestBankClient(), requests, concurrency)
+    report("per-request", latencies, time.perf_counter() - start)
+
+    async with create_http_client() as http_client:
+        client = BankClient(http_client)
+        await run(client, concurrency, concurrency)  # warm up the pool
+        start = time.perf_counter()
+        latencies = await run(client, requests, concurrency)
+        report("pooled", latencies, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency))
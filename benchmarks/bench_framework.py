@@ -0,0 +1,81 @@
+"""Per request framework cost of GET /api/v1/payments/{id}, dependencies built per request against the container.
+
+    poetry run python -m benchmarks.bench_framework --requests 20000
+
+The app is called in-process as an ASGI app, no sockets, so the time is the middlewares, the
+routing, the dependencies and the handler reading a cached payment. per-request overrides the
+dependencies with the previous providers, sync functions building a PaymentService on every
+request, which FastAPI runs in its thread pool.
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+from fastapi import Depends, Request
+
+from payment_gateway_api.acquirers import AcquirerRouter
+from payment_gateway_api.app import app, get_payment_service
+from payment_gateway_api.models import PaymentResponse, PaymentStatus
+from payment_gateway_api.repositories import repo
+from payment_gateway_api.services import PaymentService
+
+
+def per_request_bank_router(request: Request) -> AcquirerRouter:
+    return request.app.state.container.bank_router
+
+
+def per_request_payment_service(request: Request,
+                                router: AcquirerRouter = Depends(per_request_bank_router)) -> PaymentService:
+    return PaymentService(router, request.app.state.container.idempotency_cache)
+
+
+async def call(path: str) -> int:
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+             "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+             "headers": [(b"host", b"gateway")], "client": ("127.0.0.1", 50000), "server": ("gateway", 80)}
+    status = 0
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+async def run(name: str, path: str, requests: int) -> float:
+    for _ in range(200):
+        assert await call(path) == 200
+    start = time.perf_counter()
+    for _ in range(requests):
+        await call(path)
+    per_request = (time.perf_counter() - start) / requests * 1e6
+    print(f"{name:<12} {1e6 / per_request:10,.0f} requests/s {per_request:8.1f} us/request")
+    return per_request
+
+
+async def main(requests: int) -> None:
+    async with app.router.lifespan_context(app):
+        payment = PaymentResponse(id=uuid.uuid4(), status=PaymentStatus.AUTHORIZED, card_last4="8877",
+                                  expiry_month="4", expiry_year="2030", currency="GBP", amount=100)
+        await repo.add(payment)
+        path = f"/api/v1/payments/{payment.id}"
+        app.dependency_overrides[get_payment_service] = per_request_payment_service
+        try:
+            before = await run("per-request", path, requests)
+        finally:
+            app.dependency_overrides.clear()
+        after = await run("container", path, requests)
+        print(f"{before - after:.1f} us/request saved, {before / after:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20_000)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests))
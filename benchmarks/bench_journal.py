@@ -0,0 +1,83 @@
+"""Payments journaled per second with and without group commit, and journal replay speed.
+
+    poetry run python -m benchmarks.bench_journal --payments 5000 --concurrency 100 --replay 1000000
+
+one-by-one adds the payments one after the other, so each pays its own fsync, grouped adds
+concurrency payments at a time and they share the fsyncs. The replay journal is written
+directly, the time is the store opening it and rebuilding the memory store.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+
+from payment_gateway_api.journals import PaymentJournal
+from payment_gateway_api.models import PaymentResponse, PaymentStatus
+from payment_gateway_api.stores import JournaledPaymentStore, _RECORD, _owner, _pack
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+def new_payment(i: int) -> PaymentResponse:
+    return PaymentResponse(id=uuid.uuid4(), status=PaymentStatus.AUTHORIZED if i % 2 else PaymentStatus.DECLINED,
+                           card_last4=f"{i % 10000:04d}", expiry_month=str(i % 12 + 1), expiry_year="2036",
+                           currency="GBP", amount=i + 1)
+
+
+async def write(name: str, payments: int, concurrency: int) -> float:
+    with tempfile.TemporaryDirectory() as path:
+        store = JournaledPaymentStore(payments, 86400, path, SEGMENT_SIZE, 4)
+        await store.open()
+        pending = [new_payment(i) for i in range(payments)]
+        start = time.perf_counter()
+        for i in range(0, payments, concurrency):
+            await asyncio.gather(*(store.add(payment) for payment in pending[i:i + concurrency]))
+        elapsed = time.perf_counter() - start
+        await store.close()
+    print(f"{name:<12} {payments / elapsed:10,.0f} payments/s {elapsed / payments * 1e3:8.3f} ms/payment")
+    return payments / elapsed
+
+
+async def replay(records: int) -> None:
+    with tempfile.TemporaryDirectory() as path:
+        journal = PaymentJournal(path, 16, 16 + _RECORD.size, SEGMENT_SIZE, 4)
+        journal.open()
+        now = time.time()
+        for i in range(0, records, 10_000):
+            journal.append([payment.id.bytes + _pack(payment, _owner(None), now + k * 1e-6)
+                            for k, payment in ((k, new_payment(k)) for k in range(i, min(i + 10_000, records)))])
+        journal.close()
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+        read = PaymentJournal(path, 16, 16 + _RECORD.size, SEGMENT_SIZE, 4)
+        start = time.perf_counter()
+        read.open()
+        read_elapsed = time.perf_counter() - start
+        read.close()
+
+        store = JournaledPaymentStore(records, 86400, path, SEGMENT_SIZE, 1_000_000)
+        start = time.perf_counter()
+        await store.open()
+        elapsed = time.perf_counter() - start
+        assert len(store) == records
+        await store.close()
+    print(f"journal read {records / read_elapsed:10,.0f} records/s {size / read_elapsed / 2 ** 20:8.1f} MiB/s")
+    print(f"store replay {records / elapsed:10,.0f} records/s {elapsed:8.2f} s for {records:,} payments")
+
+
+async def main(payments: int, concurrency: int, records: int) -> None:
+    one_by_one = await write("one-by-one", payments // 10, 1)
+    grouped = await write("grouped", payments, concurrency)
+    print(f"group commit {grouped / one_by_one:.1f}x")
+    await replay(records)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--payments", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--replay", type=int, default=1_000_000)
+    args = parser.parse_args()
+    asyncio.run(main(args.payments, args.concurrency, args.replay))
@@ -0,0 +1,101 @@
+"""Event loop stall caused by logging, logging off against writing on the loop against the log queue.
+
+    poetry run python -m benchmarks.bench_logging --rate 500 --seconds 5 --write-latency 0.0005
+
+Simulated requests log a debug and an info line each, like the payment handlers, at an open loop
+rate. The log stream sleeps write-latency on every write, a stderr pipe or terminal that is not
+keeping up. A ticker sleeping 1ms measures how late the loop wakes it up.
+"""
+import argparse
+import asyncio
+import io
+import logging
+import random
+import time
+import uuid
+
+from payment_gateway_api.logs import JsonFormatter, LogQueue, correlation_id, debug_sampled
+
+logger = logging.getLogger("benchmarks.payments")
+
+TICK = 0.001
+
+
+class SlowStream(io.TextIOBase):
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.lines = 0
+
+    def write(self, text: str) -> int:
+        # a blocked write releases the GIL, like a write to a full pipe
+        time.sleep(self.latency)
+        self.lines += 1
+        return len(text)
+
+
+async def request(sample_rate: float) -> None:
+    correlation_id.set(uuid.uuid4().hex)
+    debug_sampled.set(random.random() < sample_rate)
+    logger.debug("received a %s payment request", "GBP")
+    await asyncio.sleep(0)
+    logger.info("payment %s authorized", uuid.uuid4())
+
+
+async def ticker(lags: list[float], stop: asyncio.Event) -> None:
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(TICK)
+        lags.append(loop.time() - start - TICK)
+
+
+async def drive(rate: float, seconds: float, sample_rate: float) -> list[float]:
+    lags = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(ticker(lags, stop))
+    tasks = set()
+    start = time.perf_counter()
+    for i in range(int(rate * seconds)):
+        # open loop, requests keep arriving on schedule however late the loop is
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.create_task(request(sample_rate))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+    stop.set()
+    await monitor
+    return lags
+
+
+def run(mode: str, args: argparse.Namespace) -> None:
+    stream = SlowStream(args.write_latency)
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(logging.CRITICAL if mode == "off" else logging.DEBUG)
+    log_queue = LogQueue(args.queue_size) if mode == "queue" else None
+    if log_queue is not None:
+        log_queue.start()
+    lags = sorted(asyncio.run(drive(args.rate, args.seconds, args.sample_rate)))
+    if log_queue is not None:
+        log_queue.stop()
+    blocked = sum(lags)
+    print(f"{mode:<6} lines {stream.lines:6d}  tick lag p50 {lags[len(lags) // 2] * 1000:6.2f}ms "
+          f"p99 {lags[int(len(lags) * 0.99)] * 1000:6.2f}ms max {lags[-1] * 1000:7.2f}ms  "
+          f"stalled {blocked / args.seconds * 100:5.1f}% of the time")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=500.0)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--write-latency", type=float, default=0.0005)
+    parser.add_argument("--sample-rate", type=float, default=0.1)
+    parser.add_argument("--queue-size", type=int, default=10_000)
+    parser.add_argument("--mode", choices=("off", "sync", "queue"), action="append")
+    arguments = parser.parse_args()
+    for benchmark_mode in arguments.mode or ("off", "sync", "queue"):
+        run(benchmark_mode, arguments)
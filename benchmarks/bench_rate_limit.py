@@ -0,0 +1,86 @@
+"""Per request cost of the API key check and rate limit, per limiter backend and through the middleware.
+
+    poetry run python -m benchmarks.bench_rate_limit --requests 200000 --keys 10000
+
+acquire is one awaited RateLimiter.acquire over keys API keys in turn, with a rate high enough that
+every request is allowed. middleware is a request through ApiKeyMiddleware to an app that answers
+at once, less the same request straight to that app, so the headers and lookups are counted too.
+The sqlite limiter is measured with --requests / 20 requests one after the other and concurrent.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+from payment_gateway_api.ratelimits import ApiKey, ApiKeyMiddleware, MemoryRateLimiter, RateLimiter, \
+    SqliteRateLimiter
+
+RATE = 1e9
+BURST = 1_000_000
+
+
+async def acquire(limiter: RateLimiter, keys: list[str], requests: int, concurrency: int = 1) -> float:
+    start = time.perf_counter()
+    for i in range(0, requests, concurrency):
+        if concurrency == 1:
+            await limiter.acquire(keys[i % len(keys)], RATE, BURST)
+        else:
+            await asyncio.gather(*(limiter.acquire(keys[(i + k) % len(keys)], RATE, BURST)
+                                   for k in range(concurrency)))
+    return (time.perf_counter() - start) / requests
+
+
+async def answer(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def request(app, scopes: list[dict]) -> float:
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        pass
+
+    start = time.perf_counter()
+    for scope in scopes:
+        # the middleware adds the merchant to the state of the request
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - start) / len(scopes)
+
+
+async def middleware(keys: list[str], requests: int) -> float:
+    container = SimpleNamespace(api_keys={key: ApiKey(f"merchant-{i}", RATE, BURST) for i, key in enumerate(keys)},
+                                rate_limiter=MemoryRateLimiter(60.0))
+    app = SimpleNamespace(state=SimpleNamespace(container=container))
+    scopes = [{"type": "http", "path": "/api/v1/payments", "app": app,
+               "headers": [(b"host", b"localhost"), (b"content-type", b"application/json"),
+                           (b"x-api-key", keys[i % len(keys)].encode())]} for i in range(requests)]
+    bare = await request(answer, scopes)
+    limited = await request(ApiKeyMiddleware(answer), scopes)
+    return limited - bare
+
+
+async def main(requests: int, key_count: int) -> None:
+    keys = [os.urandom(16).hex() for _ in range(key_count)]
+    memory = await acquire(MemoryRateLimiter(60.0), keys, requests)
+    print(f"memory acquire     {memory * 1e6:8.2f} µs/request")
+    print(f"middleware         {await middleware(keys, requests) * 1e6:8.2f} µs/request")
+    with tempfile.TemporaryDirectory() as path:
+        limiter = SqliteRateLimiter(os.path.join(path, "ratelimits.db"), 60.0)
+        await acquire(limiter, keys, 100)
+        sequential = await acquire(limiter, keys, requests // 20)
+        concurrent = await acquire(limiter, keys, requests // 20, concurrency=100)
+        await limiter.close()
+    print(f"sqlite acquire     {sequential * 1e6:8.2f} µs/request one by one")
+    print(f"sqlite acquire     {concurrent * 1e6:8.2f} µs/request 100 concurrent, {1 / concurrent:10,.0f} requests/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200_000)
+    parser.add_argument("--keys", type=int, default=10_000)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.keys))
@@ -0,0 +1,46 @@
+"""Bytes per stored payment of the previous dict of PaymentResponse against PaymentRepository.
+
+    poetry run python -m benchmarks.bench_repository_memory --entries 1000000
+"""
+import argparse
+import gc
+import tracemalloc
+import uuid
+
+from payment_gateway_api.models import PaymentResponse, PaymentStatus
+from payment_gateway_api.repositories import PaymentRepository
+
+
+def new_payment(i: int) -> PaymentResponse:
+    return PaymentResponse(id=uuid.uuid4(), status=PaymentStatus.AUTHORIZED if i % 2 else PaymentStatus.DECLINED,
+                           card_last4=f"{i % 10000:04d}", expiry_month=str(i % 12 + 1), expiry_year="2036",
+                           currency="GBP", amount=i + 1)
+
+
+def measure(name: str, entries: int, store) -> None:
+    gc.collect()
+    tracemalloc.start()
+    container = store()
+    for i in range(entries):
+        payment = new_payment(i)
+        if isinstance(container, dict):
+            container[payment.id] = payment
+        else:
+            container.add(payment)
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<20} entries={entries} total={current / 2 ** 20:8.1f}MiB per_payment={current / entries:6.1f}B")
+    del container
+
+
+def main(entries: int) -> None:
+    measure("dict[PaymentResponse]", entries, lambda: dict[uuid.UUID, PaymentResponse]())
+    measure("PaymentRepository", entries, lambda: PaymentRepository(max_entries=entries, ttl=86400))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=1_000_000)
+    args = parser.parse_args()
+    main(args.entries)
@@ -0,0 +1,68 @@
+"""Cost per response of the JSON responses, FastAPI's default path against ModelResponse and error_response.
+
+    poetry run python -m benchmarks.bench_serialization --seconds 2
+
+The default path is what FastAPI does with a returned model: validate it against the response
+model, dump it to a dict of JSON types and json.dumps that dict in JSONResponse.
+"""
+import argparse
+import time
+import uuid
+from collections.abc import Callable
+
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+from payment_gateway_api.models import PaymentResponse, PaymentStatus, ErrorResponse
+from payment_gateway_api.responses import ModelResponse, error_response
+
+PAYMENT = PaymentResponse(id=uuid.uuid4(), status=PaymentStatus.AUTHORIZED, card_last4="8877", expiry_month="4",
+                          expiry_year="2030", currency="GBP", amount=100)
+MESSAGE = "Downstream bank server is unavailable, please retry later."
+RESPONSE_MODEL = TypeAdapter(PaymentResponse)
+
+
+def default_payment() -> bytes:
+    value = RESPONSE_MODEL.validate_python(PAYMENT)
+    return JSONResponse(RESPONSE_MODEL.dump_python(value, mode="json"), status_code=201).body
+
+
+def fast_payment() -> bytes:
+    return ModelResponse(PAYMENT, status_code=201).body
+
+
+def default_error() -> bytes:
+    return JSONResponse(status_code=503, content=ErrorResponse(message=MESSAGE).model_dump()).body
+
+
+def fast_error() -> bytes:
+    return error_response(503, MESSAGE).body
+
+
+def run(name: str, render: Callable[[], bytes], seconds: float) -> float:
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(1000):
+            render()
+        count += 1000
+    elapsed = time.perf_counter() - start
+    per_response = elapsed / count * 1e9
+    print(f"{name:<16} {count / elapsed:12,.0f} responses/s {per_response:8.1f} ns/response")
+    return per_response
+
+
+def main(seconds: float) -> None:
+    assert default_payment() == fast_payment() and default_error() == fast_error()
+    for kind, default, fast in (("payment", default_payment, fast_payment), ("error", default_error, fast_error)):
+        before = run(f"{kind} default", default, seconds)
+        after = run(f"{kind} fast", fast, seconds)
+        print(f"{kind} {before / after:.1f}x faster")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=2.0)
+    args = parser.parse_args()
+    main(args.seconds)
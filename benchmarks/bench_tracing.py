@@ -0,0 +1,54 @@
+"""Cost of tracing a payment, the root span and the validate, map, bank, bank.http and store spans.
+
+    poetry run python -m benchmarks.bench_tracing --seconds 2
+
+unsampled is what most requests pay at a low TRACE_SAMPLE_RATE, sampled is the cost of a
+traced request with the spans kept in memory.
+"""
+import argparse
+import time
+
+from payment_gateway_api.tracing import Tracer, MemorySpanExporter
+
+STAGES = ("validate", "map", "bank", "store")
+
+
+def payment(tracer: Tracer) -> None:
+    with tracer.start_trace("POST /api/v1/payments") as root:
+        for stage in STAGES:
+            with tracer.span(stage) as span:
+                span.set_attribute("payment.currency", "GBP")
+                if stage == "bank":
+                    with tracer.span("bank.http") as attempt:
+                        tracer.traceparent()
+                        attempt.set_attribute("http.status_code", 200)
+        root.set_attribute("http.status_code", 201)
+
+
+def run(name: str, sample_rate: float, seconds: float) -> float:
+    tracer = Tracer(sample_rate, MemorySpanExporter(10_000))
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(1000):
+            payment(tracer)
+        count += 1000
+    elapsed = time.perf_counter() - start
+    per_request = elapsed / count * 1e6
+    print(f"{name:<10} {count / elapsed:12,.0f} payments/s {per_request:8.2f} us/payment")
+    return per_request
+
+
+def main(seconds: float) -> None:
+    unsampled = run("unsampled", 0.0, seconds)
+    sampled = run("sampled", 1.0, seconds)
+    for rate in (0.01, 0.1):
+        print(f"at {rate:.0%} sampled {unsampled * (1 - rate) + sampled * rate:.2f} us/payment on average")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=2.0)
+    args = parser.parse_args()
+    main(args.seconds)
@@ -0,0 +1,50 @@
+"""Validations per second of PaymentValidator over the fixtures of tests/unit/test_payment_validator.py.
+
+    poetry run python -m benchmarks.bench_validator --seconds 2
+"""
+import argparse
+import logging
+import time
+
+from payment_gateway_api.exceptions import BusinessValidationError
+from payment_gateway_api.models import PaymentRequest
+from payment_gateway_api.validators import PaymentValidator
+from tests.unit.test_payment_validator import TestPaymentValidator
+
+
+def fixtures(test) -> list[PaymentRequest]:
+    # the parametrize mark of the test holds the rows
+    rows = test.pytestmark[0].args[1]
+    return [PaymentRequest(card_number=row[0], expiry_month=row[1], expiry_year=row[2],
+                           currency=row[3], amount=row[4], cvv=row[5]) for row in rows]
+
+
+def run(name: str, payments: list[PaymentRequest], seconds: float) -> None:
+    validator = PaymentValidator()
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(1000):
+            for payment in payments:
+                try:
+                    validator.validate_payment(payment)
+                except BusinessValidationError:
+                    pass
+        count += 1000 * len(payments)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<8} {count / elapsed:12,.0f} validations/s {elapsed / count * 1e9:8.1f} ns/validation")
+
+
+def main(seconds: float) -> None:
+    # rejected payments log a warning each, measure the validation not stderr
+    logging.disable(logging.WARNING)
+    run("valid", fixtures(TestPaymentValidator.test_validate_payment_valid), seconds)
+    run("invalid", fixtures(TestPaymentValidator.test_validate_payment_invalid), seconds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=2.0)
+    args = parser.parse_args()
+    main(args.seconds)
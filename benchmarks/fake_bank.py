@@ -0,0 +1,99 @@
+"""An in-process stand-in for the bank simulator with configurable latency, errors and 503 bursts.
+
+Like imposters/bank_simulator.ejs, card numbers ending in an odd digit are authorized, an even
+digit declined and 0 gets a 503. POST /payments/batch answers a JSON array of payments with one
+{"status_code": ..., ...body} per payment, in order, after a single latency delay.
+"""
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+
+import uvicorn
+
+
+@dataclass
+class FakeBankConfig:
+    latency: float = 0.005
+    jitter: float = 0.002
+    # share of requests that take slow_latency instead, a heavy tail
+    slow_rate: float = 0.0
+    slow_latency: float = 0.2
+    # share of requests answered 503 regardless of the card number
+    error_rate: float = 0.0
+    # every burst_every seconds, every request gets a 503 for burst_length seconds
+    burst_every: float = 0.0
+    burst_length: float = 0.0
+
+
+class FakeBank:
+    def __init__(self, config: FakeBankConfig | None = None):
+        self.config = config or FakeBankConfig()
+        self.requests = 0
+        self._started_at = time.monotonic()
+        self._server: uvicorn.Server | None = None
+        self._task: asyncio.Task | None = None
+
+    def _in_burst(self) -> bool:
+        config = self.config
+        if config.burst_every <= 0:
+            return False
+        return (time.monotonic() - self._started_at) % config.burst_every < config.burst_length
+
+    def _answer(self, payment: dict) -> tuple[int, dict]:
+        if self._in_burst() or random.random() < self.config.error_rate:
+            return 503, {}
+        digit = str(payment.get("card_number", ""))[-1:]
+        if digit in ("1", "3", "5", "7", "9"):
+            return 200, {"authorized": True, "authorization_code": str(uuid.uuid4())}
+        if digit in ("2", "4", "6", "8"):
+            return 200, {"authorized": False, "authorization_code": ""}
+        if digit == "0":
+            return 503, {}
+        return 400, {"error_message": "Not all required properties were sent in the request"}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while (await receive())["type"] != "lifespan.shutdown":
+                await send({"type": "lifespan.startup.complete"})
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        self.requests += 1
+        config = self.config
+        if random.random() < config.slow_rate:
+            await asyncio.sleep(config.slow_latency)
+        else:
+            await asyncio.sleep(max(0.0, random.gauss(config.latency, config.jitter)))
+        if scope["path"] == "/payments/batch":
+            status = 200
+            answer = [{"status_code": code, **item} for code, item in map(self._answer, json.loads(body))]
+        else:
+            status, answer = self._answer(json.loads(body or b"{}"))
+        payload = json.dumps(answer).encode()
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"content-length", str(len(payload)).encode())]})
+        await send({"type": "http.response.body", "body": payload})
+
+    async def start(self, port: int = 0) -> str:
+        self._started_at = time.monotonic()
+        self._server = uvicorn.Server(uvicorn.Config(self, host="127.0.0.1", port=port, log_level="warning"))
+        self._task = asyncio.create_task(self._server.serve())
+        while not self._server.started:
+            await asyncio.sleep(0.01)
+        bound_port = self._server.servers[0].sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{bound_port}"
+
+    async def stop(self) -> None:
+        self._server.should_exit = True
+        await self._task
@@ -0,0 +1,249 @@
+"""Open-loop load test of the gateway against the in-process fake bank.
+
+Requests are fired on a fixed schedule whatever the gateway does, and latency is measured from
+the scheduled start, so a stalled gateway shows up in the tail instead of slowing the load
+down (coordinated omission).
+
+    poetry run python -m benchmarks.load --scenario all --rate 100 --duration 10 --output bench.json
+
+A fresh gateway is started with uvicorn on a free port for every scenario, so the circuit breaker
+and retry budget of one scenario do not leak into the next. With --gateway-url that gateway is
+used instead, and it must use the fake bank on --bank-port as its BANK_URL.
+
+The webhooks scenario registers an in-process webhook receiver for the merchant sending the async
+payments and reports how many results reached it, in how many requests, and how long after the
+last payment the last one arrived.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass, field, asdict
+
+import httpx
+
+from benchmarks.fake_bank import FakeBank, FakeBankConfig
+from benchmarks.webhook_receiver import WebhookReceiver, WebhookReceiverConfig
+
+
+@dataclass
+class Scenario:
+    name: str
+    bank: FakeBankConfig = field(default_factory=FakeBankConfig)
+    # share of payments with a card number the bank declines
+    decline_share: float = 0.0
+    # share of requests that are GET /payments/{id} of an earlier payment
+    get_share: float = 0.0
+    # payments sent with Prefer: respond-async
+    respond_async: bool = False
+    # the async payment results are delivered to a webhook receiver
+    webhook: bool = False
+
+
+SCENARIOS = {
+    "happy": Scenario("happy"),
+    "declines": Scenario("declines", decline_share=0.5),
+    "outage": Scenario("outage", bank=FakeBankConfig(burst_every=4.0, burst_length=2.0)),
+    "tail": Scenario("tail", bank=FakeBankConfig(slow_rate=0.02)),
+    "brownout": Scenario("brownout", bank=FakeBankConfig(slow_rate=0.5, slow_latency=2.0), get_share=0.5),
+    "mixed": Scenario("mixed", bank=FakeBankConfig(error_rate=0.01), decline_share=0.2, get_share=0.7),
+    # a bank taking 0.5s, every payment holds its connection for it unless it is accepted async
+    "slowbank": Scenario("slowbank", bank=FakeBankConfig(latency=0.5)),
+    "slowbank-async": Scenario("slowbank-async", bank=FakeBankConfig(latency=0.5), respond_async=True),
+    "webhooks": Scenario("webhooks", respond_async=True, webhook=True),
+}
+
+WEBHOOK_SECRET = "load-test-webhook-secret"
+# seconds the receiver may take to get the results after the last payment
+WEBHOOK_DRAIN_TIMEOUT = 30.0
+
+PERCENTILES = {"p50": 0.50, "p95": 0.95, "p99": 0.99, "p999": 0.999, "max": 1.0}
+
+
+def new_payment(decline: bool) -> dict:
+    last_digit = random.choice("2468" if decline else "13579")
+    return {"card_number": f"{random.randrange(10 ** 14, 10 ** 15)}{last_digit}", "expiry_month": "12",
+            "expiry_year": "2036", "currency": "GBP", "amount": random.randrange(1, 100_000), "cvv": "123"}
+
+
+def percentile(ordered: list[float], pct: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+async def run_scenario(client: httpx.AsyncClient, gateway_url: str, bank: FakeBank, scenario: Scenario,
+                       rate: float, duration: float) -> dict:
+    bank.config = scenario.bank
+    payment_ids = []
+    latencies = []
+    outcomes = Counter()
+    in_flight = max_in_flight = 0
+    headers = {"Prefer": "respond-async"} if scenario.respond_async else {}
+    receiver = None
+    if scenario.webhook:
+        receiver = WebhookReceiver(WebhookReceiverConfig(WEBHOOK_SECRET))
+        headers["Merchant-Id"] = "load"
+        response = await client.put(f"{gateway_url}/api/v1/webhook", headers={"Merchant-Id": "load"},
+                                    json={"url": await receiver.start(), "secret": WEBHOOK_SECRET})
+        response.raise_for_status()
+
+    # a few payments to read back before the measured run
+    if scenario.get_share:
+        for _ in range(20):
+            response = await client.post(f"{gateway_url}/api/v1/payments", json=new_payment(False))
+            if response.status_code == 201:
+                payment_ids.append(response.json()["id"])
+
+    async def one(scheduled: float) -> None:
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        try:
+            if payment_ids and random.random() < scenario.get_share:
+                response = await client.get(f"{gateway_url}/api/v1/payments/{random.choice(payment_ids)}")
+            else:
+                response = await client.post(f"{gateway_url}/api/v1/payments", headers=headers,
+                                             json=new_payment(random.random() < scenario.decline_share))
+                if response.status_code in (201, 202):
+                    payment_ids.append(response.json()["id"])
+            outcomes[str(response.status_code)] += 1
+        except httpx.HTTPError as e:
+            outcomes[type(e).__name__] += 1
+        finally:
+            in_flight -= 1
+        latencies.append(loop.time() - scheduled)
+
+    loop = asyncio.get_running_loop()
+    total = int(rate * duration)
+    tasks = []
+    start = loop.time()
+    for i in range(total):
+        scheduled = start + i / rate
+        delay = scheduled - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(scheduled)))
+    await asyncio.gather(*tasks)
+    elapsed = loop.time() - start
+
+    webhook = {}
+    if receiver is not None:
+        drain_start = loop.time()
+        while len(receiver.payments) < outcomes["202"] and loop.time() - drain_start < WEBHOOK_DRAIN_TIMEOUT:
+            await asyncio.sleep(0.01)
+        webhook = {"webhook": {"payments": len(receiver.payments), "requests": receiver.requests,
+                               "rejected": receiver.rejected, "drain_ms": round((loop.time() - drain_start) * 1000, 3)}}
+        await receiver.stop()
+
+    ordered = sorted(latencies)
+    return {
+        "scenario": scenario.name,
+        "rate": rate,
+        "duration": duration,
+        "requests": total,
+        "throughput": round(total / elapsed, 1),
+        "latency_ms": {name: round(percentile(ordered, pct) * 1000, 3) for name, pct in PERCENTILES.items()},
+        "outcomes": dict(sorted(outcomes.items())),
+        # the most requests waiting for the gateway at once, each holding a connection
+        "max_in_flight": max_in_flight,
+        "bank_requests": bank.requests,
+        "bank": asdict(scenario.bank),
+        **webhook,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def start_gateway(bank_url: str, path: str) -> tuple[subprocess.Popen, str]:
+    port = free_port()
+    # a webhook queue of its own, so no results of an earlier scenario are left to deliver
+    env = {**os.environ, "BANK_URL": bank_url, "WEBHOOK_STORE_PATH": os.path.join(path, f"webhooks-{port}.db"),
+           "WEBHOOKS_ENABLED": "true", "WEBHOOK_MERCHANT_ID_HEADER": "true",
+           "WEBHOOK_ALLOW_PRIVATE_ADDRESSES": "true"}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "payment_gateway_api.app:app", "--port", str(port), "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    gateway_url = f"http://127.0.0.1:{port}"
+    async with httpx.AsyncClient() as client:
+        for _ in range(200):
+            try:
+                await client.get(f"{gateway_url}/metrics")
+                return process, gateway_url
+            except httpx.TransportError:
+                await asyncio.sleep(0.05)
+    process.terminate()
+    raise RuntimeError("gateway did not start")
+
+
+def commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def main(args: argparse.Namespace) -> None:
+    bank = FakeBank()
+    bank_url = await bank.start(args.bank_port)
+    print(f"bank={bank_url} rate={args.rate}/s duration={args.duration}s")
+
+    names = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    results = []
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    path = tempfile.TemporaryDirectory()
+    try:
+        for name in names:
+            process = None
+            gateway_url = args.gateway_url
+            if gateway_url is None:
+                process, gateway_url = await start_gateway(bank_url, path.name)
+            try:
+                async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+                    bank.requests = 0
+                    result = await run_scenario(client, gateway_url, bank, SCENARIOS[name], args.rate, args.duration)
+            finally:
+                if process is not None:
+                    process.terminate()
+                    process.wait()
+            results.append(result)
+            latency = result["latency_ms"]
+            print(f"{name:<14} {result['throughput']:8.1f} req/s  p50={latency['p50']:8.2f}ms "
+                  f"p95={latency['p95']:8.2f}ms p99={latency['p99']:8.2f}ms p999={latency['p999']:8.2f}ms  "
+                  f"in flight<={result['max_in_flight']}  {result['outcomes']}")
+            if "webhook" in result:
+                print(f"{'':<14} webhook {result['webhook']}")
+    finally:
+        await bank.stop()
+        path.cleanup()
+
+    if args.output:
+        report = {"commit": commit(), "python": platform.python_version(), "time": time.time(), "results": results}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", choices=[*SCENARIOS, "all"], default="all")
+    parser.add_argument("--rate", type=float, default=100, help="requests per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per scenario")
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--gateway-url")
+    parser.add_argument("--bank-port", type=int, default=0)
+    parser.add_argument("--output", help="JSON report to compare between commits")
+    asyncio.run(main(parser.parse_args()))
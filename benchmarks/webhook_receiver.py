@@ -0,0 +1,105 @@
+"""An in-process stand-in for a merchant's webhook endpoint, to try the webhooks offline.
+
+    poetry run python -m benchmarks.webhook_receiver --port 8090 --secret <secret>
+
+Start the gateway with WEBHOOKS_ENABLED, WEBHOOK_MERCHANT_ID_HEADER and WEBHOOK_ALLOW_PRIVATE_ADDRESSES,
+register it with PUT /api/v1/webhook {"url": "http://127.0.0.1:8090/hook", "secret": "<secret>"} and a
+Merchant-Id header, then send payments with the same Merchant-Id. Every POST is checked against the
+secret and answered 401 when its signature does not match, or 503 for a share of them with
+--error-rate, so the retries can be watched too.
+"""
+import argparse
+import asyncio
+import json
+import random
+from dataclasses import dataclass
+
+import uvicorn
+
+from payment_gateway_api.webhooks import SIGNATURE_HEADER, verify
+
+
+@dataclass
+class WebhookReceiverConfig:
+    secret: str
+    latency: float = 0.0
+    # share of POSTs answered 503
+    error_rate: float = 0.0
+    # seconds a signature timestamp may be off
+    tolerance: float = 300.0
+
+
+class WebhookReceiver:
+    def __init__(self, config: WebhookReceiverConfig, verbose: bool = False):
+        self.config = config
+        self.verbose = verbose
+        self.requests = 0
+        self.rejected = 0
+        self.payments = list[dict]()
+        self._server: uvicorn.Server | None = None
+        self._task: asyncio.Task | None = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while (await receive())["type"] != "lifespan.shutdown":
+                await send({"type": "lifespan.startup.complete"})
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        self.requests += 1
+        config = self.config
+        if config.latency:
+            await asyncio.sleep(config.latency)
+        signature = dict(scope["headers"]).get(SIGNATURE_HEADER.lower().encode(), b"").decode()
+        if not verify(config.secret, signature, body, config.tolerance):
+            self.rejected += 1
+            status = 401
+        elif random.random() < config.error_rate:
+            status = 503
+        else:
+            status = 200
+            payments = json.loads(body)
+            self.payments.extend(payments)
+            if self.verbose:
+                for payment in payments:
+                    print(f"{payment['id']} {payment['status']} {payment['amount']} {payment['currency']}")
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-length", b"0")]})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def start(self, port: int = 0) -> str:
+        self._server = uvicorn.Server(uvicorn.Config(self, host="127.0.0.1", port=port, log_level="warning"))
+        self._task = asyncio.create_task(self._server.serve())
+        while not self._server.started:
+            await asyncio.sleep(0.01)
+        bound_port = self._server.servers[0].sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{bound_port}/hook"
+
+    async def stop(self) -> None:
+        self._server.should_exit = True
+        await self._task
+
+
+async def main(args: argparse.Namespace) -> None:
+    receiver = WebhookReceiver(WebhookReceiverConfig(args.secret, args.latency, args.error_rate), verbose=True)
+    url = await receiver.start(args.port)
+    print(f"receiving on {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await receiver.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--secret", required=True)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,54 @@
+"""Production server, N uvicorn workers supervised by gunicorn.
+
+    poetry run gunicorn -c gunicorn.conf.py payment_gateway_api.app:app
+
+uvicorn picks uvloop and httptools when they are installed (pip install uvloop httptools).
+kill -HUP the master to reload the code and settings, new workers are started and the old ones
+finish their in flight requests within the graceful timeout. kill -TERM drains the same way.
+"""
+import logging
+import os
+
+from payment_gateway_api.settings import payment_settings
+
+logger = logging.getLogger("gunicorn.error")
+
+bind = payment_settings.server_bind
+# one event loop per core, the gateway is I/O bound so more workers than cores only add contention
+workers = payment_settings.server_workers or os.cpu_count() or 1
+worker_class = "uvicorn.workers.UvicornWorker"
+graceful_timeout = payment_settings.server_graceful_timeout
+keepalive = payment_settings.server_keepalive
+loglevel = payment_settings.server_log_level
+# the app is imported in each worker after the fork, so a reload picks up new code
+preload_app = False
+logconfig_dict = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        # LOG_FORMAT json or text, card numbers masked
+        "default": {"()": "payment_gateway_api.logs.create_formatter"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "default"},
+    },
+    "root": {"level": loglevel.upper(), "handlers": ["console"]},
+    "loggers": {
+        "gunicorn.error": {"level": loglevel.upper(), "handlers": ["console"], "propagate": False},
+    },
+}
+
+
+def on_starting(server) -> None:
+    # the in memory store is per worker, a payment created on one worker would be missing
+    # on the others, and a journal directory has a single writer, so several workers share
+    # the sqlite file instead
+    if workers > 1 and payment_settings.payment_store in ("memory", "journal"):
+        logger.warning("%d workers, payments are stored in sqlite %s to be readable from every worker",
+                       workers, payment_settings.payment_store_path)
+        payment_settings.payment_store = "sqlite"
+    # a per worker limit would let a key through workers times its rate
+    if workers > 1 and payment_settings.api_keys and payment_settings.rate_limit_backend == "memory":
+        logger.warning("%d workers, rate limits are kept in sqlite %s to hold across the workers",
+                       workers, payment_settings.rate_limit_store_path)
+        payment_settings.rate_limit_backend = "sqlite"
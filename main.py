@@ -1,15 +1,8 @@
-import logging
-
 import uvicorn
 
-# can be externalized as config file
-LOG_LEVEL = "DEBUG"
+from payment_gateway_api.logs import configure_logging
 
-logging.basicConfig(
-    level=LOG_LEVEL,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+configure_logging()
 
 
 def main():
@@ -19,6 +12,8 @@ def main():
         port=8000,
         reload=True,
         workers=1,
+        # uvicorn's loggers propagate to the root handler of configure_logging
+        log_config=None,
     )
 
 
@@ -0,0 +1,150 @@
+import logging
+import time
+
+import httpx
+
+from payment_gateway_api.batchers import BankBatcher, create_bank_batcher
+from payment_gateway_api.breakers import CircuitBreaker, create_circuit_breaker
+from payment_gateway_api.clients import BankClient
+from payment_gateway_api.exceptions import BankServerError, BankConnectionError, BankCircuitOpenError, \
+    PaymentServerError
+from payment_gateway_api.hedging import create_hedge_policy
+from payment_gateway_api.metrics import registry
+from payment_gateway_api.models import BankPaymentRequest, BankPaymentResponse
+from payment_gateway_api.retries import RetryPolicy
+from payment_gateway_api.settings import payment_settings
+from payment_gateway_api.validators import PaymentValidator
+
+logger = logging.getLogger(__name__)
+
+selected_total = registry.counter("bank_acquirer_selected_total", "Payments first routed to each acquirer.",
+                                  ("acquirer",))
+failovers_total = registry.counter("bank_acquirer_failovers_total", "Payments moved off each failing acquirer.",
+                                   ("acquirer",))
+
+# an acquirer that keeps failing still gets a trickle of payments to notice its recovery
+_MIN_SUCCESS_RATE = 0.05
+# latency of an acquirer without samples yet, and the floor of the others
+_MIN_LATENCY = 0.001
+
+
+class Acquirer:
+    def __init__(self, name: str, client: BankClient, currencies: frozenset[str], weight: float, alpha: float,
+                 circuit_breaker: CircuitBreaker | None = None, batcher: BankBatcher | None = None):
+        self.name = name
+        self.client = client
+        self.currencies = currencies
+        self.weight = weight
+        self.circuit_breaker = circuit_breaker
+        self.batcher = batcher
+        self._alpha = alpha
+        # exponentially weighted moving averages of the payment latency and of failures as 0/1
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self._sampled = False
+        # smooth weighted round robin state
+        self.current_weight = 0.0
+        self.selections = selected_total.labels(name)
+        self.failovers = failovers_total.labels(name)
+
+    @property
+    def effective_weight(self) -> float:
+        # faster and healthier acquirers get proportionally more payments
+        return self.weight * max(1.0 - self.error_rate, _MIN_SUCCESS_RATE) / max(self.latency, _MIN_LATENCY)
+
+    def record(self, elapsed: float | None, failed: bool) -> None:
+        alpha = self._alpha
+        if elapsed is not None:
+            self.latency = elapsed if not self._sampled else self.latency + alpha * (elapsed - self.latency)
+            self._sampled = True
+        self.error_rate += alpha * ((1.0 if failed else 0.0) - self.error_rate)
+
+
+class AcquirerRouter:
+    # picks an acquirer per payment among the ones accepting its currency, by weighted round
+    # robin over weight * success rate / latency, then fails over to the next best on BankServerError
+    def __init__(self, acquirers: list[Acquirer]):
+        self._acquirers = acquirers
+        self._by_currency = {currency: [acquirer for acquirer in acquirers if currency in acquirer.currencies]
+                             for currency in PaymentValidator.SUPPORTED_CURRENCIES}
+        for currency, candidates in self._by_currency.items():
+            if not candidates:
+                logger.warning("No bank acquirer accepts %s", currency)
+
+    @property
+    def acquirers(self) -> list[Acquirer]:
+        return self._acquirers
+
+    async def process_payment(self, payment: BankPaymentRequest) -> BankPaymentResponse:
+        candidates = self._route(payment.currency)
+        if not candidates:
+            logger.error("No bank acquirer accepts %s", payment.currency)
+            raise PaymentServerError("Internal server error")
+
+        for position, acquirer in enumerate(candidates):
+            start = time.perf_counter()
+            try:
+                result = await acquirer.client.process_payment(payment)
+            except BankServerError as e:
+                # an open circuit rejects without calling the bank, it says nothing about latency
+                circuit_open = isinstance(e, BankCircuitOpenError)
+                acquirer.record(None if circuit_open else time.perf_counter() - start, True)
+                if position == len(candidates) - 1:
+                    raise
+                acquirer.failovers.inc()
+                logger.warning("Bank acquirer %s %s, failing over to %s", acquirer.name,
+                               "circuit is open" if circuit_open else "is unavailable", candidates[position + 1].name)
+            except BankConnectionError:
+                acquirer.record(time.perf_counter() - start, True)
+                raise
+            else:
+                acquirer.record(time.perf_counter() - start, False)
+                return result
+
+    async def close(self) -> None:
+        for acquirer in self._acquirers:
+            if acquirer.batcher is not None:
+                await acquirer.batcher.close()
+
+    def _route(self, currency: str) -> list[Acquirer]:
+        candidates = self._by_currency.get(currency)
+        if candidates is None:
+            candidates = [acquirer for acquirer in self._acquirers if currency in acquirer.currencies]
+        if len(candidates) <= 1:
+            if candidates:
+                candidates[0].selections.inc()
+            return candidates
+
+        # smooth weighted round robin, spreads the picks evenly instead of in runs
+        total = 0.0
+        selected = None
+        for acquirer in candidates:
+            weight = acquirer.effective_weight
+            acquirer.current_weight += weight
+            total += weight
+            if selected is None or acquirer.current_weight > selected.current_weight:
+                selected = acquirer
+        selected.current_weight -= total
+        selected.selections.inc()
+        fallbacks = sorted((acquirer for acquirer in candidates if acquirer is not selected),
+                           key=lambda acquirer: acquirer.effective_weight, reverse=True)
+        return [selected, *fallbacks]
+
+
+def _create_acquirer(http_client: httpx.AsyncClient, retry_policy: RetryPolicy, name: str, url: str | None,
+                     currencies: list[str], weight: float) -> Acquirer:
+    breaker = create_circuit_breaker(name)
+    batcher = create_bank_batcher(http_client, url)
+    client = BankClient(http_client, retry_policy, breaker, batcher, url, create_hedge_policy())
+    return Acquirer(name, client, frozenset(currencies or PaymentValidator.SUPPORTED_CURRENCIES), weight,
+                    payment_settings.bank_routing_ewma_alpha, breaker, batcher)
+
+
+def create_acquirer_router(http_client: httpx.AsyncClient, retry_policy: RetryPolicy) -> AcquirerRouter:
+    if not payment_settings.bank_acquirers:
+        # a url of None makes the client use bank_url
+        return AcquirerRouter([_create_acquirer(http_client, retry_policy, "default", None, [], 1.0)])
+    return AcquirerRouter([
+        _create_acquirer(http_client, retry_policy, config.name, config.url, config.currencies, config.weight)
+        for config in payment_settings.bank_acquirers
+    ])
@@ -1,97 +1,402 @@
+import json
 import logging
 import uuid
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from datetime import datetime, UTC
+from typing import Literal
 
-from fastapi import FastAPI, Request, Depends
+from fastapi import FastAPI, Request, Depends, Header, Query, Response
 from fastapi import status
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import ValidationError
 
-from payment_gateway_api.clients import BankClient
+from payment_gateway_api.clients import create_http_client
+from payment_gateway_api.containers import Container
 from payment_gateway_api.exceptions import BusinessValidationError, PaymentNotFoundError, PaymentServerError, \
-    BankServerError
-from payment_gateway_api.models import PaymentRequest, PaymentResponse, ErrorResponse
+    BankServerError, IdempotencyKeyMismatchError, OverloadedError, WebhookNotFoundError, ForbiddenError
+from payment_gateway_api.logs import CorrelationIdMiddleware, create_log_queue
+from payment_gateway_api.metrics import registry, MetricsMiddleware
+from payment_gateway_api.ratelimits import ApiKeyMiddleware
+from payment_gateway_api.models import PaymentRequest, PaymentResponse, CircuitBreakerResponse, \
+    CircuitBreakersResponse, BatchPaymentResult, PaymentPage, PaymentStatus, WebhookRequest, WebhookResponse, \
+    WebhookRegistration
+from payment_gateway_api.repositories import repo
+from payment_gateway_api.responses import ModelResponse, error_response, encoded_payment_response, ndjson_rows, \
+    csv_rows
+from payment_gateway_api.settings import payment_settings
 from payment_gateway_api.services import PaymentService
+from payment_gateway_api.stores import PaymentFilter
+from payment_gateway_api.tracing import TracingMiddleware, create_span_exporter, tracer
 from payment_gateway_api.validators import PaymentValidator
+from payment_gateway_api.webhooks import WebhookDispatcher, check_public_url
 
 logger = logging.getLogger(__name__)
-app = FastAPI()
 
 
-def get_bank_client() -> BankClient:
-    return BankClient()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # started first and stopped last, the shutdown logs are written out too
+    log_queue = create_log_queue()
+    if log_queue is not None:
+        log_queue.start()
+    tracer.exporter = create_span_exporter()
+    try:
+        # the journaled store is replayed before the first payment
+        await repo.open()
+        try:
+            async with create_http_client() as http_client:
+                app.state.container = Container(http_client)
+                try:
+                    await app.state.container.start()
+                    yield
+                finally:
+                    # also when the app fails or is cancelled, the queues drain and the store is closed
+                    await app.state.container.close()
+        finally:
+            await repo.close()
+    finally:
+        tracer.exporter.close()
+        if log_queue is not None:
+            log_queue.stop()
 
 
-def get_payment_service(client: BankClient = Depends(get_bank_client)) -> PaymentService:
-    return PaymentService(client)
+app = FastAPI(lifespan=lifespan)
+# innermost of the middlewares, rejected requests are still measured, traced and logged
+app.add_middleware(ApiKeyMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
+# outermost, the metrics middleware and every handler log under the request's correlation id
+app.add_middleware(CorrelationIdMiddleware)
 
 
-def get_validator() -> PaymentValidator:
-    return PaymentValidator()
+# async and only a lookup, sync dependencies would each be sent to the thread pool. Tests
+# replace them through app.dependency_overrides.
+async def get_container(request: Request) -> Container:
+    return request.app.state.container
 
 
-@app.exception_handler(RequestValidationError)
-async def basic_validation_error_handler(request: Request, exc: RequestValidationError):
-    errors = exc.errors()
+async def get_payment_service(request: Request) -> PaymentService:
+    return request.app.state.container.payment_service
+
+
+async def get_validator(request: Request) -> PaymentValidator:
+    return request.app.state.container.validator
+
+
+def to_timestamp(value: datetime | None) -> float | None:
+    if value is None:
+        return None
+    # a time without an offset is UTC
+    return (value if value.tzinfo is not None else value.replace(tzinfo=UTC)).timestamp()
+
+
+async def get_key_merchant_id(request: Request) -> str | None:
+    # the merchant of the API key, whose payments are the only ones it reads. None without
+    # API_KEYS, every payment is readable then
+    return getattr(request.state, "merchant_id", None)
+
+
+async def get_payment_filter(
+    status: Literal["AUTHORIZED", "DECLINED", "PENDING", "FAILED"] | None = None,
+    currency: str | None = Query(default=None, min_length=3, max_length=3),
+    created_from: datetime | None = None,
+    created_to: datetime | None = None,
+    merchant_id: str | None = Depends(get_key_merchant_id)
+) -> PaymentFilter:
+    return PaymentFilter(merchant_id=merchant_id, status=PaymentStatus[status] if status is not None else None,
+                         currency=currency, created_from=to_timestamp(created_from),
+                         created_to=to_timestamp(created_to))
+
+
+def format_validation_errors(errors) -> str:
     error_messages = []
     for error in errors:
         field = error['loc'][-1]
         msg = error['msg']
         error_messages.append(f"{field}: {msg}")
-    merged_message = "; ".join(error_messages)
-    return JSONResponse(
-        status_code=status.HTTP_400_BAD_REQUEST,
-        content=ErrorResponse(message=merged_message).model_dump()
-    )
+    return "; ".join(error_messages)
+
+
+@app.exception_handler(RequestValidationError)
+async def basic_validation_error_handler(request: Request, exc: RequestValidationError):
+    merged_message = format_validation_errors(exc.errors())
+    return error_response(status.HTTP_400_BAD_REQUEST, merged_message)
 
 
 @app.exception_handler(BusinessValidationError)
 async def business_validation_error_handler(request: Request, ex: BusinessValidationError):
-    return JSONResponse(
-        status_code=status.HTTP_400_BAD_REQUEST,
-        content=ErrorResponse(message=str(ex)).model_dump()
-    )
+    return error_response(status.HTTP_400_BAD_REQUEST, str(ex))
 
 
 @app.exception_handler(PaymentNotFoundError)
 async def payment_not_found_error_handler(request: Request, ex: PaymentNotFoundError):
-    return JSONResponse(
-        status_code=status.HTTP_404_NOT_FOUND,
-        content=ErrorResponse(message=str(ex)).model_dump()
-    )
+    return error_response(status.HTTP_404_NOT_FOUND, str(ex))
+
+
+@app.exception_handler(WebhookNotFoundError)
+async def webhook_not_found_error_handler(request: Request, ex: WebhookNotFoundError):
+    return error_response(status.HTTP_404_NOT_FOUND, str(ex))
+
+
+@app.exception_handler(ForbiddenError)
+async def forbidden_error_handler(request: Request, ex: ForbiddenError):
+    return error_response(status.HTTP_403_FORBIDDEN, str(ex))
+
+
+@app.exception_handler(IdempotencyKeyMismatchError)
+async def idempotency_key_mismatch_error_handler(request: Request, ex: IdempotencyKeyMismatchError):
+    return error_response(status.HTTP_422_UNPROCESSABLE_CONTENT, str(ex))
 
 
 @app.exception_handler(PaymentServerError)
 async def payment_server_error_handler(request: Request, ex: PaymentServerError):
-    return JSONResponse(
-        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-        content=ErrorResponse(message=str(ex)).model_dump()
-    )
+    return error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, str(ex))
 
 
 @app.exception_handler(BankServerError)
 async def bank_server_error_handler(request: Request, ex: BankServerError):
-    return JSONResponse(
-        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-        content=ErrorResponse(message=str(ex)).model_dump()
-    )
+    return error_response(status.HTTP_503_SERVICE_UNAVAILABLE, str(ex))
+
+
+@app.exception_handler(OverloadedError)
+async def overloaded_error_handler(request: Request, ex: OverloadedError):
+    return error_response(status.HTTP_503_SERVICE_UNAVAILABLE, str(ex),
+                          {"Retry-After": str(payment_settings.overload_retry_after)})
+
+
+async def get_merchant_id(
+    request: Request,
+    merchant_id: str | None = Header(default=None, alias="Merchant-Id", min_length=1, max_length=64)
+) -> str | None:
+    # the merchant whose webhook gets the payment results, the one of the API key, and only
+    # without API_KEYS the Merchant-Id header
+    return getattr(request.state, "merchant_id", merchant_id)
+
+
+async def require_merchant_id(merchant_id: str | None = Depends(get_merchant_id)) -> str:
+    if merchant_id is None:
+        raise BusinessValidationError("Merchant-Id header is required.")
+    return merchant_id
+
+
+async def require_webhook_merchant_id(request: Request, merchant_id: str | None = Depends(get_merchant_id)) -> str:
+    # a webhook redirects the merchant's payment results, the unauthenticated header is only
+    # trusted with WEBHOOK_MERCHANT_ID_HEADER
+    if getattr(request.state, "merchant_id", None) is None and not payment_settings.webhook_merchant_id_header:
+        raise ForbiddenError("Webhooks need an API key.")
+    return await require_merchant_id(merchant_id)
+
 
+def prefers_async(prefer: str | None) -> bool:
+    # Prefer: respond-async, possibly among other preferences, RFC 7240
+    if not prefer:
+        return False
+    return any(preference.split(";")[0].strip().lower() == "respond-async" for preference in prefer.split(","))
 
-@app.post("/api/v1/payments", status_code=status.HTTP_201_CREATED)
+
+# the endpoints return a ModelResponse, response_model only documents the schema
+@app.post("/api/v1/payments", status_code=status.HTTP_201_CREATED, response_model=PaymentResponse)
 async def process_payment(
     request: PaymentRequest,
+    container: Container = Depends(get_container),
+    idempotency_key: str | None = Header(default=None, alias="Idempotency-Key", min_length=1, max_length=255),
+    prefer: str | None = Header(default=None),
+    merchant_id: str | None = Depends(get_merchant_id),
     validator: PaymentValidator = Depends(get_validator),
     service: PaymentService = Depends(get_payment_service)
-) -> PaymentResponse:
+) -> ModelResponse:
     logger.debug("received a %s payment request", request.currency)
-    validator.validate_payment(request)
-    response = await service.process_payment(request)
-    return response
+    with tracer.span("validate"):
+        validator.validate_payment(request)
+    if prefers_async(prefer):
+        # answered once stored, the queue bounds the payments in progress instead of the limiter
+        pending = await service.accept_payment(request, idempotency_key, merchant_id)
+        return ModelResponse(pending, status_code=status.HTTP_202_ACCEPTED,
+                             headers={"Location": f"/api/v1/payments/{pending.id}",
+                                      "Preference-Applied": "respond-async"})
+    # invalid payments are answered above without taking a slot
+    async with container.payment_limiter.acquire():
+        response = await service.process_payment(request, idempotency_key, merchant_id)
+    return ModelResponse(response, status_code=status.HTTP_201_CREATED)
+
+
+def parse_batch(body: bytes, content_type: str) -> list:
+    if content_type.startswith("application/x-ndjson"):
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                # reported against its own line, the rest of the batch is still processed
+                items.append(None)
+        return items
+    try:
+        items = json.loads(body)
+    except ValueError:
+        raise BusinessValidationError("body must be a JSON array or NDJSON.")
+    if not isinstance(items, list):
+        raise BusinessValidationError("body must be a JSON array or NDJSON.")
+    return items
+
+
+def batch_error_status(ex: Exception) -> int:
+    if isinstance(ex, (BankServerError, OverloadedError)):
+        return status.HTTP_503_SERVICE_UNAVAILABLE
+    return status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+@app.post("/api/v1/payments/batch", response_class=StreamingResponse)
+async def process_payment_batch(
+    request: Request,
+    container: Container = Depends(get_container),
+    merchant_id: str | None = Depends(get_merchant_id),
+    validator: PaymentValidator = Depends(get_validator),
+    service: PaymentService = Depends(get_payment_service)
+) -> StreamingResponse:
+    items = parse_batch(await request.body(), request.headers.get("content-type", ""))
+    if not 0 < len(items) <= payment_settings.payment_batch_max_items:
+        raise BusinessValidationError(f"batch must contain 1-{payment_settings.payment_batch_max_items} payments.")
+    logger.debug("received a batch of %d payments", len(items))
+
+    # one validation pass, invalid payments are answered first without calling the bank
+    rejected = []
+    payments = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            rejected.append(BatchPaymentResult(index=index, status_code=status.HTTP_400_BAD_REQUEST,
+                                               message="payment must be a JSON object."))
+            continue
+        try:
+            payment = PaymentRequest.model_validate(item)
+            validator.validate_payment(payment)
+        except ValidationError as e:
+            rejected.append(BatchPaymentResult(index=index, status_code=status.HTTP_400_BAD_REQUEST,
+                                               message=format_validation_errors(e.errors())))
+            continue
+        except BusinessValidationError as e:
+            rejected.append(BatchPaymentResult(index=index, status_code=status.HTTP_400_BAD_REQUEST,
+                                               message=str(e)))
+            continue
+        payments.append((index, payment))
+
+    async def stream() -> AsyncIterator[str]:
+        for result in rejected:
+            yield result.model_dump_json(exclude_none=True) + "\n"
+        async for index, outcome in service.process_payments(payments, payment_settings.payment_batch_concurrency,
+                                                                 merchant_id, container.payment_limiter):
+            if isinstance(outcome, Exception):
+                result = BatchPaymentResult(index=index, status_code=batch_error_status(outcome), message=str(outcome))
+            else:
+                result = BatchPaymentResult(index=index, status_code=status.HTTP_201_CREATED, payment=outcome)
+            yield result.model_dump_json(exclude_none=True) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.get("/api/v1/payments", response_model=PaymentPage)
+async def list_payments(
+    container: Container = Depends(get_container),
+    cursor: str | None = None,
+    limit: int = Query(default=50, ge=1),
+    payment_filter: PaymentFilter = Depends(get_payment_filter),
+    service: PaymentService = Depends(get_payment_service)
+) -> ModelResponse:
+    if limit > payment_settings.payment_list_max_limit:
+        raise BusinessValidationError(f"limit must be 1-{payment_settings.payment_list_max_limit}.")
+    async with container.lookup_limiter.acquire():
+        page = await service.list_payments(payment_filter, cursor, limit)
+    return ModelResponse(page)
 
 
-@app.get("/api/v1/payments/{payment_id}")
+# declared before /payments/{payment_id} so "export" is not taken for a payment id
+@app.get("/api/v1/payments/export", response_class=StreamingResponse)
+async def export_payments(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    payment_filter: PaymentFilter = Depends(get_payment_filter),
+    service: PaymentService = Depends(get_payment_service)
+) -> StreamingResponse:
+    logger.debug("export payments as %s", format)
+    items = service.export_payments(payment_filter, payment_settings.payment_export_page_size)
+    if format == "csv":
+        return StreamingResponse(csv_rows(items), media_type="text/csv",
+                                 headers={"Content-Disposition": 'attachment; filename="payments.csv"'})
+    return StreamingResponse(ndjson_rows(items), media_type="application/x-ndjson")
+
+
+@app.get("/api/v1/payments/{payment_id}", response_model=PaymentResponse)
 async def get_payment(
     payment_id: uuid.UUID,
+    container: Container = Depends(get_container),
+    merchant_id: str | None = Depends(get_key_merchant_id),
+    if_none_match: str | None = Header(default=None, alias="If-None-Match"),
     service: PaymentService = Depends(get_payment_service)
-) -> PaymentResponse:
+) -> Response:
     logger.debug("retrieve a payment with id %s", payment_id)
-    return service.get_payment(payment_id)
+    async with container.lookup_limiter.acquire():
+        # another merchant's payment is not found
+        encoded = await service.get_encoded_payment(payment_id, merchant_id)
+    # 304 without a body when the caller already has this payment
+    return encoded_payment_response(encoded, if_none_match)
+
+
+async def get_webhooks(request: Request) -> WebhookDispatcher:
+    webhooks = request.app.state.container.webhooks
+    if webhooks is None:
+        raise WebhookNotFoundError("Webhooks are not enabled.")
+    return webhooks
+
+
+@app.put("/api/v1/webhook", response_model=WebhookRegistration)
+async def register_webhook(
+    request: WebhookRequest,
+    merchant_id: str = Depends(require_webhook_merchant_id),
+    webhooks: WebhookDispatcher = Depends(get_webhooks)
+) -> ModelResponse:
+    if not payment_settings.webhook_allow_private_addresses:
+        check_public_url(request.url)
+    # replaces the merchant's webhook, the secret is only returned here
+    webhook = await webhooks.register(merchant_id, request.url, request.secret)
+    return ModelResponse(WebhookRegistration(merchant_id=merchant_id, url=webhook.url, secret=webhook.secret))
+
+
+@app.get("/api/v1/webhook", response_model=WebhookResponse)
+async def get_webhook(
+    merchant_id: str = Depends(require_webhook_merchant_id),
+    webhooks: WebhookDispatcher = Depends(get_webhooks)
+) -> ModelResponse:
+    webhook = await webhooks.get(merchant_id)
+    if webhook is None:
+        raise WebhookNotFoundError(f"Webhook of merchant {merchant_id} not found")
+    return ModelResponse(WebhookResponse(merchant_id=merchant_id, url=webhook.url))
+
+
+@app.delete("/api/v1/webhook", status_code=status.HTTP_204_NO_CONTENT)
+async def unregister_webhook(
+    merchant_id: str = Depends(require_webhook_merchant_id),
+    webhooks: WebhookDispatcher = Depends(get_webhooks)
+) -> Response:
+    if not await webhooks.unregister(merchant_id):
+        raise WebhookNotFoundError(f"Webhook of merchant {merchant_id} not found")
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@app.get("/api/v1/bank/circuit-breaker", response_model=CircuitBreakersResponse)
+async def get_circuit_breaker(container: Container = Depends(get_container)) -> ModelResponse:
+    return ModelResponse(CircuitBreakersResponse({
+        acquirer.name: CircuitBreakerResponse(
+            state=acquirer.circuit_breaker.state.name,
+            calls=acquirer.circuit_breaker.calls,
+            failure_rate=acquirer.circuit_breaker.failure_rate,
+            slow_call_rate=acquirer.circuit_breaker.slow_call_rate
+        )
+        for acquirer in container.bank_router.acquirers if acquirer.circuit_breaker is not None
+    }))
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
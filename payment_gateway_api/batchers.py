@@ -0,0 +1,111 @@
+import asyncio
+import logging
+
+import httpx
+
+from payment_gateway_api.exceptions import PaymentServerError
+from payment_gateway_api.metrics import registry
+from payment_gateway_api.settings import payment_settings
+
+logger = logging.getLogger(__name__)
+
+batch_size = registry.histogram("bank_batch_size", "Payments per bank batch request.",
+                                buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+batches_total = registry.counter("bank_batches_total", "Bank batch requests by what flushed them.", ("trigger",))
+_flushed_full = batches_total.labels("size")
+_flushed_window = batches_total.labels("window")
+
+
+class BankBatcher:
+    # concurrent bank calls are queued and sent as one POST {bank_url}/payments/batch when
+    # max_size payments are queued or window seconds after the first one. The bank answers
+    # a JSON array in request order, one {"status_code": ..., ...body} per payment, and
+    # each caller gets its own item back as an httpx.Response, so the BankClient status
+    # handling, retries and circuit breaker stay per payment.
+    def __init__(self, client: httpx.AsyncClient, max_size: int, window: float, bank_url: str | None = None):
+        self._client = client
+        self._max_size = max_size
+        self._window = window
+        self._batch_url = f"{bank_url or payment_settings.bank_url}/payments/batch"
+        self._pending = list[tuple[dict, asyncio.Future]]()
+        self._timer: asyncio.TimerHandle | None = None
+        # strong references, the loop only keeps weak ones to tasks
+        self._in_flight = set[asyncio.Task]()
+
+    async def submit(self, body: dict) -> httpx.Response:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((body, future))
+        if len(self._pending) >= self._max_size:
+            _flushed_full.inc()
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._window, self._flush_window)
+        return await future
+
+    async def close(self) -> None:
+        if self._pending:
+            self._flush()
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+    def _flush_window(self) -> None:
+        self._timer = None
+        if self._pending:
+            _flushed_window.inc()
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # payments whose caller gave up while queued are not sent
+        batch = [(body, future) for body, future in self._pending if not future.done()]
+        self._pending = []
+        if not batch:
+            return
+        task = asyncio.create_task(self._send(batch))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, batch: list[tuple[dict, asyncio.Future]]) -> None:
+        batch_size.observe(len(batch))
+        try:
+            response = await self._client.post(self._batch_url, json=[body for body, _ in batch])
+        except httpx.RequestError as e:
+            # every caller sees the transport error as if its own request failed
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if response.status_code != 200:
+            # the whole batch failed, e.g. 503, each payment handles it like a single call
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(httpx.Response(response.status_code, content=response.content))
+            return
+
+        try:
+            results = response.json()
+        except ValueError:
+            results = None
+        if (not isinstance(results, list) or len(results) != len(batch)
+                or not all(isinstance(result, dict) for result in results)):
+            logger.error("Bank batch returned %s results for %d payments",
+                         len(results) if isinstance(results, list) else "no", len(batch))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(PaymentServerError("Internal server error"))
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                status_code = result.pop("status_code", 500)
+                future.set_result(httpx.Response(status_code, json=result))
+
+
+def create_bank_batcher(client: httpx.AsyncClient, bank_url: str | None = None) -> BankBatcher | None:
+    if not payment_settings.bank_batch_enabled:
+        return None
+    return BankBatcher(client, payment_settings.bank_batch_max_size, payment_settings.bank_batch_window, bank_url)
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import time
+from collections.abc import Awaitable, Callable
+from enum import Enum
+
+from payment_gateway_api.exceptions import BankServerError, BankConnectionError, BankCircuitOpenError
+from payment_gateway_api.metrics import registry
+from payment_gateway_api.settings import payment_settings
+
+logger = logging.getLogger(__name__)
+
+FAILURE_ERRORS = (BankServerError, BankConnectionError, TimeoutError)
+
+rejected_total = registry.counter("bank_circuit_rejected_total", "Bank calls rejected by the open circuit.")
+opened_total = registry.counter("bank_circuit_opened_total", "Times the bank circuit opened.")
+state_gauge = registry.gauge("bank_circuit_state", "Bank circuit state of each acquirer, 0 closed, 1 open, "
+                             "2 half open.", label_names=("acquirer",))
+failure_rate_gauge = registry.gauge("bank_circuit_failure_rate", "Failure rate over each acquirer's breaker window.",
+                                    label_names=("acquirer",))
+slow_call_rate_gauge = registry.gauge("bank_circuit_slow_call_rate",
+                                      "Slow call rate over each acquirer's breaker window.", label_names=("acquirer",))
+
+
+class CircuitState(Enum):
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+
+class CircuitBreaker:
+    def __init__(self, window_size: int, minimum_calls: int, failure_rate_threshold: float,
+                 slow_call_rate_threshold: float, slow_call_duration: float, open_duration: float,
+                 half_open_calls: int, clock: Callable[[], float] = time.monotonic):
+        self._window_size = window_size
+        self._minimum_calls = minimum_calls
+        self._failure_rate_threshold = failure_rate_threshold
+        self._slow_call_rate_threshold = slow_call_rate_threshold
+        self._slow_call_duration = slow_call_duration
+        self._open_duration = open_duration
+        self._half_open_calls = half_open_calls
+        self._clock = clock
+
+        self._state = CircuitState.CLOSED
+        self._opened_at = 0.0
+        self._probe_permits = 0
+        self._probe_successes = 0
+        # preallocated ring buffers over the latest calls, counts are kept incrementally
+        self._failures = [False] * window_size
+        self._slow_calls = [False] * window_size
+        self._index = 0
+        self._calls = 0
+        self._failure_count = 0
+        self._slow_call_count = 0
+
+    @property
+    def state(self) -> CircuitState:
+        if self._state is CircuitState.OPEN and self._clock() - self._opened_at >= self._open_duration:
+            return CircuitState.HALF_OPEN
+        return self._state
+
+    @property
+    def calls(self) -> int:
+        return self._calls
+
+    @property
+    def failure_rate(self) -> float:
+        return self._failure_count / self._calls if self._calls else 0.0
+
+    @property
+    def slow_call_rate(self) -> float:
+        return self._slow_call_count / self._calls if self._calls else 0.0
+
+    async def call[T](self, attempt: Callable[[], Awaitable[T]]) -> T:
+        probe = self._acquire()
+        start = self._clock()
+        try:
+            result = await attempt()
+        except FAILURE_ERRORS:
+            self._record(True, self._clock() - start >= self._slow_call_duration)
+            raise
+        except asyncio.CancelledError:
+            # cancelled from outside, the call has no outcome and a probe slot is given back
+            if probe and self._state is CircuitState.HALF_OPEN:
+                self._probe_permits += 1
+            raise
+        except Exception:
+            # the bank answered, e.g. a 4xx, so it does not count against its health
+            self._record(False, self._clock() - start >= self._slow_call_duration)
+            raise
+        self._record(False, self._clock() - start >= self._slow_call_duration)
+        return result
+
+    def _acquire(self) -> bool:
+        # whether the call is a half open probe
+        if self._state is CircuitState.OPEN:
+            if self._clock() - self._opened_at < self._open_duration:
+                rejected_total.inc()
+                raise BankCircuitOpenError("Downstream bank server is unavailable, please retry later.")
+            logger.warning("Bank circuit half open, sending %d probe calls", self._half_open_calls)
+            self._state = CircuitState.HALF_OPEN
+            self._probe_permits = self._half_open_calls
+            self._probe_successes = 0
+
+        if self._state is CircuitState.HALF_OPEN:
+            if self._probe_permits == 0:
+                rejected_total.inc()
+                raise BankCircuitOpenError("Downstream bank server is unavailable, please retry later.")
+            self._probe_permits -= 1
+            return True
+        return False
+
+    def _record(self, failed: bool, slow: bool) -> None:
+        if self._state is CircuitState.HALF_OPEN:
+            if failed or slow:
+                self._open()
+            else:
+                self._probe_successes += 1
+                if self._probe_successes >= self._half_open_calls:
+                    self._close()
+            return
+
+        if self._state is CircuitState.OPEN:
+            # a call started before the circuit opened
+            return
+
+        index = self._index
+        if self._calls == self._window_size:
+            self._failure_count -= self._failures[index]
+            self._slow_call_count -= self._slow_calls[index]
+        else:
+            self._calls += 1
+        self._failures[index] = failed
+        self._slow_calls[index] = slow
+        self._failure_count += failed
+        self._slow_call_count += slow
+        self._index = (index + 1) % self._window_size
+
+        if self._calls >= self._minimum_calls and (
+                self.failure_rate >= self._failure_rate_threshold
+                or self.slow_call_rate >= self._slow_call_rate_threshold):
+            self._open()
+
+    def _open(self) -> None:
+        logger.error("Bank circuit open, failure rate %.2f, slow call rate %.2f",
+                     self.failure_rate, self.slow_call_rate)
+        opened_total.inc()
+        self._state = CircuitState.OPEN
+        self._opened_at = self._clock()
+        self._probe_permits = 0
+
+    def _close(self) -> None:
+        logger.warning("Bank circuit closed")
+        self._state = CircuitState.CLOSED
+        self._failures = [False] * self._window_size
+        self._slow_calls = [False] * self._window_size
+        self._index = 0
+        self._calls = 0
+        self._failure_count = 0
+        self._slow_call_count = 0
+
+
+def create_circuit_breaker(acquirer: str) -> CircuitBreaker:
+    breaker = CircuitBreaker(
+        window_size=payment_settings.bank_breaker_window_size,
+        minimum_calls=payment_settings.bank_breaker_minimum_calls,
+        failure_rate_threshold=payment_settings.bank_breaker_failure_rate,
+        slow_call_rate_threshold=payment_settings.bank_breaker_slow_call_rate,
+        slow_call_duration=payment_settings.bank_breaker_slow_call_duration,
+        open_duration=payment_settings.bank_breaker_open_duration,
+        half_open_calls=payment_settings.bank_breaker_half_open_calls,
+    )
+    state_gauge.labels(acquirer, read=lambda: breaker.state.value)
+    failure_rate_gauge.labels(acquirer, read=lambda: breaker.failure_rate)
+    slow_call_rate_gauge.labels(acquirer, read=lambda: breaker.slow_call_rate)
+    return breaker
@@ -0,0 +1,60 @@
+import hashlib
+import math
+import time
+import uuid
+from collections import OrderedDict
+from typing import NamedTuple
+
+from payment_gateway_api.metrics import registry
+from payment_gateway_api.models import PaymentResponse
+
+hits_total = registry.counter("payment_cache_hits_total", "Payment lookups answered by the response cache.")
+misses_total = registry.counter("payment_cache_misses_total", "Payment lookups that went to the payment store.")
+
+
+class EncodedPayment(NamedTuple):
+    body: bytes
+    etag: str
+
+
+def encode_payment(payment: PaymentResponse) -> EncodedPayment:
+    body = PaymentResponse.__pydantic_serializer__.to_json(payment)
+    # a strong validator of the exact bytes, a pending payment gets a new one once the bank answers
+    return EncodedPayment(body, f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"')
+
+
+class ResponseCache:
+    # the encoded responses of the most recently written or read payments, merchants poll a
+    # payment right after creating it so it is cached at write time. Each is kept with the
+    # merchant it belongs to, a get for another merchant is a miss, and with the time the store
+    # stops finding it, a get from then is a miss too.
+    def __init__(self, max_entries: int):
+        self._max_entries = max_entries
+        self._data = OrderedDict[bytes, tuple[str | None, float, EncodedPayment]]()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, payment_id: uuid.UUID, merchant_id: str | None = None) -> EncodedPayment | None:
+        key = payment_id.bytes
+        entry = self._data.get(key, None)
+        if entry is not None and time.time() >= entry[1]:
+            del self._data[key]
+            entry = None
+        if entry is None or (merchant_id is not None and entry[0] != merchant_id):
+            misses_total.inc()
+            return None
+        hits_total.inc()
+        self._data.move_to_end(key)
+        return entry[2]
+
+    def put(self, payment_id: uuid.UUID, encoded: EncodedPayment, merchant_id: str | None = None,
+            expires_at: float = math.inf) -> None:
+        key = payment_id.bytes
+        self._data[key] = (merchant_id, expires_at, encoded)
+        self._data.move_to_end(key)
+        if len(self._data) > self._max_entries:
+            self._data.popitem(last=False)
+
+    def discard(self, payment_id: uuid.UUID) -> None:
+        self._data.pop(payment_id.bytes, None)
@@ -1,39 +1,118 @@
+import asyncio
 import logging
+import time
+import uuid
 
 import httpx
 
-from payment_gateway_api.exceptions import PaymentServerError, BankServerError
+from payment_gateway_api.batchers import BankBatcher
+from payment_gateway_api.breakers import CircuitBreaker
+from payment_gateway_api.exceptions import PaymentServerError, BankServerError, BankConnectionError
+from payment_gateway_api.hedging import HedgePolicy
+from payment_gateway_api.metrics import registry
 from payment_gateway_api.models import BankPaymentRequest, BankPaymentResponse
+from payment_gateway_api.retries import RetryPolicy
 from payment_gateway_api.settings import payment_settings
+from payment_gateway_api.tracing import Span, tracer
 
 logger = logging.getLogger(__name__)
 
+bank_request_duration = registry.histogram(
+    "bank_request_duration_seconds", "Latency of one bank call by outcome.", ("outcome",))
+_authorized = bank_request_duration.labels("authorized")
+_declined = bank_request_duration.labels("declined")
+_client_error = bank_request_duration.labels("client_error")
+_server_error = bank_request_duration.labels("server_error")
+_transport_error = bank_request_duration.labels("transport_error")
+
+
+def create_http_client() -> httpx.AsyncClient:
+    # one pooled client per process, keep-alive connections are reused across payments
+    limits = httpx.Limits(
+        max_connections=payment_settings.bank_max_connections,
+        max_keepalive_connections=payment_settings.bank_max_keepalive_connections,
+        keepalive_expiry=payment_settings.bank_keepalive_expiry,
+    )
+    return httpx.AsyncClient(timeout=payment_settings.bank_timeout, limits=limits, http2=payment_settings.bank_http2)
+
 
 class BankClient:
-    def __init__(self):
-        self._payments_url = f"{payment_settings.bank_url}/payments"
-        self._timeout = payment_settings.bank_timeout
+    def __init__(self, client: httpx.AsyncClient, retry_policy: RetryPolicy | None = None,
+                 circuit_breaker: CircuitBreaker | None = None, batcher: BankBatcher | None = None,
+                 bank_url: str | None = None, hedge_policy: HedgePolicy | None = None):
+        self._client = client
+        self._retry_policy = retry_policy
+        self._circuit_breaker = circuit_breaker
+        self._batcher = batcher
+        self._hedge_policy = hedge_policy
+        self._payments_url = f"{bank_url or payment_settings.bank_url}/payments"
 
     async def process_payment(self, payment: BankPaymentRequest) -> BankPaymentResponse:
-        async with httpx.AsyncClient(timeout=self._timeout) as client:
-            try:
-                response = await client.post(self._payments_url, json=payment.model_dump())
-
-                status = response.status_code
-                if 400 <= status < 500:
-                    # cannot retry - bad request - suppose not reach here, error message should not be exposed to caller.
-                    logger.error("Client error %d : %s", status, response.text)
-                    raise PaymentServerError("Internal server error")
-
-                if 500 <= status < 600:
-                    # possible retry for code 5XX
-                    logger.error("Server error %d : %s", status, response.text)
-                    raise BankServerError("Downstream bank server is unavailable, please retry later.")
-
-                response_body = response.json()
-                return BankPaymentResponse(**response_body)
-
-            except httpx.RequestError as e:
-                # might be network issue, e.g. wrong host/firewall issue, high load - server no response, etc.
-                logger.error("Request Error: %s", str(e))
-                raise PaymentServerError("Request error when calling downstream bank.")
+        body = payment.model_dump()
+        # one reference for every retry and hedge of this payment, so the bank can tell them apart from new payments
+        headers = {"Idempotency-Key": str(uuid.uuid4())}
+        if self._retry_policy is None:
+            return await self._attempt(body, headers, None)
+        return await self._retry_policy.call(lambda deadline: self._attempt(body, headers, deadline))
+
+    async def _attempt(self, body: dict, headers: dict, deadline: float | None) -> BankPaymentResponse:
+        if self._circuit_breaker is None:
+            return await self._timed_send(body, headers, deadline)
+        # the breaker sees one call however many hedged attempts it took, a cancelled loser is no failure
+        return await self._circuit_breaker.call(lambda: self._timed_send(body, headers, deadline))
+
+    async def _timed_send(self, body: dict, headers: dict, deadline: float | None) -> BankPaymentResponse:
+        # past the retry deadline the breaker gets a TimeoutError, a failure of the bank, while a
+        # cancellation from outside, e.g. a caller gone away, says nothing about it
+        async with asyncio.timeout_at(deadline):
+            return await self._hedged_send(body, headers)
+
+    async def _hedged_send(self, body: dict, headers: dict) -> BankPaymentResponse:
+        if self._hedge_policy is None:
+            return await self._send(body, headers)
+        return await self._hedge_policy.call(lambda: self._send(body, headers))
+
+    async def _send(self, body: dict, headers: dict) -> BankPaymentResponse:
+        # one span per attempt, retries and hedges each get their own
+        with tracer.span("bank.http") as span:
+            span.set_attribute("http.url", self._payments_url)
+            result = await self._send_traced(body, headers, span)
+        return result
+
+    async def _send_traced(self, body: dict, headers: dict, span: Span) -> BankPaymentResponse:
+        start = time.perf_counter()
+        try:
+            if self._batcher is None:
+                # the bank's spans join the payment's trace as children of this attempt
+                traceparent = tracer.traceparent()
+                if traceparent is not None:
+                    headers = {**headers, "traceparent": traceparent}
+                response = await self._client.post(self._payments_url, json=body, headers=headers)
+            else:
+                # a batch carries many payments, it belongs to no single trace
+                response = await self._batcher.submit(body)
+        except httpx.RequestError as e:
+            # might be network issue, e.g. wrong host/firewall issue, high load - server no response, etc.
+            _transport_error.observe(time.perf_counter() - start)
+            logger.error("Request Error: %s", str(e))
+            raise BankConnectionError("Request error when calling downstream bank.")
+        elapsed = time.perf_counter() - start
+
+        status = response.status_code
+        span.set_attribute("http.status_code", status)
+        if 400 <= status < 500:
+            # cannot retry - bad request - suppose not reach here, error message should not be exposed to caller.
+            _client_error.observe(elapsed)
+            logger.error("Client error %d : %s", status, response.text)
+            raise PaymentServerError("Internal server error")
+
+        if 500 <= status < 600:
+            # retried by the retry policy
+            _server_error.observe(elapsed)
+            logger.error("Server error %d : %s", status, response.text)
+            raise BankServerError("Downstream bank server is unavailable, please retry later.")
+
+        response_body = response.json()
+        result = BankPaymentResponse(**response_body)
+        (_authorized if result.authorized else _declined).observe(elapsed)
+        return result
@@ -0,0 +1,47 @@
+import httpx
+
+from payment_gateway_api.acquirers import create_acquirer_router
+from payment_gateway_api.idempotency import create_idempotency_cache
+from payment_gateway_api.limiters import create_payment_limiter, create_lookup_limiter
+from payment_gateway_api.ratelimits import create_api_keys, create_rate_limiter
+from payment_gateway_api.retries import create_retry_policy
+from payment_gateway_api.services import PaymentService
+from payment_gateway_api.settings import payment_settings
+from payment_gateway_api.validators import PaymentValidator
+from payment_gateway_api.webhooks import create_webhook_client, create_webhook_dispatcher
+from payment_gateway_api.workers import create_payment_worker_pool
+
+
+class Container:
+    # the long lived objects of the app, built once at startup and kept on app.state.container,
+    # the route dependencies only look them up
+    def __init__(self, http_client: httpx.AsyncClient):
+        self.http_client = http_client
+        self.retry_policy = create_retry_policy()
+        self.bank_router = create_acquirer_router(http_client, self.retry_policy)
+        self.idempotency_cache = create_idempotency_cache()
+        self.payment_limiter = create_payment_limiter()
+        self.lookup_limiter = create_lookup_limiter()
+        self.api_keys = create_api_keys()
+        self.rate_limiter = create_rate_limiter()
+        self.validator = PaymentValidator()
+        self.payment_workers = create_payment_worker_pool()
+        # built only when enabled, an idle dispatcher would still poll the store of every worker
+        self.webhook_client = create_webhook_client() if payment_settings.webhooks_enabled else None
+        self.webhooks = create_webhook_dispatcher(self.webhook_client) if self.webhook_client is not None else None
+        self.payment_service = PaymentService(self.bank_router, self.idempotency_cache, self.payment_workers,
+                                              self.webhooks)
+
+    async def start(self) -> None:
+        self.payment_workers.start()
+        if self.webhooks is not None:
+            await self.webhooks.start()
+
+    async def close(self) -> None:
+        # the queued async payments still need the bank and notify the webhooks
+        await self.payment_workers.close()
+        if self.webhooks is not None:
+            await self.webhooks.close()
+            await self.webhook_client.aclose()
+        await self.bank_router.close()
+        await self.rate_limiter.close()
@@ -6,9 +6,33 @@ class PaymentNotFoundError(Exception):
     pass
 
 
+class WebhookNotFoundError(Exception):
+    pass
+
+
+class ForbiddenError(Exception):
+    pass
+
+
 class PaymentServerError(Exception):
     pass
 
 
 class BankServerError(Exception):
     pass
+
+
+class BankConnectionError(PaymentServerError):
+    pass
+
+
+class BankCircuitOpenError(BankServerError):
+    pass
+
+
+class IdempotencyKeyMismatchError(Exception):
+    pass
+
+
+class OverloadedError(Exception):
+    pass
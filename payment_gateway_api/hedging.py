@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import time
+from collections.abc import Awaitable, Callable
+
+from payment_gateway_api.metrics import registry
+from payment_gateway_api.retries import RetryBudget
+from payment_gateway_api.settings import payment_settings
+
+logger = logging.getLogger(__name__)
+
+hedges_fired_total = registry.counter("bank_hedges_fired_total", "Second bank attempts sent for slow calls.")
+hedges_won_total = registry.counter("bank_hedges_won_total", "Hedged bank attempts that answered first.")
+hedges_capped_total = registry.counter(
+    "bank_hedges_capped_total", "Slow bank calls not hedged because the hedge budget was empty.")
+
+
+class LatencyTracker:
+    # ring buffer of the latest bank latencies, the percentile is recomputed every
+    # tenth of the window instead of sorting on every call
+    def __init__(self, window: int, percentile: float, min_samples: int):
+        self._samples = [0.0] * window
+        self._percentile = percentile
+        self._min_samples = min_samples
+        self._index = 0
+        self._count = 0
+        self._refresh_every = max(1, window // 10)
+        self._since_refresh = 0
+        self._threshold: float | None = None
+
+    @property
+    def threshold(self) -> float | None:
+        # None until there are enough samples to trust the percentile
+        return self._threshold
+
+    def observe(self, latency: float) -> None:
+        self._samples[self._index] = latency
+        self._index = (self._index + 1) % len(self._samples)
+        self._count = min(self._count + 1, len(self._samples))
+        self._since_refresh += 1
+        if self._count >= self._min_samples and self._since_refresh >= self._refresh_every:
+            self._since_refresh = 0
+            ordered = sorted(self._samples[:self._count])
+            self._threshold = ordered[min(self._count - 1, int(self._count * self._percentile))]
+
+
+class HedgePolicy:
+    # when the first attempt is slower than the tracked percentile, a second identical attempt
+    # is sent, the first success wins and the other one is cancelled. Hedges draw from a token
+    # bucket filled by every call, so they stay a bounded share of the bank traffic.
+    def __init__(self, tracker: LatencyTracker, budget: RetryBudget):
+        self._tracker = tracker
+        self._budget = budget
+
+    async def call[T](self, attempt: Callable[[], Awaitable[T]]) -> T:
+        self._budget.deposit()
+        start = time.perf_counter()
+        first = asyncio.ensure_future(attempt())
+        tasks = {first}
+        hedge = None
+        try:
+            delay = self._tracker.threshold
+            if delay is not None:
+                await asyncio.wait(tasks, timeout=delay)
+                if not first.done():
+                    if self._budget.try_withdraw():
+                        hedges_fired_total.inc()
+                        logger.debug("Bank call slower than %.3fs, sending a hedged attempt", delay)
+                        hedge = asyncio.ensure_future(self._timed(attempt))
+                        tasks.add(hedge)
+                    else:
+                        hedges_capped_total.inc()
+
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is not None:
+                        if not tasks:
+                            raise task.exception()
+                        # the other attempt may still succeed
+                        continue
+                    if task is hedge:
+                        hedges_won_total.inc()
+                        latency, result = task.result()
+                    else:
+                        latency, result = time.perf_counter() - start, task.result()
+                    self._tracker.observe(latency)
+                    return result
+        finally:
+            for task in (first, hedge):
+                if task is None:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    # the loser's error is not worth an "exception was never retrieved" log
+                    task.exception()
+
+    @staticmethod
+    async def _timed[T](attempt: Callable[[], Awaitable[T]]) -> tuple[float, T]:
+        start = time.perf_counter()
+        result = await attempt()
+        return time.perf_counter() - start, result
+
+
+def create_hedge_policy() -> HedgePolicy | None:
+    if not payment_settings.bank_hedge_enabled:
+        return None
+    tracker = LatencyTracker(payment_settings.bank_hedge_window, payment_settings.bank_hedge_percentile,
+                             payment_settings.bank_hedge_min_samples)
+    budget = RetryBudget(payment_settings.bank_hedge_ratio, payment_settings.bank_hedge_capacity)
+    return HedgePolicy(tracker, budget)
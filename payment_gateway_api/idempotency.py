@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+
+from payment_gateway_api.exceptions import IdempotencyKeyMismatchError
+from payment_gateway_api.metrics import registry
+from payment_gateway_api.models import PaymentResponse
+from payment_gateway_api.settings import payment_settings
+
+logger = logging.getLogger(__name__)
+
+replayed_total = registry.counter("idempotency_replayed_total", "Payments served from a previous Idempotency-Key.")
+evicted_total = registry.counter("idempotency_evicted_total", "Idempotency keys evicted before their ttl.")
+
+
+class _Entry:
+    __slots__ = ("fingerprint", "future", "expires_at")
+
+    def __init__(self, fingerprint: bytes, future: asyncio.Future):
+        self.fingerprint = fingerprint
+        self.future = future
+        # in flight entries never expire
+        self.expires_at = math.inf
+
+
+class IdempotencyCache:
+    # keys are per merchant, one merchant reusing another's key gets a payment of its own
+    def __init__(self, max_keys: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self._max_keys = max_keys
+        self._ttl = ttl
+        self._clock = clock
+        # ordered by completion time, so expired keys are always at the front
+        self._entries = OrderedDict[tuple[str | None, str], _Entry]()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def run(self, key: str, fingerprint: bytes, produce: Callable[[], Awaitable[PaymentResponse]],
+                  merchant_id: str | None = None) -> PaymentResponse:
+        self._evict_expired()
+        scoped_key = (merchant_id, key)
+        entry = self._entries.get(scoped_key)
+        if entry is not None:
+            if entry.fingerprint != fingerprint:
+                raise IdempotencyKeyMismatchError(f"Idempotency-Key {key} was already used with a different payment.")
+            replayed_total.inc()
+            logger.debug("replay payment for idempotency key %s", key)
+            return await asyncio.shield(entry.future)
+
+        # a task of its own, a caller that disconnects does not abort the bank call of the others
+        future = asyncio.ensure_future(produce())
+        entry = _Entry(fingerprint, future)
+        self._entries[scoped_key] = entry
+        future.add_done_callback(lambda f: self._complete(scoped_key, entry, f))
+        self._evict_overflow()
+        return await asyncio.shield(future)
+
+    def _complete(self, key: tuple[str | None, str], entry: _Entry, future: asyncio.Future) -> None:
+        if self._entries.get(key) is not entry:
+            return
+        if future.cancelled() or future.exception() is not None:
+            # failures are not remembered, the caller is expected to retry with the same key
+            del self._entries[key]
+            return
+        entry.expires_at = self._clock() + self._ttl
+        self._entries.move_to_end(key)
+
+    def _evict_expired(self) -> None:
+        now = self._clock()
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if entry.expires_at > now:
+                return
+            self._entries.popitem(last=False)
+
+    def _evict_overflow(self) -> None:
+        while len(self._entries) > self._max_keys:
+            self._entries.popitem(last=False)
+            evicted_total.inc()
+
+
+def create_idempotency_cache() -> IdempotencyCache:
+    return IdempotencyCache(payment_settings.idempotency_max_keys, payment_settings.idempotency_ttl)
@@ -0,0 +1,156 @@
+import logging
+import mmap
+import os
+import struct
+import zlib
+from collections.abc import Callable
+
+logger = logging.getLogger(__name__)
+
+# a frame is the payload length and crc32, then the payload, the fixed size records of one append
+_FRAME = struct.Struct("<II")
+# records per frame of a compacted segment
+_COMPACT_FRAME_RECORDS = 10_000
+_SUFFIX = ".journal"
+_COMPACTING_SUFFIX = ".compacting"
+# the data without the metadata of the file, macOS has only fsync
+_sync_data = getattr(os, "fdatasync", os.fsync)
+
+
+def _frame(payload: bytes) -> bytes:
+    return _FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+class PaymentJournal:
+    # an append only directory of numbered segment files of length prefixed, checksummed frames,
+    # each append is one frame of records of record size bytes starting with a key of key size
+    # bytes. A later record replaces an earlier one with the same key. The active segment is
+    # rotated beyond segment size bytes, and once compact segments are sealed they are rewritten
+    # as one holding the latest record of each key. The methods block, the store calls open and
+    # append from its writer thread and compact from another one, a sealed segment is never
+    # written again.
+    def __init__(self, path: str, key_size: int, record_size: int, segment_size: int, compact_segments: int):
+        self._path = path
+        # a record read as its key and value, a frame is split into records in C
+        self._record = struct.Struct(f"{key_size}s{record_size - key_size}s")
+        self._segment_size = segment_size
+        self._compact_segments = compact_segments
+        self._fd: int | None = None
+        self._segment = 0
+        self._size = 0
+
+    @property
+    def compactable(self) -> bool:
+        return len(self._sealed()) >= self._compact_segments
+
+    def open(self) -> dict[bytes, bytes]:
+        # the latest value of every key, the segments are read oldest first. Appends go to a
+        # new segment, a torn record at the end of the last one is cut off.
+        os.makedirs(self._path, exist_ok=True)
+        for name in os.listdir(self._path):
+            if name.endswith(_COMPACTING_SUFFIX):
+                os.unlink(os.path.join(self._path, name))
+        records = dict[bytes, bytes]()
+        segments = self._segments()
+        for number in segments:
+            path = self._segment_path(number)
+            size = os.path.getsize(path)
+            valid = self._read(path, size, records)
+            if valid < size:
+                if number == segments[-1]:
+                    logger.warning("Cut %d bytes of a torn record off journal segment %s", size - valid, path)
+                    os.truncate(path, valid)
+                else:
+                    logger.error("Journal segment %s is corrupt after byte %d, the rest is skipped", path, valid)
+        self._start_segment((segments[-1] if segments else 0) + 1)
+        return records
+
+    def append(self, records: list[bytes]) -> bool:
+        # one frame, one write and one fsync for all of them, a failed write is cut off again so
+        # the segment never holds a partial frame before later ones. True when the segment was rotated.
+        data = _frame(b"".join(records))
+        try:
+            written = 0
+            while written < len(data):
+                written += os.write(self._fd, data[written:])
+            _sync_data(self._fd)
+        except OSError:
+            os.ftruncate(self._fd, self._size)
+            raise
+        self._size += len(data)
+        if self._size < self._segment_size:
+            return False
+        os.close(self._fd)
+        self._start_segment(self._segment + 1)
+        return True
+
+    def compact(self, keep: Callable[[bytes], bool]) -> None:
+        # the sealed segments are rewritten into the newest of them, without the replaced records
+        # and the values keep rejects. A crash before the old segments are deleted replays them
+        # before the compacted one, which holds the latest record of their keys.
+        segments = self._sealed()
+        if len(segments) < 2:
+            return
+        records = dict[bytes, bytes]()
+        for number in segments:
+            path = self._segment_path(number)
+            self._read(path, os.path.getsize(path), records)
+        target = self._segment_path(segments[-1])
+        temporary = target + _COMPACTING_SUFFIX
+        kept = [key + value for key, value in records.items() if keep(value)]
+        with open(temporary, "wb") as file:
+            for i in range(0, len(kept), _COMPACT_FRAME_RECORDS):
+                file.write(_frame(b"".join(kept[i:i + _COMPACT_FRAME_RECORDS])))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, target)
+        for number in segments[:-1]:
+            os.unlink(self._segment_path(number))
+        self._sync_directory()
+        logger.info("Compacted %d journal segments into %s", len(segments), target)
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _read(self, path: str, size: int, records: dict[bytes, bytes]) -> int:
+        # the records of a segment into records, returns the length of its valid frames
+        if size == 0:
+            return 0
+        offset = 0
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                memoryview(data) as view:
+            while offset + _FRAME.size <= size:
+                length, checksum = _FRAME.unpack_from(data, offset)
+                start = offset + _FRAME.size
+                end = start + length
+                if end > size or length % self._record.size or zlib.crc32(view[start:end]) != checksum:
+                    break
+                records.update(self._record.iter_unpack(view[start:end]))
+                offset = end
+        return offset
+
+    def _start_segment(self, number: int) -> None:
+        self._segment = number
+        self._size = 0
+        self._fd = os.open(self._segment_path(number), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._sync_directory()
+
+    def _segments(self) -> list[int]:
+        return sorted(int(name[:-len(_SUFFIX)]) for name in os.listdir(self._path) if name.endswith(_SUFFIX))
+
+    def _sealed(self) -> list[int]:
+        # every segment before the active one is closed
+        active = self._segment
+        return [number for number in self._segments() if number < active]
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self._path, f"{number:012d}{_SUFFIX}")
+
+    def _sync_directory(self) -> None:
+        fd = os.open(self._path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
+from payment_gateway_api.exceptions import BankServerError, OverloadedError
+from payment_gateway_api.metrics import registry
+from payment_gateway_api.settings import payment_settings
+
+logger = logging.getLogger(__name__)
+
+rejected_total = registry.counter("concurrency_rejected_total", "Requests rejected by a full limiter.",
+                                  ("limiter",))
+queued_total = registry.counter("concurrency_queued_total", "Requests that waited for a limiter slot.",
+                                ("limiter",))
+
+
+class ConcurrencyLimiter:
+    # at most `limit` requests run at once, up to queue_size more wait in FIFO order for at
+    # most queue_timeout seconds, the rest are rejected at once instead of piling up
+    def __init__(self, name: str, limit: int, queue_size: int, queue_timeout: float):
+        self.name = name
+        self._limit = float(limit)
+        self._queue_size = queue_size
+        self._queue_timeout = queue_timeout
+        self._in_flight = 0
+        self._waiters = deque[asyncio.Future]()
+        self._rejected = rejected_total.labels(name)
+        self._queued = queued_total.labels(name)
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[None]:
+        await self._enter()
+        start = time.perf_counter()
+        dropped = False
+        try:
+            yield
+        except BankServerError:
+            dropped = True
+            raise
+        finally:
+            self._in_flight -= 1
+            self._on_sample(time.perf_counter() - start, dropped)
+            self._wake()
+
+    async def _enter(self) -> None:
+        if self._in_flight < self.limit and not self._waiters:
+            self._in_flight += 1
+            return
+        if len(self._waiters) >= self._queue_size:
+            self._reject("queue is full")
+        self._queued.inc()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            # unlike wait_for, wait does not cancel the future, _wake takes the slot before resolving it
+            await asyncio.wait((future,), timeout=self._queue_timeout)
+        except asyncio.CancelledError:
+            if future.done():
+                # woken up and cancelled at once, hand the slot on
+                self._in_flight -= 1
+                self._wake()
+            else:
+                self._give_up(future)
+            raise
+        if not future.done():
+            self._give_up(future)
+            self._reject("waited too long")
+
+    def _give_up(self, future: asyncio.Future) -> None:
+        future.cancel()
+        self._waiters.remove(future)
+
+    def _wake(self) -> None:
+        while self._waiters and self._in_flight < self.limit:
+            future = self._waiters.popleft()
+            if future.done():
+                continue
+            self._in_flight += 1
+            future.set_result(None)
+
+    def _reject(self, reason: str) -> None:
+        self._rejected.inc()
+        logger.warning("Rejected a request, %s limiter %s (limit %d, in flight %d)", self.name, reason,
+                       self.limit, self._in_flight)
+        raise OverloadedError("Too many requests in progress, please retry later.")
+
+    def _on_sample(self, latency: float, dropped: bool) -> None:
+        pass
+
+
+class AdaptiveConcurrencyLimiter(ConcurrencyLimiter):
+    # gradient limit: while the latency stays within tolerance of its long term baseline the limit
+    # grows by about sqrt(limit) per request, once it rises above the limit shrinks by
+    # baseline / latency, down to half per request, and a bank error cuts it by the backoff ratio
+    def __init__(self, name: str, initial_limit: int, min_limit: int, max_limit: int, queue_size: int,
+                 queue_timeout: float, tolerance: float, smoothing: float, backoff: float = 0.9):
+        super().__init__(name, initial_limit, queue_size, queue_timeout)
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._tolerance = tolerance
+        self._smoothing = smoothing
+        self._backoff = backoff
+        self._baseline = 0.0
+
+    @property
+    def baseline(self) -> float:
+        return self._baseline
+
+    def _on_sample(self, latency: float, dropped: bool) -> None:
+        limit = self._limit
+        if dropped:
+            new_limit = limit * self._backoff
+        else:
+            if self._baseline == 0.0:
+                self._baseline = latency
+            else:
+                # slow moving average, and it decays towards faster samples so a past slow
+                # period does not become the new normal
+                self._baseline += (latency - self._baseline) * (0.01 if latency > self._baseline else 0.05)
+            gradient = max(0.5, min(1.0, self._tolerance * self._baseline / latency)) if latency > 0 else 1.0
+            new_limit = limit * gradient
+            # only grow a limit that is actually in use
+            if self._in_flight + 1 >= limit / 2:
+                new_limit += math.sqrt(limit)
+        new_limit = limit + (new_limit - limit) * self._smoothing
+        self._limit = max(self._min_limit, min(self._max_limit, new_limit))
+
+
+def create_payment_limiter() -> AdaptiveConcurrencyLimiter:
+    limiter = AdaptiveConcurrencyLimiter(
+        "payments",
+        initial_limit=payment_settings.payment_concurrency_initial_limit,
+        min_limit=payment_settings.payment_concurrency_min_limit,
+        max_limit=payment_settings.payment_concurrency_max_limit,
+        queue_size=payment_settings.payment_concurrency_queue_size,
+        queue_timeout=payment_settings.payment_concurrency_queue_timeout,
+        tolerance=payment_settings.payment_concurrency_tolerance,
+        smoothing=payment_settings.payment_concurrency_smoothing,
+    )
+    registry.gauge("payment_concurrency_limit", "Current adaptive limit of concurrent payments.",
+                   lambda: limiter.limit)
+    registry.gauge("payment_in_flight", "Payments being processed.", lambda: limiter.in_flight)
+    registry.gauge("payment_queued", "Payments waiting for a concurrency slot.", lambda: limiter.queued)
+    return limiter
+
+
+def create_lookup_limiter() -> ConcurrencyLimiter:
+    # a separate budget, lookups stay fast while payments are throttled
+    return ConcurrencyLimiter("lookups", payment_settings.payment_lookup_concurrency,
+                              payment_settings.payment_lookup_queue_size,
+                              payment_settings.payment_concurrency_queue_timeout)
@@ -0,0 +1,189 @@
+import json
+import logging
+import queue
+import random
+import re
+import threading
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, UTC
+
+from payment_gateway_api.metrics import registry
+from payment_gateway_api.settings import payment_settings
+
+# the loggers whose handlers are moved behind the queue, uvicorn's and gunicorn's own
+# loggers do not propagate to the root logger
+QUEUED_LOGGERS = ("", "uvicorn", "uvicorn.error", "uvicorn.access", "gunicorn.error", "gunicorn.access")
+CORRELATION_ID_HEADER = "x-request-id"
+
+correlation_id = ContextVar[str | None]("correlation_id", default=None)
+# whether the debug lines of the current request are kept
+debug_sampled = ContextVar[bool]("debug_sampled", default=True)
+
+dropped_total = registry.counter("log_records_dropped_total", "Log records dropped because the log queue was full.")
+
+# card numbers are 14-19 digits, 13 and up also covers a full number cut short
+_CARD_NUMBER = re.compile(r"(?<!\d)\d{13,19}(?!\d)")
+_LOG_RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "correlation_id"}
+
+
+def _mask(match: re.Match) -> str:
+    number = match.group()
+    return "*" * (len(number) - 4) + number[-4:]
+
+
+def mask_card_numbers(text: str) -> str:
+    return _CARD_NUMBER.sub(_mask, text)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return mask_card_numbers(super().format(record))
+
+
+class JsonFormatter(logging.Formatter):
+    # one JSON object per line, the fields passed in extra= are kept as they are
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, UTC).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+        }
+        correlation = getattr(record, "correlation_id", None)
+        if correlation is not None:
+            entry["correlation_id"] = correlation
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return mask_card_numbers(json.dumps(entry, default=str))
+
+
+def create_formatter() -> logging.Formatter:
+    if payment_settings.log_format == "json":
+        return JsonFormatter()
+    return TextFormatter("%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s",
+                         "%Y-%m-%d %H:%M:%S")
+
+
+def configure_logging() -> None:
+    # the handler log_queue moves behind the queue when the app starts
+    handler = logging.StreamHandler()
+    handler.setFormatter(create_formatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(payment_settings.log_level.upper())
+
+
+class _QueueHandler(logging.Handler):
+    # runs on the event loop, only tags and enqueues the record, formatting and writing
+    # happen on the log thread
+    def __init__(self, log_queue: queue.Queue, handlers: tuple[logging.Handler, ...]):
+        super().__init__()
+        self._queue = log_queue
+        self._handlers = handlers
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # no handler lock, Queue is thread safe
+        if record.levelno < logging.INFO and not debug_sampled.get():
+            return False
+        if not hasattr(record, "correlation_id"):
+            record.correlation_id = correlation_id.get()
+        try:
+            self._queue.put_nowait((record, self._handlers))
+        except queue.Full:
+            dropped_total.inc()
+        return True
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.handle(record)
+
+
+class LogQueue:
+    # the handlers of the queued loggers are replaced by a handler that puts records on a
+    # bounded queue, one background thread hands them to the original handlers. A full queue
+    # drops records instead of blocking requests on a slow stderr.
+    def __init__(self, max_size: int):
+        self._queue = queue.Queue(max_size)
+        self._thread: threading.Thread | None = None
+        self._moved = list[tuple[logging.Logger, list[logging.Handler]]]()
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        for name in QUEUED_LOGGERS:
+            logger = logging.getLogger(name)
+            if not logger.handlers:
+                continue
+            handlers = list(logger.handlers)
+            self._moved.append((logger, handlers))
+            logger.handlers[:] = [_QueueHandler(self._queue, tuple(handlers))]
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        # writes out the records still queued and gives the loggers their handlers back
+        if self._thread is None:
+            return
+        for logger, handlers in self._moved:
+            logger.handlers[:] = handlers
+        self._moved.clear()
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            record, handlers = item
+            for handler in handlers:
+                if record.levelno >= handler.level:
+                    # handle() reports its own errors through handleError
+                    handler.handle(record)
+
+
+def create_log_queue() -> LogQueue | None:
+    if payment_settings.log_queue_size <= 0:
+        return None
+    return LogQueue(payment_settings.log_queue_size)
+
+
+class CorrelationIdMiddleware:
+    # tags the log records of a request with its X-Request-ID, taken from the caller or a new
+    # one, echoed in the response, and decides once per request whether its debug lines are kept
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                # bounded and printable, it ends up in every log line of the request
+                if 0 < len(value) <= 128 and value.isascii() and value.decode().isprintable():
+                    request_id = value.decode()
+                break
+        if request_id is None:
+            request_id = uuid.uuid4().hex
+        correlation_token = correlation_id.set(request_id)
+        sampled_token = debug_sampled.set(random.random() < payment_settings.log_debug_sample_rate)
+        header = (CORRELATION_ID_HEADER.encode(), request_id.encode())
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), header]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            correlation_id.reset(correlation_token)
+            debug_sampled.reset(sampled_token)
@@ -0,0 +1,186 @@
+import time
+from bisect import bisect_left
+from collections.abc import Callable, Iterator
+
+# recording happens on the single event loop thread, plain adds into preallocated
+# slots are atomic enough, so there are no locks on the hot path
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(label_names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    __slots__ = ("name", "description", "label_names", "value", "_children")
+
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.value = 0.0
+        self._children = dict[tuple[str, ...], Counter]()
+
+    def labels(self, *values: str) -> "Counter":
+        # bind once at import time where the labels are known, e.g. a validation rule
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = Counter(self.name, self.description)
+        return child
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} counter"
+        if not self.label_names:
+            yield f"{self.name} {self.value}"
+            return
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{_format_labels(self.label_names, values)} {child.value}"
+
+
+class Histogram:
+    __slots__ = ("name", "description", "label_names", "buckets", "counts", "sum", "count", "_children")
+
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        # one slot per bucket plus +Inf, not cumulative until rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._children = dict[tuple[str, ...], Histogram]()
+
+    def labels(self, *values: str) -> "Histogram":
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = Histogram(self.name, self.description, buckets=self.buckets)
+        return child
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} histogram"
+        if not self.label_names:
+            yield from self._render_series(())
+            return
+        for values, child in list(self._children.items()):
+            yield from child._render_series(values, self.label_names)
+
+    def _render_series(self, values: tuple[str, ...], label_names: tuple[str, ...] = ()) -> Iterator[str]:
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f"{self.name}_bucket{_format_labels(label_names, values, f'le="{bound}"')} {cumulative}"
+        yield f"{self.name}_bucket{_format_labels(label_names, values, 'le="+Inf"')} {self.count}"
+        yield f"{self.name}_sum{_format_labels(label_names, values)} {self.sum}"
+        yield f"{self.name}_count{_format_labels(label_names, values)} {self.count}"
+
+
+class Gauge:
+    __slots__ = ("name", "description", "label_names", "read", "_children")
+
+    def __init__(self, name: str, description: str, read: Callable[[], float] | None = None,
+                 label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        # sampled only when rendered, nothing is recorded on the hot path
+        self.read = read
+        self._children = dict[tuple[str, ...], Gauge]()
+
+    def labels(self, *values: str, read: Callable[[], float]) -> "Gauge":
+        # the latest read of a series wins, e.g. a new breaker created by a new app lifespan
+        child = self._children[values] = Gauge(self.name, self.description, read)
+        return child
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} gauge"
+        if not self.label_names:
+            yield f"{self.name} {float(self.read())}"
+            return
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{_format_labels(self.label_names, values)} {float(child.read())}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = dict[str, Counter | Histogram | Gauge]()
+
+    def counter(self, name: str, description: str, label_names: tuple[str, ...] = ()) -> Counter:
+        if name not in self._metrics:
+            self._metrics[name] = Counter(name, description, label_names)
+        return self._metrics[name]
+
+    def histogram(self, name: str, description: str, label_names: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        if name not in self._metrics:
+            self._metrics[name] = Histogram(name, description, label_names, buckets)
+        return self._metrics[name]
+
+    def gauge(self, name: str, description: str, read: Callable[[], float] | None = None,
+              label_names: tuple[str, ...] = ()) -> Gauge:
+        # the latest registration wins, e.g. a new worker pool created by a new app lifespan. A
+        # labelled gauge is registered once and each of its series is read as given to labels.
+        if label_names:
+            if name not in self._metrics:
+                self._metrics[name] = Gauge(name, description, label_names=label_names)
+            return self._metrics[name]
+        self._metrics[name] = Gauge(name, description, read)
+        return self._metrics[name]
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by method, route and status.",
+    ("method", "route", "status"))
+
+
+class MetricsMiddleware:
+    # a plain ASGI middleware, cheaper than BaseHTTPMiddleware on every request
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # the route template, not the raw path, keeps the number of series bounded
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            http_request_duration.labels(scope["method"], path, str(status_code)).observe(
+                time.perf_counter() - start)
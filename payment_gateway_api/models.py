@@ -1,7 +1,8 @@
 import uuid
+from datetime import datetime
 from enum import Enum
 
-from pydantic import BaseModel, field_serializer, field_validator
+from pydantic import BaseModel, Field, RootModel, field_serializer, field_validator
 
 
 class PaymentRequest(BaseModel):
@@ -27,9 +28,23 @@ class PaymentResponse(BaseModel):
         return status.name
 
 
+class PaymentListItem(PaymentResponse):
+    created_at: datetime
+
+
+class PaymentPage(BaseModel):
+    items: list[PaymentListItem]
+    # pass as cursor to get the next page, None on the last page
+    next_cursor: str | None = None
+
+
 class PaymentStatus(Enum):
     AUTHORIZED = 1
     DECLINED = 2
+    # accepted with Prefer: respond-async, the bank has not answered yet
+    PENDING = 3
+    # an accepted payment the bank could not process, it was not charged
+    FAILED = 4
 
 
 class BankPaymentRequest(BaseModel):
@@ -53,3 +68,45 @@ class BankPaymentResponse(BaseModel):
 
 class ErrorResponse(BaseModel):
     message: str
+
+
+class BatchPaymentResult(BaseModel):
+    index: int
+    status_code: int
+    payment: PaymentResponse | None = None
+    message: str | None = None
+
+
+class CircuitBreakerResponse(BaseModel):
+    state: str
+    calls: int
+    failure_rate: float
+    slow_call_rate: float
+
+
+class CircuitBreakersResponse(RootModel[dict[str, CircuitBreakerResponse]]):
+    # the breaker of each acquirer by its name
+    pass
+
+
+class WebhookRequest(BaseModel):
+    url: str
+    # signs the webhook requests, generated when not given
+    secret: str | None = Field(default=None, min_length=16, max_length=128)
+
+    @field_validator("url")
+    @classmethod
+    def http_url(cls, v):
+        if not v.startswith(("http://", "https://")):
+            raise ValueError("url must be an http or https URL")
+        return v
+
+
+class WebhookResponse(BaseModel):
+    merchant_id: str
+    url: str
+
+
+class WebhookRegistration(WebhookResponse):
+    # only returned when the webhook is registered
+    secret: str
@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import math
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from fastapi import status
+
+from payment_gateway_api.metrics import registry
+from payment_gateway_api.responses import error_response
+from payment_gateway_api.settings import payment_settings
+
+logger = logging.getLogger(__name__)
+
+API_KEY_HEADER = "X-API-Key"
+# seconds of float rounding forgiven at the edge of a burst, a tat near time.time() is only exact to 0.2µs
+_TOLERANCE = 1e-6
+
+rate_limited_total = registry.counter("rate_limited_total", "Requests rejected by the rate limit of their API key.",
+                                      ("merchant",))
+unauthorized_total = registry.counter("unauthorized_total", "Requests without a known API key.")
+
+
+class ApiKey(NamedTuple):
+    merchant_id: str
+    rate: float
+    burst: int
+
+
+class RateLimit(NamedTuple):
+    allowed: bool
+    limit: int
+    # requests still allowed at once after this one
+    remaining: int
+    # seconds until the whole burst is available again
+    reset_after: float
+    # seconds until a rejected request would be allowed, 0 when allowed
+    retry_after: float
+
+
+def _allowed(now: float, tat: float, interval: float, burst: int) -> RateLimit:
+    # tat is the theoretical arrival time after this request, burst intervals ahead of now at most
+    remaining = int((now + burst * interval - tat + _TOLERANCE) / interval)
+    return RateLimit(True, burst, remaining, tat - now, 0.0)
+
+
+def _rejected(now: float, tat: float, interval: float, burst: int) -> RateLimit:
+    return RateLimit(False, burst, 0, tat - now, tat + interval - burst * interval - now)
+
+
+class RateLimiter(ABC):
+    # GCRA, a key's state is a single theoretical arrival time (tat), how far its requests are ahead
+    # of its rate. A request moves it one interval of 1 / rate on from max(tat, now) and is rejected
+    # instead when that would put it more than burst intervals ahead of now. A tat in the past is the
+    # same as no entry, so idle keys are dropped from the table without losing anything.
+    @abstractmethod
+    async def acquire(self, key: str, rate: float, burst: int) -> RateLimit:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryRateLimiter(RateLimiter):
+    # one float per active key in a dict, idle keys are swept out every sweep interval seconds
+    def __init__(self, sweep_interval: float, clock: Callable[[], float] = time.monotonic):
+        self._sweep_interval = sweep_interval
+        self._clock = clock
+        self._tats = dict[str, float]()
+        self._next_sweep = clock() + sweep_interval
+
+    def __len__(self) -> int:
+        return len(self._tats)
+
+    async def acquire(self, key: str, rate: float, burst: int) -> RateLimit:
+        now = self._clock()
+        if now >= self._next_sweep:
+            self._sweep(now)
+        interval = 1.0 / rate
+        tat = max(self._tats.get(key, now), now) + interval
+        if tat - burst * interval > now + _TOLERANCE:
+            return _rejected(now, tat - interval, interval, burst)
+        self._tats[key] = tat
+        return _allowed(now, tat, interval, burst)
+
+    def _sweep(self, now: float) -> None:
+        # rebuilt rather than deleted from, the dict shrinks back after a burst of keys
+        self._tats = {key: tat for key, tat in self._tats.items() if tat > now}
+        self._next_sweep = now + self._sweep_interval
+
+
+class SqliteRateLimiter(RateLimiter):
+    # the tats in a WAL mode database file shared by every worker on the host, so a key has one
+    # limit whichever worker it reaches. A request is one upsert that only moves the tat when
+    # the request is allowed. The requests arriving while a batch is in the writer thread go
+    # together in the next transaction, so a busy worker pays one thread hop and one write lock
+    # for many of them. The state is not worth an fsync, a crash at most forgets the latest requests.
+    _SCHEMA = "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tat REAL NOT NULL) WITHOUT ROWID"
+    # ?1 key, ?2 now, ?3 interval, ?4 burst intervals and the tolerance, returns no row when rejected
+    _ACQUIRE = ("INSERT INTO rate_limits VALUES (?1, ?2 + ?3) "
+                "ON CONFLICT (key) DO UPDATE SET tat = max(tat, ?2) + ?3 WHERE max(tat, ?2) + ?3 - ?4 <= ?2 "
+                "RETURNING tat")
+    _SELECT = "SELECT tat FROM rate_limits WHERE key = ?"
+    _SWEEP = "DELETE FROM rate_limits WHERE tat <= ?"
+
+    def __init__(self, path: str, sweep_interval: float, clock: Callable[[], float] = time.time):
+        self._path = path
+        self._sweep_interval = sweep_interval
+        self._clock = clock
+        self._next_sweep = clock() + sweep_interval
+        self._pending = list[tuple[str, float, int, asyncio.Future]]()
+        self._flush_task: asyncio.Task | None = None
+        # sqlite connections are used from their own thread only
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rate-limiter")
+        self._connection: sqlite3.Connection | None = None
+
+    async def acquire(self, key: str, rate: float, burst: int) -> RateLimit:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((key, rate, burst, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+        return await future
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close)
+        self._executor.shutdown()
+
+    async def _flush(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending:
+                batch = self._pending
+                self._pending = []
+                try:
+                    limits = await loop.run_in_executor(self._executor, self._acquire,
+                                                        [(key, rate, burst) for key, rate, burst, _ in batch])
+                except sqlite3.Error as e:
+                    # an unavailable limiter lets the requests through instead of failing every payment
+                    logger.error("Rate limit of %d requests not checked: %s", len(batch), str(e))
+                    limits = [RateLimit(True, burst, burst - 1, 0.0, 0.0) for _, _, burst, _ in batch]
+                for (_, _, _, future), limit in zip(batch, limits):
+                    if not future.done():
+                        future.set_result(limit)
+        finally:
+            self._flush_task = None
+
+    def _acquire(self, requests: list[tuple[str, float, int]]) -> list[RateLimit]:
+        if self._connection is None:
+            self._connection = self._connect()
+        connection = self._connection
+        now = self._clock()
+        limits = []
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if now >= self._next_sweep:
+                # any worker may sweep, the others find fewer idle keys
+                connection.execute(self._SWEEP, (now,))
+                self._next_sweep = now + self._sweep_interval
+            for key, rate, burst in requests:
+                interval = 1.0 / rate
+                row = connection.execute(self._ACQUIRE, (key, now, interval, burst * interval + _TOLERANCE)).fetchone()
+                if row is not None:
+                    limits.append(_allowed(now, row[0], interval, burst))
+                    continue
+                tat = connection.execute(self._SELECT, (key,)).fetchone()[0]
+                limits.append(_rejected(now, max(tat, now), interval, burst))
+            connection.execute("COMMIT")
+        except BaseException:
+            # a failed COMMIT (busy, disk full) may leave the transaction open as well
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        return limits
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=OFF")
+        connection.execute("PRAGMA busy_timeout=5000")
+        connection.execute(self._SCHEMA)
+        return connection
+
+    def _close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def _headers(limit: RateLimit) -> list[tuple[bytes, bytes]]:
+    # bytes formatting, about half the cost of str().encode() on every request
+    return [(b"x-ratelimit-limit", b"%d" % limit.limit),
+            (b"x-ratelimit-remaining", b"%d" % limit.remaining),
+            (b"x-ratelimit-reset", b"%d" % math.ceil(limit.reset_after))]
+
+
+class ApiKeyMiddleware:
+    # requests to /api need a known X-API-Key, whose merchant is put in the request state, and are
+    # answered 429 beyond the key's rate. Checked before the body is read or a route runs, so a
+    # flooding key costs a lookup and does not reach the limiters or the bank. The keys and the
+    # limiter are the container's, without API keys every request passes.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/api/"):
+            await self.app(scope, receive, send)
+            return
+        container = scope["app"].state.container
+        api_keys = container.api_keys
+        if not api_keys:
+            await self.app(scope, receive, send)
+            return
+
+        key = None
+        for name, value in scope["headers"]:
+            if name == b"x-api-key":
+                key = value.decode("latin-1")
+                break
+        api_key = api_keys.get(key) if key is not None else None
+        if api_key is None:
+            unauthorized_total.inc()
+            response = error_response(status.HTTP_401_UNAUTHORIZED, "Missing or unknown API key.",
+                                      {"WWW-Authenticate": API_KEY_HEADER})
+            await response(scope, receive, send)
+            return
+
+        limit = await container.rate_limiter.acquire(key, api_key.rate, api_key.burst)
+        headers = _headers(limit)
+        if not limit.allowed:
+            rate_limited_total.labels(api_key.merchant_id).inc()
+            response = error_response(status.HTTP_429_TOO_MANY_REQUESTS, "Rate limit exceeded, please retry later.",
+                                      {"Retry-After": str(math.ceil(limit.retry_after))})
+            response.raw_headers.extend(headers)
+            await response(scope, receive, send)
+            return
+
+        scope.setdefault("state", {})["merchant_id"] = api_key.merchant_id
+
+        async def send_with_rate_limit(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), *headers]
+            await send(message)
+
+        await self.app(scope, receive, send_with_rate_limit)
+
+
+def create_api_keys() -> dict[str, ApiKey]:
+    return {api_key.key: ApiKey(api_key.merchant_id,
+                                payment_settings.rate_limit_rate if api_key.rate is None else api_key.rate,
+                                payment_settings.rate_limit_burst if api_key.burst is None else api_key.burst)
+            for api_key in payment_settings.api_keys}
+
+
+def create_rate_limiter() -> RateLimiter:
+    if payment_settings.rate_limit_backend == "sqlite":
+        return SqliteRateLimiter(payment_settings.rate_limit_store_path, payment_settings.rate_limit_sweep_interval)
+    return MemoryRateLimiter(payment_settings.rate_limit_sweep_interval)
@@ -1,17 +1,98 @@
 import uuid
+from collections.abc import AsyncIterator
 
-from payment_gateway_api.models import PaymentResponse
+from payment_gateway_api.caches import ResponseCache, EncodedPayment, encode_payment
+from payment_gateway_api.metrics import registry
+from payment_gateway_api.models import PaymentResponse, PaymentStatus
+from payment_gateway_api.settings import payment_settings
+from payment_gateway_api.stores import PaymentStore, MemoryPaymentStore, JournaledPaymentStore, \
+    SqlitePaymentStore, PaymentFilter, PaymentCursor
 
 
 class PaymentRepository:
-    def __init__(self):
-        self._data = dict[uuid.UUID, PaymentResponse]()
+    # only final payments are cached, a PENDING one is completed later and maybe by another worker
+    # sharing the store, so it is always read from the store. A cached payment is not served
+    # once the store expired or evicted it.
+    def __init__(self, store: PaymentStore, cache: ResponseCache | None = None):
+        self._store = store
+        self._cache = cache
+        if cache is not None:
+            store.on_evict(cache.discard)
 
-    def add(self, payment: PaymentResponse) -> None:
-        self._data[payment.id] = payment
+    @property
+    def store(self) -> PaymentStore:
+        return self._store
 
-    def get(self, payment_id: uuid.UUID) -> PaymentResponse:
-        return self._data.get(payment_id, None)
+    def __len__(self) -> int:
+        return len(self._store)
 
+    async def add(self, payment: PaymentResponse, merchant_id: str | None = None) -> None:
+        await self._store.add(payment, merchant_id)
+        self._cache_payment(payment, merchant_id)
 
-repo = PaymentRepository()
+    async def update(self, payment: PaymentResponse, merchant_id: str | None = None) -> None:
+        await self._store.update(payment, merchant_id)
+        self._cache_payment(payment, merchant_id)
+
+    async def get(self, payment_id: uuid.UUID, merchant_id: str | None = None) -> PaymentResponse | None:
+        return await self._store.get(payment_id, merchant_id)
+
+    async def get_encoded(self, payment_id: uuid.UUID, merchant_id: str | None = None) -> EncodedPayment | None:
+        if self._cache is not None:
+            encoded = self._cache.get(payment_id, merchant_id)
+            if encoded is not None:
+                return encoded
+        payment = await self._store.get(payment_id, merchant_id)
+        if payment is None:
+            return None
+        encoded = encode_payment(payment)
+        if self._cache is not None and payment.status != PaymentStatus.PENDING:
+            self._cache.put(payment_id, encoded, merchant_id, self._store.expires_at(payment_id))
+        return encoded
+
+    def _cache_payment(self, payment: PaymentResponse, merchant_id: str | None) -> None:
+        if self._cache is not None and payment.status != PaymentStatus.PENDING:
+            self._cache.put(payment.id, encode_payment(payment), merchant_id, self._store.expires_at(payment.id))
+
+    async def scan(self, payment_filter: PaymentFilter, after: PaymentCursor | None, limit: int) \
+            -> list[tuple[float, PaymentResponse]]:
+        return await self._store.scan(payment_filter, after, limit)
+
+    async def iterate(self, payment_filter: PaymentFilter, page_size: int) \
+            -> AsyncIterator[tuple[float, PaymentResponse]]:
+        # page by page from the store, at most one page is held in memory whatever the row count
+        after = None
+        while True:
+            page = await self._store.scan(payment_filter, after, page_size)
+            for item in page:
+                yield item
+            if len(page) < page_size:
+                return
+            created_at, payment = page[-1]
+            after = PaymentCursor(created_at, payment.id)
+
+    async def open(self) -> None:
+        await self._store.open()
+
+    async def close(self) -> None:
+        await self._store.close()
+
+
+def create_payment_store() -> PaymentStore:
+    if payment_settings.payment_store == "sqlite":
+        return SqlitePaymentStore(payment_settings.payment_store_path, payment_settings.payment_store_batch_size)
+    if payment_settings.payment_store == "journal":
+        return JournaledPaymentStore(payment_settings.payment_max_entries, payment_settings.payment_ttl,
+                                     payment_settings.payment_journal_path, payment_settings.payment_journal_segment_size,
+                                     payment_settings.payment_journal_compact_segments)
+    return MemoryPaymentStore(payment_settings.payment_max_entries, payment_settings.payment_ttl)
+
+
+def create_response_cache() -> ResponseCache | None:
+    if payment_settings.payment_cache_max_entries <= 0:
+        return None
+    return ResponseCache(payment_settings.payment_cache_max_entries)
+
+
+repo = PaymentRepository(create_payment_store(), create_response_cache())
+registry.gauge("payment_repository_size", "Payments held by the payment store.", lambda: len(repo))
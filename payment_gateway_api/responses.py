@@ -0,0 +1,81 @@
+import csv
+import io
+from collections.abc import AsyncIterator, Mapping
+
+from pydantic import BaseModel
+from starlette.responses import Response
+
+from payment_gateway_api.caches import EncodedPayment
+from payment_gateway_api.models import ErrorResponse, PaymentListItem
+
+CSV_COLUMNS = ("id", "status", "card_last4", "expiry_month", "expiry_year", "currency", "amount", "created_at")
+
+# the fixed messages of server errors and rejections, encoded once instead of on every failed request
+_PREBUILT_MESSAGES = (
+    "Internal server error",
+    "Downstream bank server is unavailable, please retry later.",
+    "Request error when calling downstream bank.",
+    "Too many requests in progress, please retry later.",
+    "Missing or unknown API key.",
+    "Rate limit exceeded, please retry later.",
+)
+
+
+def _encode_error(message: str) -> bytes:
+    return ErrorResponse.__pydantic_serializer__.to_json(ErrorResponse(message=message))
+
+
+_ERROR_BODIES = {message: _encode_error(message) for message in _PREBUILT_MESSAGES}
+
+
+class ModelResponse(Response):
+    # serialized by pydantic-core straight to bytes, the same compact JSON as JSONResponse
+    # without FastAPI validating the model again and going through a dict and json.dumps
+    media_type = "application/json"
+
+    def render(self, content: BaseModel) -> bytes:
+        return content.__pydantic_serializer__.to_json(content)
+
+
+def error_response(status_code: int, message: str, headers: Mapping[str, str] | None = None) -> Response:
+    body = _ERROR_BODIES.get(message)
+    if body is None:
+        body = _encode_error(message)
+    return Response(body, status_code=status_code, headers=headers, media_type="application/json")
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # weak comparison as If-None-Match requires, W/"x" matches "x"
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def encoded_payment_response(encoded: EncodedPayment, if_none_match: str | None = None) -> Response:
+    headers = {"ETag": encoded.etag}
+    if etag_matches(if_none_match, encoded.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(encoded.body, headers=headers, media_type="application/json")
+
+
+async def ndjson_rows(items: AsyncIterator[PaymentListItem]) -> AsyncIterator[bytes]:
+    async for item in items:
+        yield item.__pydantic_serializer__.to_json(item) + b"\n"
+
+
+async def csv_rows(items: AsyncIterator[PaymentListItem]) -> AsyncIterator[bytes]:
+    # one reused buffer, a row is written, taken and the buffer emptied again
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(CSV_COLUMNS)
+    async for item in items:
+        writer.writerow((item.id, item.status.name, item.card_last4, item.expiry_month, item.expiry_year,
+                         item.currency, item.amount, item.created_at.isoformat()))
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # the header of an empty export
+        yield buffer.getvalue().encode()
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import random
+from collections.abc import Awaitable, Callable
+
+from payment_gateway_api.exceptions import BankServerError, BankConnectionError, BankCircuitOpenError
+from payment_gateway_api.metrics import registry
+from payment_gateway_api.settings import payment_settings
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_ERRORS = (BankServerError, BankConnectionError)
+
+attempts_total = registry.counter("bank_attempts_total", "Bank calls including retries.")
+retries_total = registry.counter("bank_retries_total", "Bank calls that were retries.")
+retry_budget_exhausted_total = registry.counter(
+    "bank_retry_budget_exhausted_total", "Retries skipped because the retry budget was empty.")
+retry_deadline_exceeded_total = registry.counter(
+    "bank_retry_deadline_exceeded_total", "Payments that ran out of time across all attempts.")
+retry_backoff_seconds_total = registry.counter(
+    "bank_retry_backoff_seconds_total", "Time spent sleeping between bank attempts.")
+
+
+class RetryBudget:
+    # token bucket - every payment deposits `ratio` tokens and every retry takes one,
+    # so retries stay a bounded share of the traffic during a bank brown-out
+    def __init__(self, ratio: float, capacity: float):
+        self._ratio = ratio
+        self._capacity = capacity
+        self._tokens = capacity
+
+    @property
+    def tokens(self) -> float:
+        return self._tokens
+
+    def deposit(self) -> None:
+        self._tokens = min(self._capacity, self._tokens + self._ratio)
+
+    def try_withdraw(self) -> bool:
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class RetryPolicy:
+    def __init__(self, max_retries: int, base_delay: float, max_delay: float, deadline: float,
+                 budget: RetryBudget):
+        self._max_retries = max_retries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._deadline = deadline
+        self._budget = budget
+
+    def backoff(self, retry: int) -> float:
+        # full jitter: uniform between 0 and the capped exponential delay
+        return random.uniform(0, min(self._max_delay, self._base_delay * 2 ** retry))
+
+    async def call[T](self, attempt: Callable[[float], Awaitable[T]]) -> T:
+        # attempt is given the loop time it has to be done by and raises TimeoutError past it, the
+        # deadline is enforced inside the circuit breaker so it is not seen as a cancellation
+        self._budget.deposit()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._deadline
+        retry = 0
+        while True:
+            attempts_total.inc()
+            try:
+                return await attempt(deadline)
+            except TimeoutError:
+                retry_deadline_exceeded_total.inc()
+                logger.error("Bank call exceeded the %.1fs deadline after %d attempts", self._deadline, retry + 1)
+                raise BankServerError("Downstream bank server is unavailable, please retry later.")
+            except BankCircuitOpenError:
+                # fail fast, the breaker decides when the bank is worth calling again
+                raise
+            except RETRYABLE_ERRORS:
+                if retry >= self._max_retries:
+                    raise
+                delay = self.backoff(retry)
+                if loop.time() + delay >= deadline:
+                    retry_deadline_exceeded_total.inc()
+                    raise
+                if not self._budget.try_withdraw():
+                    retry_budget_exhausted_total.inc()
+                    logger.warning("Retry budget exhausted, not retrying the bank call")
+                    raise
+                retry += 1
+                retries_total.inc()
+                retry_backoff_seconds_total.inc(delay)
+                logger.warning("Retrying bank call in %.3fs, retry %d of %d", delay, retry, self._max_retries)
+                await asyncio.sleep(delay)
+
+
+def create_retry_policy() -> RetryPolicy:
+    budget = RetryBudget(payment_settings.bank_retry_budget_ratio, payment_settings.bank_retry_budget_capacity)
+    return RetryPolicy(
+        max_retries=payment_settings.bank_retry,
+        base_delay=payment_settings.bank_retry_delay,
+        max_delay=payment_settings.bank_retry_max_delay,
+        deadline=payment_settings.bank_retry_deadline,
+        budget=budget,
+    )
@@ -1,25 +1,185 @@
+import asyncio
+import hashlib
+import logging
 import uuid
+from collections.abc import AsyncIterator, Awaitable
+from datetime import datetime, UTC
 
+from payment_gateway_api.acquirers import AcquirerRouter
+from payment_gateway_api.caches import EncodedPayment
 from payment_gateway_api.clients import BankClient
-from payment_gateway_api.exceptions import PaymentNotFoundError
+from payment_gateway_api.exceptions import PaymentNotFoundError, PaymentServerError, BankServerError, \
+    BusinessValidationError, OverloadedError
+from payment_gateway_api.idempotency import IdempotencyCache
+from payment_gateway_api.limiters import ConcurrencyLimiter
 from payment_gateway_api.mappers import map_to_bank_request, map_to_payment_response
-from payment_gateway_api.models import PaymentRequest, PaymentResponse, PaymentStatus
+from payment_gateway_api.models import PaymentRequest, PaymentResponse, PaymentStatus, PaymentListItem, \
+    PaymentPage
 from payment_gateway_api.repositories import repo
+from payment_gateway_api.stores import PaymentFilter, PaymentCursor
+from payment_gateway_api.tracing import tracer
+from payment_gateway_api.webhooks import WebhookDispatcher
+from payment_gateway_api.workers import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+
+def _fingerprint(payment: PaymentRequest, respond_async: bool) -> bytes:
+    # the mode is part of it, a key first used async and retried sync would replay the PENDING
+    # payment as created
+    mode = b"async:" if respond_async else b"sync:"
+    return hashlib.sha256(mode + payment.model_dump_json().encode()).digest()
+
+
+def to_list_item(created_at: float, payment: PaymentResponse) -> PaymentListItem:
+    return PaymentListItem(**payment.__dict__, created_at=datetime.fromtimestamp(created_at, UTC))
 
 
 class PaymentService:
-    def __init__(self, client: BankClient) -> None:
+    # the client is a single bank or the router over all the configured acquirers, async
+    # payments are completed by the worker pool. Every stored result is sent to the merchant's
+    # webhook, if it has one.
+    def __init__(self, client: BankClient | AcquirerRouter, idempotency_cache: IdempotencyCache | None = None,
+                 worker_pool: WorkerPool | None = None, webhooks: WebhookDispatcher | None = None) -> None:
         self.client = client
+        self.idempotency_cache = idempotency_cache
+        self.worker_pool = worker_pool
+        self.webhooks = webhooks
+
+    async def process_payment(self, payment: PaymentRequest, idempotency_key: str | None = None,
+                              merchant_id: str | None = None) -> PaymentResponse:
+        if idempotency_key is None or self.idempotency_cache is None:
+            return await self._process_payment(payment, merchant_id)
+        fingerprint = _fingerprint(payment, respond_async=False)
+        return await self.idempotency_cache.run(idempotency_key, fingerprint,
+                                                lambda: self._process_payment(payment, merchant_id), merchant_id)
 
-    async def process_payment(self, payment: PaymentRequest) -> PaymentResponse:
-        bank_response = await self.client.process_payment(map_to_bank_request(payment))
-        status = PaymentStatus.AUTHORIZED if bank_response.authorized else PaymentStatus.DECLINED
+    async def _process_payment(self, payment: PaymentRequest, merchant_id: str | None = None) -> PaymentResponse:
+        status = await self._authorize(payment)
         result = map_to_payment_response(uuid.uuid4(), status, payment)
-        repo.add(result)
+        with tracer.span("store") as span:
+            span.set_attribute("payment.id", str(result.id))
+            await repo.add(result, merchant_id)
+        self._notify(merchant_id, result)
+        return result
+
+    def _notify(self, merchant_id: str | None, result: PaymentResponse) -> None:
+        # queued, the response does not wait for the webhook
+        if self.webhooks is not None:
+            self.webhooks.notify(merchant_id, result)
+
+    async def _authorize(self, payment: PaymentRequest) -> PaymentStatus:
+        with tracer.span("map"):
+            bank_request = map_to_bank_request(payment)
+        with tracer.span("bank") as span:
+            span.set_attribute("payment.currency", payment.currency)
+            bank_response = await self.client.process_payment(bank_request)
+            span.set_attribute("payment.authorized", bank_response.authorized)
+        return PaymentStatus.AUTHORIZED if bank_response.authorized else PaymentStatus.DECLINED
+
+    async def accept_payment(self, payment: PaymentRequest, idempotency_key: str | None = None,
+                             merchant_id: str | None = None) -> PaymentResponse:
+        # stored as PENDING and queued, the bank is called by a worker after the caller got its answer
+        if idempotency_key is None or self.idempotency_cache is None:
+            return await self._accept_payment(payment, merchant_id)
+        accepted = False
+
+        def accept() -> Awaitable[PaymentResponse]:
+            nonlocal accepted
+            accepted = True
+            return self._accept_payment(payment, merchant_id)
+
+        result = await self.idempotency_cache.run(idempotency_key, _fingerprint(payment, respond_async=True),
+                                                  accept, merchant_id)
+        if accepted:
+            return result
+        # a replay, the payment may have been completed since it was accepted
+        return await repo.get(result.id, merchant_id) or result
+
+    async def _accept_payment(self, payment: PaymentRequest, merchant_id: str | None) -> PaymentResponse:
+        # the queue slot is taken first, a full queue rejects the payment before anything is stored
+        self.worker_pool.reserve()
+        pending = map_to_payment_response(uuid.uuid4(), PaymentStatus.PENDING, payment)
+        try:
+            with tracer.span("store") as span:
+                span.set_attribute("payment.id", str(pending.id))
+                await repo.add(pending, merchant_id)
+        except BaseException:
+            self.worker_pool.release()
+            raise
+        self.worker_pool.submit(lambda: self._complete_payment(pending, payment, merchant_id))
+        return pending
+
+    async def _complete_payment(self, pending: PaymentResponse, payment: PaymentRequest,
+                                merchant_id: str | None) -> None:
+        try:
+            status = await self._authorize(payment)
+        except (PaymentServerError, BankServerError) as e:
+            logger.error("Async payment %s failed: %s", pending.id, str(e))
+            status = PaymentStatus.FAILED
+        except Exception:
+            # any other error still completes the payment, it would otherwise stay PENDING for good
+            logger.exception("Async payment %s failed", pending.id)
+            status = PaymentStatus.FAILED
+        result = pending.model_copy(update={"status": status})
+        await repo.update(result, merchant_id)
+        self._notify(merchant_id, result)
+
+    async def process_payments(self, payments: list[tuple[int, PaymentRequest]], concurrency: int,
+                               merchant_id: str | None = None, limiter: ConcurrencyLimiter | None = None) \
+            -> AsyncIterator[tuple[int, PaymentResponse | Exception]]:
+        # results are yielded as they complete, not in the submitted order. Each payment takes the
+        # limiter like a single payment does, one refused by it is answered with the OverloadedError.
+        semaphore = asyncio.Semaphore(concurrency)
+        stopped = False
+
+        async def process(index: int, payment: PaymentRequest) -> tuple[int, PaymentResponse | Exception] | None:
+            async with semaphore:
+                if stopped:
+                    return None
+                try:
+                    if limiter is None:
+                        return index, await self._process_payment(payment, merchant_id)
+                    async with limiter.acquire():
+                        return index, await self._process_payment(payment, merchant_id)
+                except (PaymentServerError, BankServerError, OverloadedError) as e:
+                    return index, e
+
+        tasks = [asyncio.create_task(process(index, payment)) for index, payment in payments]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            # the caller went away, payments already at the bank complete and are stored,
+            # the ones still waiting for the semaphore are not started
+            stopped = True
+
+    # with a merchant, the payments of other merchants are not found
+    async def get_payment(self, payment_id: uuid.UUID, merchant_id: str | None = None) -> PaymentResponse:
+        result = await repo.get(payment_id, merchant_id)
+        if result is None:
+            raise PaymentNotFoundError(f'Payment with id {payment_id} not found')
         return result
 
-    def get_payment(self, payment_id: uuid.UUID) -> PaymentResponse:
-        result = repo.get(payment_id)
+    async def get_encoded_payment(self, payment_id: uuid.UUID, merchant_id: str | None = None) -> EncodedPayment:
+        result = await repo.get_encoded(payment_id, merchant_id)
         if result is None:
             raise PaymentNotFoundError(f'Payment with id {payment_id} not found')
         return result
+
+    async def list_payments(self, payment_filter: PaymentFilter, cursor: str | None, limit: int) -> PaymentPage:
+        try:
+            after = PaymentCursor.decode(cursor) if cursor is not None else None
+        except ValueError:
+            raise BusinessValidationError("cursor is invalid.")
+        page = await repo.scan(payment_filter, after, limit)
+        next_cursor = None
+        if len(page) == limit:
+            created_at, payment = page[-1]
+            next_cursor = PaymentCursor(created_at, payment.id).encode()
+        return PaymentPage(items=[to_list_item(created_at, payment) for created_at, payment in page],
+                           next_cursor=next_cursor)
+
+    async def export_payments(self, payment_filter: PaymentFilter, page_size: int) -> AsyncIterator[PaymentListItem]:
+        async for created_at, payment in repo.iterate(payment_filter, page_size):
+            yield to_list_item(created_at, payment)
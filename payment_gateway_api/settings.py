@@ -1,13 +1,164 @@
+from typing import Literal
+
+from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
+class AcquirerSettings(BaseModel):
+    name: str
+    url: str
+    # empty means every supported currency
+    currencies: list[str] = []
+    weight: float = 1.0
+
+
+class ApiKeySettings(BaseModel):
+    key: str
+    merchant_id: str
+    # requests per second and the burst allowed above it, the rate_limit defaults when missing
+    rate: float | None = Field(default=None, gt=0)
+    burst: int | None = Field(default=None, gt=0)
+
+
 class PaymentSettings(BaseSettings):
     bank_url: str = "http://localhost:8080"
+    # several banks as a JSON list of {"name", "url", "currencies", "weight"}, empty means the single bank_url
+    bank_acquirers: list[AcquirerSettings] = []
+    # smoothing of the per acquirer latency and error rate, a higher alpha follows changes faster
+    bank_routing_ewma_alpha: float = 0.2
     bank_timeout: int = 10
-    # not implemented
+    # connection pool of the shared bank http client
+    bank_max_connections: int = 100
+    bank_max_keepalive_connections: int = 20
+    bank_keepalive_expiry: float = 5.0
+    # requires the h2 package (httpx[http2])
+    bank_http2: bool = False
+    # retries on bank 5xx and transport errors, exponential backoff with full jitter
     bank_retry: int = 3
-    # not implemented
-    bank_retry_delay: int = 5
+    bank_retry_delay: float = 0.1
+    bank_retry_max_delay: float = 2.0
+    # caps the total time of all attempts of one payment
+    bank_retry_deadline: float = 15.0
+    # token bucket shared by all payments, each payment deposits the ratio and each retry costs one token
+    bank_retry_budget_ratio: float = 0.2
+    bank_retry_budget_capacity: float = 10.0
+    # micro-batching, concurrent bank calls are sent as one POST /payments/batch once max size
+    # payments are queued or window seconds after the first one, a wider window trades latency for throughput
+    bank_batch_enabled: bool = False
+    bank_batch_max_size: int = 50
+    bank_batch_window: float = 0.005
+    # hedging, a bank call slower than the percentile of the latest window latencies gets a second
+    # attempt, the first answer wins. Each call deposits the ratio into a bucket and each hedge takes one token
+    bank_hedge_enabled: bool = False
+    bank_hedge_percentile: float = 0.95
+    bank_hedge_window: int = 1000
+    bank_hedge_min_samples: int = 100
+    bank_hedge_ratio: float = 0.05
+    bank_hedge_capacity: float = 10.0
+    # circuit breaker over a sliding window of the latest bank calls
+    bank_breaker_window_size: int = 20
+    bank_breaker_minimum_calls: int = 10
+    bank_breaker_failure_rate: float = 0.5
+    bank_breaker_slow_call_rate: float = 0.8
+    bank_breaker_slow_call_duration: float = 5.0
+    bank_breaker_open_duration: float = 30.0
+    bank_breaker_half_open_calls: int = 3
+    # POST /payments/batch, max payments per batch and max concurrent bank calls per batch
+    payment_batch_max_items: int = 10_000
+    payment_batch_concurrency: int = 20
+    # completed Idempotency-Key results are replayed for the ttl, bounded by max keys
+    idempotency_ttl: float = 86400.0
+    idempotency_max_keys: int = 100_000
+    # adaptive limit of concurrent POST /payments, grows while the latency stays within tolerance times
+    # its baseline and shrinks above it or on bank errors. Up to queue size more wait queue timeout seconds
+    payment_concurrency_initial_limit: int = 50
+    payment_concurrency_min_limit: int = 10
+    payment_concurrency_max_limit: int = 1000
+    payment_concurrency_queue_size: int = 100
+    payment_concurrency_queue_timeout: float = 1.0
+    payment_concurrency_tolerance: float = 2.0
+    payment_concurrency_smoothing: float = 0.2
+    # fixed separate limit of concurrent GET /payments/{id}
+    payment_lookup_concurrency: int = 500
+    payment_lookup_queue_size: int = 500
+    # Retry-After seconds of a request rejected by a full limiter
+    overload_retry_after: int = 1
+    # memory is per worker, journal is the memory store replayed from a write-ahead journal on startup,
+    # sqlite is a file shared by all the workers on the host
+    payment_store: Literal["memory", "journal", "sqlite"] = "memory"
+    payment_store_path: str = "payments.db"
+    # max payments committed in one sqlite transaction
+    payment_store_batch_size: int = 500
+    # directory of the journal segments, a segment is rotated beyond segment size bytes and the sealed
+    # ones are compacted into one once there are compact segments of them
+    payment_journal_path: str = "journal"
+    payment_journal_segment_size: int = 64 * 1024 * 1024
+    payment_journal_compact_segments: int = 4
+    # in memory payments, least recently used are evicted beyond max entries, older than ttl seconds are dropped
+    payment_max_entries: int = 1_000_000
+    payment_ttl: float = 7 * 86400.0
+    # encoded responses of the most recently written or read payments in front of the store, 0 disables
+    payment_cache_max_entries: int = 10_000
+    # GET /payments page size limit, and the store page size behind the streaming export
+    payment_list_max_limit: int = 500
+    payment_export_page_size: int = 1000
+    # Prefer: respond-async payments, queued up to queue size and sent to the bank by the workers,
+    # the queue has drain timeout seconds to empty on shutdown
+    payment_async_workers: int = 50
+    payment_async_queue_size: int = 10_000
+    payment_async_drain_timeout: float = 10.0
+    # merchant webhooks, off by default, nothing is polled and no store file is created without them
+    webhooks_enabled: bool = False
+    # merchant webhooks and their queue of payment results to deliver, a sqlite file shared by the workers.
+    # A POST carries up to batch max size results, at most destination concurrency POSTs go to a merchant
+    # at once, a failed one is retried with backoff up to max attempts. Retries falling due and the
+    # registrations made on other workers are picked up every poll interval seconds
+    webhook_store_path: str = "webhooks.db"
+    webhook_timeout: float = 5.0
+    webhook_max_connections: int = 100
+    webhook_batch_max_size: int = 100
+    webhook_destination_concurrency: int = 4
+    webhook_max_attempts: int = 10
+    webhook_retry_delay: float = 1.0
+    webhook_retry_max_delay: float = 300.0
+    webhook_poll_interval: float = 1.0
+    # without API keys the webhook routes trust the Merchant-Id header, so anyone could redirect any
+    # merchant's results, only for local testing
+    webhook_merchant_id_header: bool = False
+    # lets webhooks reach loopback, link-local and private addresses, only for a local receiver
+    webhook_allow_private_addresses: bool = False
+    # API keys as a JSON list of {"key", "merchant_id", "rate", "burst"} sent in X-API-Key, each key is the
+    # merchant it stands for. Empty leaves /api open and the merchant is taken from the Merchant-Id header
+    api_keys: list[ApiKeySettings] = []
+    # a key may send burst requests at once, refilled at rate per second (GCRA). memory is per worker,
+    # sqlite is a file shared by all the workers on the host. Keys idle until their burst is refilled
+    # are dropped from the table every sweep interval seconds
+    rate_limit_rate: float = 50.0
+    rate_limit_burst: int = 100
+    rate_limit_backend: Literal["memory", "sqlite"] = "memory"
+    rate_limit_store_path: str = "ratelimits.db"
+    rate_limit_sweep_interval: float = 60.0
+    # gunicorn.conf.py production server, 0 workers means one per CPU
+    server_bind: str = "0.0.0.0:8000"
+    server_workers: int = 0
+    # seconds a stopping or reloaded worker has to finish its in flight requests
+    server_graceful_timeout: int = 30
+    server_keepalive: int = 5
+    server_log_level: str = "info"
+    # level of the development server in main.py, gunicorn uses server_log_level
+    log_level: str = "debug"
+    log_format: Literal["json", "text"] = "json"
+    # records are written by a background thread from a queue of this size, a full queue drops
+    # records instead of blocking requests, 0 writes them on the event loop
+    log_queue_size: int = 10_000
+    # share of requests whose debug lines are kept, info and above are always kept
+    log_debug_sample_rate: float = 0.1
+    # share of requests traced when the caller sent no traceparent, a caller's sampled flag is followed
+    trace_sample_rate: float = 0.01
+    # spans of sampled requests, kept in memory or appended to a JSON lines file by a background thread
+    trace_exporter: Literal["none", "memory", "file"] = "memory"
+    trace_memory_max_spans: int = 10_000
+    trace_file_path: str = "traces.jsonl"
 
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -0,0 +1,558 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import logging
+import math
+import sqlite3
+import struct
+import time
+import uuid
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from payment_gateway_api.exceptions import PaymentServerError
+from payment_gateway_api.journals import PaymentJournal
+from payment_gateway_api.metrics import registry
+from payment_gateway_api.models import PaymentResponse, PaymentStatus
+
+logger = logging.getLogger(__name__)
+
+journal_commit_duration = registry.histogram("payment_journal_commit_seconds",
+                                             "Time to append and fsync a group of payments to the journal.")
+journal_records_total = registry.counter("payment_journal_records_total", "Payments appended to the journal.")
+
+# payments are keyed by the 16 bytes of their uuid
+_KEY_SIZE = 16
+# status, card_last4, expiry_month, expiry_year, currency, amount, owner, created_at
+_RECORD = struct.Struct("<B4s2s4s3sq16sd")
+_CREATED_AT = struct.Struct("<d")
+_CREATED_AT_OFFSET = _RECORD.size - _CREATED_AT.size
+_OWNER_OFFSET = _CREATED_AT_OFFSET - 16
+# the created_at of each of a run of records
+_RECORD_CREATED_AT = struct.Struct(f"<{_CREATED_AT_OFFSET}xd")
+
+
+def _owner(merchant_id: str | None) -> bytes:
+    # the merchant a payment belongs to as a fixed size digest, zeros for a payment without one
+    if merchant_id is None:
+        return bytes(16)
+    return hashlib.blake2b(merchant_id.encode(), digest_size=16).digest()
+
+
+def _pack(payment: PaymentResponse, owner: bytes, created_at: float) -> bytes:
+    return _RECORD.pack(
+        payment.status.value,
+        payment.card_last4.encode(),
+        payment.expiry_month.encode(),
+        payment.expiry_year.encode(),
+        payment.currency.encode(),
+        payment.amount,
+        owner,
+        created_at,
+    )
+
+
+def _unpack(key: bytes, record: bytes) -> PaymentResponse:
+    status, card_last4, expiry_month, expiry_year, currency, amount, _, _ = _RECORD.unpack(record)
+    return PaymentResponse(
+        id=uuid.UUID(bytes=key),
+        status=PaymentStatus(status),
+        card_last4=card_last4.decode(),
+        expiry_month=expiry_month.rstrip(b"\0").decode(),
+        expiry_year=expiry_year.decode(),
+        currency=currency.decode(),
+        amount=amount,
+    )
+
+
+def _created_at(record: bytes) -> float:
+    return _CREATED_AT.unpack_from(record, _CREATED_AT_OFFSET)[0]
+
+
+def _record_owner(record: bytes) -> bytes:
+    return record[_OWNER_OFFSET:_CREATED_AT_OFFSET]
+
+
+class PaymentFilter(NamedTuple):
+    # only the payments of this merchant, all of them without
+    merchant_id: str | None = None
+    status: PaymentStatus | None = None
+    currency: str | None = None
+    # creation time range in epoch seconds, from inclusive and to exclusive
+    created_from: float | None = None
+    created_to: float | None = None
+
+
+class PaymentCursor(NamedTuple):
+    # the position of the last listed payment, payments are listed by creation time then id
+    created_at: float
+    id: uuid.UUID
+
+    _TOKEN = struct.Struct("<d16s")
+
+    def encode(self) -> str:
+        return base64.urlsafe_b64encode(self._TOKEN.pack(self.created_at, self.id.bytes)).decode()
+
+    @classmethod
+    def decode(cls, token: str) -> "PaymentCursor":
+        try:
+            created_at, key = cls._TOKEN.unpack(base64.urlsafe_b64decode(token))
+        except (binascii.Error, struct.error, ValueError):
+            raise ValueError(f"invalid cursor {token!r}")
+        return cls(created_at, uuid.UUID(bytes=key))
+
+
+class PaymentStore(ABC):
+    # a payment belongs to the merchant it was added for, a get or scan for a merchant does not
+    # see the payments of the others
+    @abstractmethod
+    async def add(self, payment: PaymentResponse, merchant_id: str | None = None) -> None:
+        pass
+
+    @abstractmethod
+    async def update(self, payment: PaymentResponse, merchant_id: str | None = None) -> None:
+        # a new status for a stored payment, it keeps its creation time and merchant
+        pass
+
+    @abstractmethod
+    async def get(self, payment_id: uuid.UUID, merchant_id: str | None = None) -> PaymentResponse | None:
+        pass
+
+    @abstractmethod
+    async def scan(self, payment_filter: PaymentFilter, after: PaymentCursor | None, limit: int) \
+            -> list[tuple[float, PaymentResponse]]:
+        # up to limit (created_at, payment) matching the filter after the cursor, oldest first
+        pass
+
+    def __len__(self) -> int:
+        return 0
+
+    def expires_at(self, payment_id: uuid.UUID) -> float:
+        # the time.time() from which a stored payment is no longer found
+        return math.inf
+
+    def on_evict(self, callback: Callable[[uuid.UUID], None]) -> None:
+        # callback is called with each payment dropped before it expires
+        pass
+
+    async def open(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryPaymentStore(PaymentStore):
+    # payments are kept as 16 byte uuid keys and struct packed rows, a PaymentResponse is
+    # only built on get. Least recently used payments are evicted beyond max_entries,
+    # and payments older than ttl are dropped.
+    def __init__(self, max_entries: int, ttl: float):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._data = OrderedDict[bytes, bytes]()
+        # creation time index for range scans, sorted by (created_at, key) in two parallel
+        # sequences. Evicted, expired and replaced payments are left in it and skipped by scans
+        # until it is compacted.
+        self._index_times = array("d")
+        self._index_keys = list[bytes]()
+        self._evicted: Callable[[uuid.UUID], None] | None = None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def expires_at(self, payment_id: uuid.UUID) -> float:
+        record = self._data.get(payment_id.bytes, None)
+        return _created_at(record) + self._ttl if record is not None else 0.0
+
+    def on_evict(self, callback: Callable[[uuid.UUID], None]) -> None:
+        self._evicted = callback
+
+    async def add(self, payment: PaymentResponse, merchant_id: str | None = None) -> None:
+        await self._put(payment.id.bytes, _pack(payment, _owner(merchant_id), time.time()))
+
+    async def update(self, payment: PaymentResponse, merchant_id: str | None = None) -> None:
+        key = payment.id.bytes
+        record = self._data.get(key, None)
+        # a payment evicted in the meantime is added again
+        if record is None:
+            await self.add(payment, merchant_id)
+            return
+        await self._put(key, _pack(payment, _record_owner(record), _created_at(record)))
+
+    async def _put(self, key: bytes, record: bytes) -> None:
+        self._set(key, record)
+
+    def _set(self, key: bytes, record: bytes) -> None:
+        created_at = _created_at(record)
+        previous = self._data.get(key, None)
+        self._data[key] = record
+        self._data.move_to_end(key)
+        self._evict(time.time())
+        if previous is None or _created_at(previous) != created_at:
+            self._add_to_index(created_at, key)
+
+    def _load(self, records: dict[bytes, bytes]) -> None:
+        # replaces the payments with records, least recently used first by creation time. The
+        # expired ones are dropped and only the newest max entries kept.
+        keys = list(records)
+        values = list(records.values())
+        times = [created_at for created_at, in _RECORD_CREATED_AT.iter_unpack(b"".join(values))]
+        # records come mostly in creation order already, so the sort is about one pass
+        order = sorted(range(len(times)), key=times.__getitem__)
+        start = max(bisect_right(order, time.time() - self._ttl, key=times.__getitem__),
+                    len(order) - self._max_entries)
+        del order[:start]
+        self._index_keys = list(map(keys.__getitem__, order))
+        self._index_times = array("d", map(times.__getitem__, order))
+        self._data = OrderedDict(zip(self._index_keys, map(values.__getitem__, order)))
+
+    async def scan(self, payment_filter: PaymentFilter, after: PaymentCursor | None, limit: int) \
+            -> list[tuple[float, PaymentResponse]]:
+        times, keys = self._index_times, self._index_keys
+        start = bisect_right(times, time.time() - self._ttl)
+        if payment_filter.created_from is not None:
+            start = max(start, bisect_left(times, payment_filter.created_from))
+        if after is not None:
+            start = max(start, self._position(after.created_at, after.id.bytes))
+        owner = _owner(payment_filter.merchant_id) if payment_filter.merchant_id is not None else None
+        status = payment_filter.status.value if payment_filter.status is not None else None
+        currency = payment_filter.currency.encode() if payment_filter.currency is not None else None
+        created_to = payment_filter.created_to
+
+        payments = []
+        for i in range(start, len(times)):
+            created_at = times[i]
+            if created_to is not None and created_at >= created_to:
+                break
+            key = keys[i]
+            record = self._data.get(key, None)
+            if record is None or _created_at(record) != created_at:
+                continue
+            # owner, status and currency are read from the packed record, only the matches are unpacked
+            if owner is not None and _record_owner(record) != owner:
+                continue
+            if status is not None and record[0] != status:
+                continue
+            if currency is not None and _RECORD.unpack(record)[4] != currency:
+                continue
+            # a scan does not refresh the LRU order, an export would flush the hot payments
+            payments.append((created_at, _unpack(key, record)))
+            if len(payments) == limit:
+                break
+        return payments
+
+    def _position(self, created_at: float, key: bytes) -> int:
+        # the index of the first entry after (created_at, key)
+        times, keys = self._index_times, self._index_keys
+        i = bisect_right(times, created_at)
+        while i > 0 and times[i - 1] == created_at and keys[i - 1] > key:
+            i -= 1
+        return i
+
+    def _add_to_index(self, created_at: float, key: bytes) -> None:
+        if len(self._index_keys) >= 2 * len(self._data) + 1024:
+            self._compact_index()
+        # the clock rarely goes backwards, a new payment is almost always appended at the end
+        i = self._position(created_at, key)
+        self._index_times.insert(i, created_at)
+        self._index_keys.insert(i, key)
+
+    def _compact_index(self) -> None:
+        times, keys = array("d"), list[bytes]()
+        for created_at, key in zip(self._index_times, self._index_keys):
+            record = self._data.get(key, None)
+            if record is not None and _created_at(record) == created_at:
+                times.append(created_at)
+                keys.append(key)
+        self._index_times, self._index_keys = times, keys
+
+    async def get(self, payment_id: uuid.UUID, merchant_id: str | None = None) -> PaymentResponse | None:
+        key = payment_id.bytes
+        record = self._data.get(key, None)
+        if record is None:
+            return None
+        if merchant_id is not None and _record_owner(record) != _owner(merchant_id):
+            return None
+        if time.time() - _created_at(record) >= self._ttl:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return _unpack(key, record)
+
+    def _evict(self, now: float) -> None:
+        while len(self._data) > self._max_entries:
+            key, _ = self._data.popitem(last=False)
+            if self._evicted is not None:
+                self._evicted(uuid.UUID(bytes=key))
+        # the least recently used payments are checked first, the rest expire on get
+        while self._data:
+            key, record = next(iter(self._data.items()))
+            if now - _created_at(record) < self._ttl:
+                return
+            del self._data[key]
+
+
+class JournaledPaymentStore(MemoryPaymentStore):
+    # the memory store behind a write-ahead journal. A payment is appended to the journal and
+    # fsynced before it is stored and acknowledged, the writes arriving while a group is being
+    # fsynced are appended together with the next one. open replays the journal, so the payments
+    # survive a restart or a crash within the ttl and max entries of the memory store.
+    def __init__(self, max_entries: int, ttl: float, path: str, segment_size: int, compact_segments: int):
+        super().__init__(max_entries, ttl)
+        self._journal = PaymentJournal(path, _KEY_SIZE, _KEY_SIZE + _RECORD.size, segment_size, compact_segments)
+        self._pending = list[tuple[bytes, bytes, asyncio.Future]]()
+        self._flush_task: asyncio.Task | None = None
+        self._compact_task: asyncio.Task | None = None
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="payment-journal-writer")
+        self._compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="payment-journal-compactor")
+
+    async def open(self) -> None:
+        start = time.perf_counter()
+        records = await asyncio.get_running_loop().run_in_executor(self._writer, self._journal.open)
+        self._load(records)
+        logger.info("Replayed %d journaled payments, %d kept, in %.3fs", len(records), len(self._data),
+                    time.perf_counter() - start)
+        self._compact()
+
+    async def _put(self, key: bytes, record: bytes) -> None:
+        # stored in memory by the flush once journaled, a caller cancelled while waiting for the
+        # fsync does not leave a journaled payment missing from memory
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((key, record, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+        await future
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._compact_task is not None:
+            await self._compact_task
+        await asyncio.get_running_loop().run_in_executor(self._writer, self._journal.close)
+
+    async def _flush(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending:
+                batch = self._pending
+                self._pending = []
+                start = time.perf_counter()
+                try:
+                    rotated = await loop.run_in_executor(self._writer, self._journal.append,
+                                                         [key + record for key, record, _ in batch])
+                except OSError as e:
+                    logger.error("Failed to journal %d payments: %s", len(batch), str(e))
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(PaymentServerError("Internal server error"))
+                    continue
+                journal_commit_duration.observe(time.perf_counter() - start)
+                journal_records_total.inc(len(batch))
+                for key, record, future in batch:
+                    self._set(key, record)
+                    if not future.done():
+                        future.set_result(None)
+                if rotated:
+                    self._compact()
+        finally:
+            self._flush_task = None
+
+    def _compact(self) -> None:
+        if self._compact_task is None and self._journal.compactable:
+            self._compact_task = asyncio.create_task(self._run_compaction())
+
+    async def _run_compaction(self) -> None:
+        expires = time.time() - self._ttl
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self._compactor, self._journal.compact, lambda record: _created_at(record) > expires)
+        except OSError as e:
+            logger.error("Failed to compact the payment journal: %s", str(e))
+        finally:
+            self._compact_task = None
+
+
+class SqlitePaymentStore(PaymentStore):
+    # a WAL mode database file shared by every worker on the host. Concurrent adds are
+    # grouped and committed in one transaction (one fsync) while the previous batch is
+    # being written, every add returns once its batch is committed so the payment is
+    # readable from any worker.
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS payments (
+            id BLOB PRIMARY KEY,
+            status INTEGER NOT NULL,
+            card_last4 TEXT NOT NULL,
+            expiry_month TEXT NOT NULL,
+            expiry_year TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            merchant_id TEXT
+        ) WITHOUT ROWID
+    """
+    _INDEXES = ("CREATE INDEX IF NOT EXISTS payments_created_at ON payments (created_at, id)",
+                # a merchant's listing reads its own payments in order, not everyone's
+                "CREATE INDEX IF NOT EXISTS payments_merchant_created_at ON payments (merchant_id, created_at, id)")
+    # an update is an insert whose id exists, only its status changes
+    _INSERT = ("INSERT INTO payments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+               "ON CONFLICT (id) DO UPDATE SET status = excluded.status")
+    _SELECT = ("SELECT status, card_last4, expiry_month, expiry_year, currency, amount, merchant_id "
+               "FROM payments WHERE id = ?")
+    _SCAN = ("SELECT id, status, card_last4, expiry_month, expiry_year, currency, amount, created_at "
+             "FROM payments WHERE {} ORDER BY created_at, id LIMIT ?")
+
+    def __init__(self, path: str, batch_size: int):
+        self._path = path
+        self._batch_size = batch_size
+        self._pending = list[tuple[tuple, bool, asyncio.Future]]()
+        self._flush_task: asyncio.Task | None = None
+        # sqlite connections are used from their own thread only
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="payment-store-writer")
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="payment-store-reader")
+        self._write_connection: sqlite3.Connection | None = None
+        self._read_connection: sqlite3.Connection | None = None
+        # rows found when the writer connected plus the rows this process committed since,
+        # other workers' writes show up after a restart
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    async def add(self, payment: PaymentResponse, merchant_id: str | None = None) -> None:
+        await self._write(payment, merchant_id, True)
+
+    async def update(self, payment: PaymentResponse, merchant_id: str | None = None) -> None:
+        await self._write(payment, merchant_id, False)
+
+    async def _write(self, payment: PaymentResponse, merchant_id: str | None, new: bool) -> None:
+        row = (payment.id.bytes, payment.status.value, payment.card_last4, payment.expiry_month,
+               payment.expiry_year, payment.currency, payment.amount, time.time(), merchant_id)
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((row, new, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+        await future
+
+    async def get(self, payment_id: uuid.UUID, merchant_id: str | None = None) -> PaymentResponse | None:
+        loop = asyncio.get_running_loop()
+        row = await loop.run_in_executor(self._reader, self._select, payment_id.bytes)
+        if row is None:
+            return None
+        status, card_last4, expiry_month, expiry_year, currency, amount, owner = row
+        if merchant_id is not None and owner != merchant_id:
+            return None
+        return PaymentResponse(id=payment_id, status=PaymentStatus(status), card_last4=card_last4,
+                               expiry_month=expiry_month, expiry_year=expiry_year, currency=currency, amount=amount)
+
+    async def scan(self, payment_filter: PaymentFilter, after: PaymentCursor | None, limit: int) \
+            -> list[tuple[float, PaymentResponse]]:
+        conditions = []
+        params = []
+        if payment_filter.merchant_id is not None:
+            conditions.append("merchant_id = ?")
+            params.append(payment_filter.merchant_id)
+        if payment_filter.status is not None:
+            conditions.append("status = ?")
+            params.append(payment_filter.status.value)
+        if payment_filter.currency is not None:
+            conditions.append("currency = ?")
+            params.append(payment_filter.currency)
+        if payment_filter.created_from is not None:
+            conditions.append("created_at >= ?")
+            params.append(payment_filter.created_from)
+        if payment_filter.created_to is not None:
+            conditions.append("created_at < ?")
+            params.append(payment_filter.created_to)
+        if after is not None:
+            conditions.append("(created_at, id) > (?, ?)")
+            params.extend((after.created_at, after.id.bytes))
+        params.append(limit)
+        query = self._SCAN.format(" AND ".join(conditions) or "1")
+        loop = asyncio.get_running_loop()
+        rows = await loop.run_in_executor(self._reader, self._select_many, query, params)
+        return [(created_at, PaymentResponse(id=uuid.UUID(bytes=key), status=PaymentStatus(status),
+                                             card_last4=card_last4, expiry_month=expiry_month,
+                                             expiry_year=expiry_year, currency=currency, amount=amount))
+                for key, status, card_last4, expiry_month, expiry_year, currency, amount, created_at in rows]
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._writer, self._close_writer)
+        await loop.run_in_executor(self._reader, self._close_reader)
+
+    async def _flush(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending:
+                batch = self._pending[:self._batch_size]
+                del self._pending[:self._batch_size]
+                try:
+                    await loop.run_in_executor(self._writer, self._insert, [row for row, _, _ in batch],
+                                               sum(new for _, new, _ in batch))
+                except sqlite3.Error as e:
+                    logger.error("Failed to store %d payments: %s", len(batch), str(e))
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(PaymentServerError("Internal server error"))
+                else:
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+        finally:
+            self._flush_task = None
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=FULL")
+        connection.execute("PRAGMA busy_timeout=5000")
+        connection.execute(self._SCHEMA)
+        for index in self._INDEXES:
+            connection.execute(index)
+        return connection
+
+    def _insert(self, rows: list[tuple], new_rows: int) -> None:
+        if self._write_connection is None:
+            self._write_connection = self._connect()
+            self._size = self._write_connection.execute("SELECT count(*) FROM payments").fetchone()[0]
+        connection = self._write_connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(self._INSERT, rows)
+            connection.execute("COMMIT")
+        except BaseException:
+            # a failed COMMIT (busy, disk full) may leave the transaction open, and the next
+            # BEGIN on this shared connection would fail too
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        self._size += new_rows
+
+    def _select(self, key: bytes) -> tuple | None:
+        return self._reader_connection().execute(self._SELECT, (key,)).fetchone()
+
+    def _select_many(self, query: str, params: list) -> list[tuple]:
+        return self._reader_connection().execute(query, params).fetchall()
+
+    def _reader_connection(self) -> sqlite3.Connection:
+        if self._read_connection is None:
+            self._read_connection = self._connect()
+        return self._read_connection
+
+    def _close_writer(self) -> None:
+        if self._write_connection is not None:
+            self._write_connection.close()
+            self._write_connection = None
+
+    def _close_reader(self) -> None:
+        if self._read_connection is not None:
+            self._read_connection.close()
+            self._read_connection = None
@@ -0,0 +1,241 @@
+import json
+import queue
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any
+
+from payment_gateway_api.settings import payment_settings
+
+# version 00: 32 hex trace id, 16 hex parent span id, 2 hex flags
+_TRACEPARENT = re.compile(r"00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+_INVALID_TRACE_ID = "0" * 32
+_INVALID_SPAN_ID = "0" * 16
+
+
+class Span:
+    # a sampled span records its timing and attributes and is exported when it ends, an
+    # unsampled one only carries the ids that are propagated to the bank
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "sampled", "start", "duration", "attributes", "error",
+                 "_start_counter")
+
+    def __init__(self, name: str, trace_id: str, parent_id: str | None, sampled: bool):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.duration = 0.0
+        self.attributes = dict[str, Any]()
+        self.error: str | None = None
+        # most requests are not sampled, they skip the clocks
+        self.start = time.time() if sampled else 0.0
+        self._start_counter = time.perf_counter() if sampled else 0.0
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        if self.sampled:
+            self.attributes[key] = value
+
+    def finish(self) -> None:
+        self.duration = time.perf_counter() - self._start_counter
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+_NOT_TRACED = Span("not traced", _INVALID_TRACE_ID, None, False)
+
+
+class SpanExporter:
+    def export(self, span: Span) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class MemorySpanExporter(SpanExporter):
+    # the latest max_spans ended spans, for tests and benchmarks
+    def __init__(self, max_spans: int):
+        self.spans = deque[Span](maxlen=max_spans)
+
+    def export(self, span: Span) -> None:
+        self.spans.append(span)
+
+    def trace(self, trace_id: str) -> list[Span]:
+        return [span for span in self.spans if span.trace_id == trace_id]
+
+
+class FileSpanExporter(SpanExporter):
+    # JSON lines appended by a background thread, the event loop only enqueues the span.
+    # A full queue drops spans rather than blocking requests.
+    def __init__(self, path: str, max_queued: int = 10_000):
+        self._path = path
+        self._queue = queue.Queue[Span | None](max_queued)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="span-writer", daemon=True)
+        self._thread.start()
+
+    def export(self, span: Span) -> None:
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        with open(self._path, "a", encoding="utf-8") as file:
+            while True:
+                span = self._queue.get()
+                if span is None:
+                    return
+                file.write(json.dumps(span.to_dict(), default=str) + "\n")
+                # written out once the queue is drained, not on every span
+                if self._queue.empty():
+                    file.flush()
+
+
+def parse_traceparent(header: str | None) -> tuple[str, str, bool] | None:
+    if not header:
+        return None
+    match = _TRACEPARENT.fullmatch(header.strip().lower())
+    if match is None:
+        return None
+    trace_id, parent_id, flags = match.groups()
+    if trace_id == _INVALID_TRACE_ID or parent_id == _INVALID_SPAN_ID:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+class _SpanScope:
+    # a plain context manager class, a generator based one costs several times more per span
+    __slots__ = ("_tracer", "_span", "_token")
+
+    def __init__(self, tracer: "Tracer", span: Span):
+        self._tracer = tracer
+        self._span = span
+
+    def __enter__(self) -> Span:
+        self._token = self._tracer._current.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        span = self._span
+        self._tracer._current.reset(self._token)
+        if span.sampled:
+            span.finish()
+            if exc_type is not None:
+                span.error = exc_type.__name__
+            self._tracer.exporter.export(span)
+
+
+class _UnrecordedScope:
+    # hands back the enclosing unsampled span, nothing to set or record
+    __slots__ = ("_span",)
+
+    def __init__(self, span: Span):
+        self._span = span
+
+    def __enter__(self) -> Span:
+        return self._span
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        pass
+
+
+_NOT_TRACED_SCOPE = _UnrecordedScope(_NOT_TRACED)
+
+
+class Tracer:
+    # head sampling: the decision is taken once at the root span of a request, from the caller's
+    # traceparent flag when there is one, and every span of the request follows it
+    def __init__(self, sample_rate: float, exporter: SpanExporter | None = None):
+        self.sample_rate = sample_rate
+        self.exporter = exporter or SpanExporter()
+        self._current = ContextVar[Span | None]("current_span", default=None)
+
+    @property
+    def current_span(self) -> Span | None:
+        return self._current.get()
+
+    def traceparent(self) -> str | None:
+        span = self._current.get()
+        return span.traceparent if span is not None else None
+
+    def start_trace(self, name: str, traceparent: str | None = None) -> _SpanScope:
+        parent = parse_traceparent(traceparent)
+        if parent is None:
+            trace_id, parent_id = f"{random.getrandbits(128):032x}", None
+            sampled = random.random() < self.sample_rate
+        else:
+            trace_id, parent_id, sampled = parent
+        return _SpanScope(self, Span(name, trace_id, parent_id, sampled))
+
+    def span(self, name: str) -> _SpanScope | _UnrecordedScope:
+        # outside a sampled trace there is nothing to record, the cost is one context lookup and
+        # the unsampled span, whose attributes are ignored, is handed back
+        parent = self._current.get()
+        if parent is None:
+            return _NOT_TRACED_SCOPE
+        if not parent.sampled:
+            return _UnrecordedScope(parent)
+        return _SpanScope(self, Span(name, parent.trace_id, parent.span_id, True))
+
+
+def create_span_exporter() -> SpanExporter:
+    if payment_settings.trace_exporter == "file":
+        return FileSpanExporter(payment_settings.trace_file_path)
+    if payment_settings.trace_exporter == "memory":
+        return MemorySpanExporter(payment_settings.trace_memory_max_spans)
+    return SpanExporter()
+
+
+tracer = Tracer(payment_settings.trace_sample_rate)
+
+
+class TracingMiddleware:
+    # the root span of every request, continued from the caller's traceparent
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+
+        with tracer.start_trace(scope["method"], traceparent) as span:
+            async def send_with_status(message):
+                if message["type"] == "http.response.start":
+                    span.set_attribute("http.status_code", message["status"])
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                route = scope.get("route")
+                span.name = f"{scope['method']} {route.path if route is not None else 'unmatched'}"
@@ -1,21 +1,76 @@
 import logging
 import re
+import time
 from datetime import datetime
 
 from payment_gateway_api.exceptions import BusinessValidationError
+from payment_gateway_api.metrics import registry
 from payment_gateway_api.models import PaymentRequest
 
 logger = logging.getLogger(__name__)
 
+rejected_total = registry.counter("payment_validation_rejected_total", "Rejected payment fields by rule.", ("rule",))
+_rejected_card_number = rejected_total.labels("card_number")
+_rejected_expiry_month = rejected_total.labels("expiry_month")
+_rejected_expiry_year = rejected_total.labels("expiry_year")
+_rejected_expiry_date = rejected_total.labels("expiry_date")
+_rejected_currency_format = rejected_total.labels("currency_format")
+_rejected_currency_supported = rejected_total.labels("currency_supported")
+_rejected_amount = rejected_total.labels("amount")
+_rejected_cvv = rejected_total.labels("cvv")
+
+# "1" to "12" to the month number, small ints are shared so the lookup does not allocate
+_MONTHS = {str(month): month for month in range(1, 13)}
+
+
+class _CurrentMonth:
+    # datetime.now() is only called again once the next month has started
+    def __init__(self):
+        self._refresh_at = 0.0
+        self.year = ""
+        self.month = 0
+        self.value = 0
+
+    def refresh(self) -> None:
+        if time.time() < self._refresh_at:
+            return
+        now = datetime.now()
+        self.year = f"{now.year:04d}"
+        self.month = now.month
+        self.value = now.year * 12 + now.month
+        next_month = datetime(now.year + now.month // 12, now.month % 12 + 1, 1)
+        self._refresh_at = next_month.timestamp()
+
+
+_current_month = _CurrentMonth()
+
+
 class PaymentValidator:
-    CARD_NUMBER_REGEX = r'^[0-9]{14,19}$'
-    EXPIRY_MONTH_REGEX = r'^([1-9]|1[0-2])$' # possible support 01 to add 0?
-    EXPIRY_YEAR_REGEX = r'^[0-9]{4}$'
-    CURRENCY_REGEX = r'^[A-Z]{3}$'
-    CVV_REGEX = r'^[0-9]{3,4}$'
+    CARD_NUMBER_REGEX = re.compile(r'[0-9]{14,19}')
+    EXPIRY_MONTH_REGEX = re.compile(r'[1-9]|1[0-2]') # possible support 01 to add 0?
+    EXPIRY_YEAR_REGEX = re.compile(r'[0-9]{4}')
+    CURRENCY_REGEX = re.compile(r'[A-Z]{3}')
+    CVV_REGEX = re.compile(r'[0-9]{3,4}')
     SUPPORTED_CURRENCIES = {"GBP", "USD", "CNY"} # can be extracted to config file
 
     def validate_payment(self, payment: PaymentRequest) -> None:
+        # fast path with plain str checks, a valid payment allocates nothing
+        _current_month.refresh()
+        card_number = payment.card_number
+        expiry_year = payment.expiry_year
+        month = _MONTHS.get(payment.expiry_month, 0)
+        cvv = payment.cvv
+        if (14 <= len(card_number) <= 19 and card_number.isascii() and card_number.isdigit()
+                and month
+                and len(expiry_year) == 4 and expiry_year.isascii() and expiry_year.isdigit()
+                # 4 digit years compare as strings like numbers
+                and (expiry_year > _current_month.year
+                     or (expiry_year == _current_month.year and month > _current_month.month))
+                and payment.currency in PaymentValidator.SUPPORTED_CURRENCIES
+                and payment.amount > 0
+                and 3 <= len(cvv) <= 4 and cvv.isascii() and cvv.isdigit()):
+            return
+
         errors = []
 
         valid, message = self._validate_card_number(payment.card_number)
@@ -44,38 +99,44 @@ class PaymentValidator:
             raise BusinessValidationError(message)
 
     def _validate_card_number(self, card_number: str) -> (bool, str):
-        if not card_number or not re.match(PaymentValidator.CARD_NUMBER_REGEX, card_number):
+        if not card_number or not PaymentValidator.CARD_NUMBER_REGEX.fullmatch(card_number):
+            _rejected_card_number.inc()
             return False, 'card_number must be a 14-19 length numeric.'
         return True, ''
 
     def _validate_expiry_date(self, expiry_month, expiry_year) -> (bool, str):
         errors = []
-        if not expiry_month or not re.match(PaymentValidator.EXPIRY_MONTH_REGEX, expiry_month):
+        if not expiry_month or not PaymentValidator.EXPIRY_MONTH_REGEX.fullmatch(expiry_month):
+            _rejected_expiry_month.inc()
             errors.append('expiry_month must be 1-12.')
-        if not expiry_year or not re.match(PaymentValidator.EXPIRY_YEAR_REGEX, expiry_year):
+        if not expiry_year or not PaymentValidator.EXPIRY_YEAR_REGEX.fullmatch(expiry_year):
+            _rejected_expiry_year.inc()
             errors.append('expiry_year must be a 4 length numeric.')
         if len(errors) == 0:
-            now = datetime.now()
-            year = now.year
-            month = now.month
-            if year * 12 + month >= int(expiry_year) * 12 + int(expiry_month):
+            _current_month.refresh()
+            if _current_month.value >= int(expiry_year) * 12 + int(expiry_month):
+                _rejected_expiry_date.inc()
                 errors.append('expiry_year and expiry_month must be in the future.')
         return len(errors) == 0, ' '.join(errors)
 
     def _validate_currency(self, currency: str) -> (bool, str):
-        if not currency or not re.match(PaymentValidator.CURRENCY_REGEX, currency):
+        if not currency or not PaymentValidator.CURRENCY_REGEX.fullmatch(currency):
+            _rejected_currency_format.inc()
             return False, 'currency must be 3 upper case characters.'
         # possible to validate against ISO 4217
         if currency not in PaymentValidator.SUPPORTED_CURRENCIES:
+            _rejected_currency_supported.inc()
             return False, f'currency {currency} is not supported.'
         return True, ''
 
     def _validate_amount(self, amount: int) -> (bool, str):
         if amount <= 0:
+            _rejected_amount.inc()
             return False, 'amount must be positive.'
         return True, ''
 
     def _validate_cvv(self, cvv: str) -> (bool, str):
-        if not cvv or not re.match(PaymentValidator.CVV_REGEX, cvv):
+        if not cvv or not PaymentValidator.CVV_REGEX.fullmatch(cvv):
+            _rejected_cvv.inc()
             return False, 'cvv must be a 3-4 length numeric.'
         return True, ''
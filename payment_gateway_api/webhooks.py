@@ -0,0 +1,416 @@
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import logging
+import random
+import secrets
+import socket
+import sqlite3
+import time
+import urllib.parse
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import NamedTuple
+
+import httpx
+
+from payment_gateway_api.exceptions import BusinessValidationError
+from payment_gateway_api.metrics import registry
+from payment_gateway_api.models import PaymentResponse
+from payment_gateway_api.settings import payment_settings
+
+logger = logging.getLogger(__name__)
+
+events_total = registry.counter("webhook_events_total", "Payment results by webhook delivery outcome.", ("outcome",))
+_queued = events_total.labels("queued")
+_delivered = events_total.labels("delivered")
+_retried = events_total.labels("retried")
+_dropped = events_total.labels("dropped")
+_unregistered = events_total.labels("unregistered")
+request_duration = registry.histogram("webhook_request_duration_seconds", "Webhook POST latency.")
+
+SIGNATURE_HEADER = "Webhook-Signature"
+
+
+def _digest(secret: str, timestamp: int, body: bytes) -> str:
+    return hmac.new(secret.encode(), b"%d." % timestamp + body, hashlib.sha256).hexdigest()
+
+
+def sign(secret: str, timestamp: int, body: bytes) -> str:
+    # t=<unix seconds>,v1=<hex HMAC-SHA256 of "<t>." and the body>, the timestamp is signed too
+    # so a receiver can refuse an old request replayed
+    return f"t={timestamp},v1={_digest(secret, timestamp, body)}"
+
+
+def verify(secret: str, signature: str, body: bytes, tolerance: float) -> bool:
+    try:
+        fields = dict(field.split("=", 1) for field in signature.split(","))
+        timestamp = int(fields["t"])
+    except (KeyError, ValueError):
+        return False
+    if abs(time.time() - timestamp) > tolerance:
+        return False
+    return hmac.compare_digest(fields.get("v1", ""), _digest(secret, timestamp, body))
+
+
+def check_public_url(url: str) -> None:
+    # the gateway POSTs signed bodies to the url, it must not reach into the gateway's own network.
+    # A name is only resolved at delivery, by PublicAddressTransport
+    host = urllib.parse.urlsplit(url).hostname
+    if not host:
+        raise BusinessValidationError("url must have a host.")
+    if host == "localhost" or host.endswith(".localhost"):
+        raise BusinessValidationError("url must not point to a loopback, link-local or private address.")
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return
+    if not address.is_global:
+        raise BusinessValidationError("url must not point to a loopback, link-local or private address.")
+
+
+class PublicAddressTransport(httpx.AsyncHTTPTransport):
+    # refuses a request whose host resolves to any address that is not public, a name registered
+    # for a public address may resolve to an internal one later
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, request.url.port, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise httpx.ConnectError(str(e), request=request)
+        if not all(ipaddress.ip_address(info[4][0]).is_global for info in infos):
+            raise httpx.ConnectError(f"{host} resolves to a non public address", request=request)
+        return await super().handle_async_request(request)
+
+
+class Webhook(NamedTuple):
+    merchant_id: str
+    url: str
+    secret: str
+
+
+class Delivery(NamedTuple):
+    id: int
+    event: bytes
+    attempts: int
+
+
+class WebhookStore:
+    # the webhook registrations and the durable queue of the payment results to deliver, in a WAL
+    # sqlite file shared by the workers. A leased event is hidden from every dispatcher until the
+    # lease ends, so the events of a worker that died are delivered again. The methods block, the
+    # dispatcher calls them from its own thread.
+    _SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS webhooks (
+            merchant_id TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            secret TEXT NOT NULL
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS webhook_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            merchant_id TEXT NOT NULL,
+            event BLOB NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            due_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS webhook_events_due_at ON webhook_events (due_at)",
+    )
+    _REGISTER = ("INSERT INTO webhooks VALUES (?, ?, ?) "
+                 "ON CONFLICT (merchant_id) DO UPDATE SET url = excluded.url, secret = excluded.secret")
+    # the events of the merchants busy with other deliveries are left for later
+    _DUE = ("SELECT e.id, e.merchant_id, e.event, e.attempts, w.url, w.secret FROM webhook_events e "
+            "LEFT JOIN webhooks w USING (merchant_id) WHERE e.due_at <= ? AND e.merchant_id NOT IN ({}) "
+            "ORDER BY e.due_at LIMIT ?")
+
+    def __init__(self, path: str):
+        self._path = path
+        self._connection: sqlite3.Connection | None = None
+
+    def register(self, webhook: Webhook) -> None:
+        self._connect().execute(self._REGISTER, webhook)
+
+    def unregister(self, merchant_id: str) -> bool:
+        return self._connect().execute("DELETE FROM webhooks WHERE merchant_id = ?", (merchant_id,)).rowcount > 0
+
+    def get(self, merchant_id: str) -> Webhook | None:
+        row = self._connect().execute("SELECT merchant_id, url, secret FROM webhooks WHERE merchant_id = ?",
+                                      (merchant_id,)).fetchone()
+        return Webhook(*row) if row is not None else None
+
+    def merchants(self) -> set[str]:
+        return {merchant_id for merchant_id, in self._connect().execute("SELECT merchant_id FROM webhooks")}
+
+    def push(self, events: list[tuple[str, bytes]], due_at: float) -> None:
+        with self._transaction() as connection:
+            connection.executemany("INSERT INTO webhook_events (merchant_id, event, due_at) VALUES (?, ?, ?)",
+                                   [(merchant_id, event, due_at) for merchant_id, event in events])
+
+    def lease(self, now: float, until: float, limit: int, batch_size: int, slots: int, busy: dict[str, int]) \
+            -> tuple[list[tuple[Webhook, list[Delivery]]], int]:
+        # the due events grouped into batches of up to batch size, at most slots batches a merchant
+        # less its busy ones, leased until the given time. The events of unregistered merchants are
+        # deleted and counted.
+        full = [merchant_id for merchant_id, count in busy.items() if count >= slots]
+        webhooks = dict[str, Webhook]()
+        batches = dict[str, list[list[Delivery]]]()
+        leased = []
+        orphaned = []
+        with self._transaction() as connection:
+            rows = connection.execute(self._DUE.format(",".join("?" * len(full))), (now, *full, limit))
+            for event_id, merchant_id, event, attempts, url, secret in rows.fetchall():
+                if url is None:
+                    orphaned.append((event_id,))
+                    continue
+                merchant_batches = batches.setdefault(merchant_id, [])
+                if not merchant_batches or len(merchant_batches[-1]) == batch_size:
+                    if len(merchant_batches) == slots - busy.get(merchant_id, 0):
+                        continue
+                    merchant_batches.append([])
+                merchant_batches[-1].append(Delivery(event_id, event, attempts))
+                webhooks[merchant_id] = Webhook(merchant_id, url, secret)
+                leased.append((until, event_id))
+            connection.executemany("UPDATE webhook_events SET due_at = ? WHERE id = ?", leased)
+            connection.executemany("DELETE FROM webhook_events WHERE id = ?", orphaned)
+        return [(webhooks[merchant_id], deliveries) for merchant_id, merchant_batches in batches.items()
+                for deliveries in merchant_batches], len(orphaned)
+
+    def complete(self, event_ids: list[int]) -> None:
+        with self._transaction() as connection:
+            connection.executemany("DELETE FROM webhook_events WHERE id = ?", [(event_id,) for event_id in event_ids])
+
+    def reschedule(self, retries: list[tuple[float, int]], dropped: list[int]) -> None:
+        # retries are (due at, event id)
+        with self._transaction() as connection:
+            connection.executemany("UPDATE webhook_events SET attempts = attempts + 1, due_at = ? WHERE id = ?",
+                                   retries)
+            connection.executemany("DELETE FROM webhook_events WHERE id = ?", [(event_id,) for event_id in dropped])
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL")
+            connection.execute("PRAGMA busy_timeout=5000")
+            for statement in self._SCHEMA:
+                connection.execute(statement)
+            self._connection = connection
+        return self._connection
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+            connection.execute("COMMIT")
+        except BaseException:
+            # a failed COMMIT (busy, disk full) may leave the transaction open as well
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+
+
+class WebhookDispatcher:
+    # the results of the payments of the merchants with a webhook are queued by notify and posted
+    # by a background task. notify never waits, the results notified meanwhile are written to the
+    # durable queue in one transaction a moment later. Each POST is a JSON array of up to batch max
+    # size payments signed with the merchant's secret, at most destination concurrency POSTs a
+    # merchant at once. A failed POST is retried with exponential backoff and full jitter, up to
+    # max attempts.
+    def __init__(self, store: WebhookStore, client: httpx.AsyncClient, batch_max_size: int,
+                 destination_concurrency: int, max_attempts: int, retry_delay: float, retry_max_delay: float,
+                 poll_interval: float, timeout: float, lease: float):
+        self._store = store
+        self._client = client
+        # the whole POST, the client's timeout is per connect, write and read and a receiver
+        # trickling bytes could outlast the lease
+        self._timeout = timeout
+        self._batch_max_size = batch_max_size
+        self._destination_concurrency = destination_concurrency
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._retry_max_delay = retry_max_delay
+        self._poll_interval = poll_interval
+        self._lease_time = lease
+        # sqlite connections are used from their own thread only
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="webhook-store")
+        # the merchants with a webhook, registrations made on other workers show up within a poll interval
+        self._merchants = set[str]()
+        self._pending = list[tuple[str, bytes]]()
+        self._busy = dict[str, int]()
+        self._wakeup = asyncio.Event()
+        self._flush_task: asyncio.Task | None = None
+        self._run_task: asyncio.Task | None = None
+        self._deliveries = set[asyncio.Task]()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._deliveries)
+
+    async def start(self) -> None:
+        self._merchants = await self._call(self._store.merchants)
+        self._run_task = asyncio.create_task(self._run(), name="webhook-dispatcher")
+
+    async def register(self, merchant_id: str, url: str, secret: str | None = None) -> Webhook:
+        webhook = Webhook(merchant_id, url, secret or secrets.token_urlsafe(32))
+        await self._call(self._store.register, webhook)
+        self._merchants.add(merchant_id)
+        return webhook
+
+    async def unregister(self, merchant_id: str) -> bool:
+        self._merchants.discard(merchant_id)
+        return await self._call(self._store.unregister, merchant_id)
+
+    async def get(self, merchant_id: str) -> Webhook | None:
+        return await self._call(self._store.get, merchant_id)
+
+    def notify(self, merchant_id: str | None, payment: PaymentResponse) -> None:
+        if merchant_id is None or merchant_id not in self._merchants:
+            return
+        self._pending.append((merchant_id, payment.__pydantic_serializer__.to_json(payment)))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def close(self) -> None:
+        # the notified results are queued and the POSTs in progress finish, the queued results
+        # are delivered after the next start
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._run_task is not None:
+            self._run_task.cancel()
+            await asyncio.gather(self._run_task, return_exceptions=True)
+            self._run_task = None
+        await asyncio.gather(*self._deliveries, return_exceptions=True)
+        await self._call(self._store.close)
+
+    async def _call[T](self, function: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def _flush(self) -> None:
+        try:
+            while self._pending:
+                events = self._pending
+                self._pending = []
+                try:
+                    await self._call(self._store.push, events, time.time())
+                except sqlite3.Error as e:
+                    _dropped.inc(len(events))
+                    logger.error("Failed to queue %d webhook events: %s", len(events), str(e))
+                    continue
+                _queued.inc(len(events))
+                self._wakeup.set()
+        finally:
+            self._flush_task = None
+
+    async def _run(self) -> None:
+        refresh_at = time.monotonic() + self._poll_interval
+        while True:
+            self._wakeup.clear()
+            if time.monotonic() >= refresh_at:
+                refresh_at = time.monotonic() + self._poll_interval
+                try:
+                    self._merchants = await self._call(self._store.merchants)
+                except sqlite3.Error as e:
+                    logger.error("Failed to read the webhooks: %s", str(e))
+            now = time.time()
+            if not self._merchants:
+                # no webhook on any worker, so no event to deliver, and no write lock taken for nothing
+                batches, unregistered = [], 0
+            else:
+                batches, unregistered = await self._lease(now)
+            _unregistered.inc(unregistered)
+            for webhook, deliveries in batches:
+                self._busy[webhook.merchant_id] = self._busy.get(webhook.merchant_id, 0) + 1
+                task = asyncio.create_task(self._deliver(webhook, deliveries))
+                self._deliveries.add(task)
+                task.add_done_callback(self._deliveries.discard)
+            if batches:
+                continue
+            # woken by new events or a finished delivery, the retries falling due are found by polling
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._poll_interval)
+            except TimeoutError:
+                pass
+
+    async def _lease(self, now: float) -> tuple[list[tuple[Webhook, list[Delivery]]], int]:
+        try:
+            return await self._call(
+                self._store.lease, now, now + self._lease_time, self._batch_max_size * self._destination_concurrency,
+                self._batch_max_size, self._destination_concurrency, dict(self._busy))
+        except sqlite3.Error as e:
+            logger.error("Failed to lease webhook events: %s", str(e))
+            return [], 0
+
+    async def _deliver(self, webhook: Webhook, deliveries: list[Delivery]) -> None:
+        body = b"[" + b",".join(delivery.event for delivery in deliveries) + b"]"
+        headers = {"Content-Type": "application/json", SIGNATURE_HEADER: sign(webhook.secret, int(time.time()), body)}
+        start = time.perf_counter()
+        try:
+            try:
+                async with asyncio.timeout(self._timeout):
+                    response = await self._client.post(webhook.url, content=body, headers=headers)
+                failure = None if response.is_success else f"status {response.status_code}"
+            except httpx.HTTPError as e:
+                failure = str(e) or type(e).__name__
+            except TimeoutError:
+                failure = f"no answer within {self._timeout}s"
+            request_duration.observe(time.perf_counter() - start)
+            if failure is None:
+                await self._call(self._store.complete, [delivery.id for delivery in deliveries])
+                _delivered.inc(len(deliveries))
+                return
+            now = time.time()
+            retries = [(now + self._backoff(delivery.attempts), delivery.id) for delivery in deliveries
+                       if delivery.attempts + 1 < self._max_attempts]
+            dropped = [delivery.id for delivery in deliveries if delivery.attempts + 1 >= self._max_attempts]
+            await self._call(self._store.reschedule, retries, dropped)
+            _retried.inc(len(retries))
+            logger.warning("Webhook of merchant %s failed with %s, %d events retried", webhook.merchant_id,
+                           failure, len(retries))
+            if dropped:
+                _dropped.inc(len(dropped))
+                logger.error("Dropped %d webhook events of merchant %s after %d attempts", len(dropped),
+                             webhook.merchant_id, self._max_attempts)
+        except sqlite3.Error as e:
+            # delivered again once their lease ends
+            logger.error("Failed to update %d webhook events: %s", len(deliveries), str(e))
+        finally:
+            self._busy[webhook.merchant_id] -= 1
+            if self._busy[webhook.merchant_id] == 0:
+                del self._busy[webhook.merchant_id]
+            self._wakeup.set()
+
+    def _backoff(self, attempts: int) -> float:
+        return random.uniform(0, min(self._retry_max_delay, self._retry_delay * 2 ** attempts))
+
+
+def create_webhook_client() -> httpx.AsyncClient:
+    # separate from the bank client, slow merchant endpoints do not take the bank's connections
+    limits = httpx.Limits(max_connections=payment_settings.webhook_max_connections,
+                          max_keepalive_connections=payment_settings.webhook_max_connections)
+    transport = httpx.AsyncHTTPTransport if payment_settings.webhook_allow_private_addresses \
+        else PublicAddressTransport
+    return httpx.AsyncClient(timeout=payment_settings.webhook_timeout, transport=transport(limits=limits))
+
+
+def create_webhook_dispatcher(client: httpx.AsyncClient) -> WebhookDispatcher:
+    # a POST ends within the webhook timeout, an event is only leased again when its worker died
+    dispatcher = WebhookDispatcher(
+        WebhookStore(payment_settings.webhook_store_path), client, payment_settings.webhook_batch_max_size,
+        payment_settings.webhook_destination_concurrency, payment_settings.webhook_max_attempts,
+        payment_settings.webhook_retry_delay, payment_settings.webhook_retry_max_delay,
+        payment_settings.webhook_poll_interval, payment_settings.webhook_timeout,
+        lease=2 * payment_settings.webhook_timeout + 10)
+    registry.gauge("webhook_requests_in_flight", "Webhook POSTs in progress.", lambda: dispatcher.in_flight)
+    return dispatcher
@@ -0,0 +1,92 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections.abc import Awaitable, Callable
+
+from payment_gateway_api.exceptions import OverloadedError
+from payment_gateway_api.metrics import registry
+from payment_gateway_api.settings import payment_settings
+
+logger = logging.getLogger(__name__)
+
+queue_wait = registry.histogram("payment_queue_wait_seconds", "Time an accepted payment waited for a worker.")
+rejected_total = registry.counter("payment_queue_rejected_total", "Async payments rejected by a full queue.")
+
+Job = Callable[[], Awaitable[None]]
+
+
+class WorkerPool:
+    # a bounded in-process queue drained by a fixed number of worker tasks. A slot is reserved
+    # before the caller does its own work, so once accepted a job always fits in the queue.
+    def __init__(self, name: str, workers: int, queue_size: int, drain_timeout: float):
+        self.name = name
+        self._workers = workers
+        self._queue_size = queue_size
+        self._drain_timeout = drain_timeout
+        self._queue = asyncio.Queue[tuple[float, contextvars.Context, Job]]()
+        self._reserved = 0
+        self._busy = 0
+        self._tasks = list[asyncio.Task]()
+        self._closed = False
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() + self._reserved
+
+    @property
+    def busy(self) -> int:
+        return self._busy
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._work(), name=f"{self.name}-worker-{i}")
+                       for i in range(self._workers)]
+
+    def reserve(self) -> None:
+        if self._closed or self.depth >= self._queue_size:
+            rejected_total.inc()
+            logger.warning("Rejected an async payment, %s queue is full (%d queued)", self.name, self.depth)
+            raise OverloadedError("Too many payments queued, please retry later.")
+        self._reserved += 1
+
+    def release(self) -> None:
+        self._reserved -= 1
+
+    def submit(self, job: Job) -> None:
+        # into a slot taken by reserve, run in the caller's context so its logs and spans keep
+        # the request's correlation id and trace
+        self._reserved -= 1
+        self._queue.put_nowait((time.perf_counter(), contextvars.copy_context(), job))
+
+    async def close(self) -> None:
+        # the queued jobs get drain_timeout to finish, the rest are abandoned
+        self._closed = True
+        try:
+            await asyncio.wait_for(self._queue.join(), self._drain_timeout)
+        except TimeoutError:
+            logger.error("%s pool stopped with %d jobs not done", self.name, self._queue.qsize() + self._busy)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _work(self) -> None:
+        while True:
+            enqueued_at, context, job = await self._queue.get()
+            queue_wait.observe(time.perf_counter() - enqueued_at)
+            self._busy += 1
+            try:
+                await asyncio.create_task(job(), context=context)
+            except Exception:
+                logger.exception("%s job failed", self.name)
+            finally:
+                self._busy -= 1
+                self._queue.task_done()
+
+
+def create_payment_worker_pool() -> WorkerPool:
+    pool = WorkerPool("payments", payment_settings.payment_async_workers, payment_settings.payment_async_queue_size,
+                      payment_settings.payment_async_drain_timeout)
+    registry.gauge("payment_queue_depth", "Async payments accepted and waiting for a worker.", lambda: pool.depth)
+    registry.gauge("payment_workers_busy", "Workers calling the bank for an async payment.", lambda: pool.busy)
+    return pool
@@ -1,9 +1,19 @@
-from unittest.mock import patch
+import json
+import time
+import uuid
+from datetime import datetime, UTC
+from unittest.mock import patch, AsyncMock
 
 import pytest
 from fastapi.testclient import TestClient
 
-from payment_gateway_api.app import app
+from payment_gateway_api.app import app, get_payment_service
+from payment_gateway_api.caches import ResponseCache, encode_payment
+from payment_gateway_api.models import PaymentResponse, PaymentStatus
+from payment_gateway_api.repositories import PaymentRepository
+from payment_gateway_api.settings import AcquirerSettings, ApiKeySettings
+from payment_gateway_api.stores import MemoryPaymentStore
+from payment_gateway_api.tracing import tracer
 
 
 @pytest.mark.parametrize("request_body, expected_message", [
@@ -32,8 +42,8 @@ from payment_gateway_api.app import app
       "cvv": "123"}, "expiry_year and expiry_month must be in the future. currency AAA is not supported.")
 ])
 def test_validation_error(request_body, expected_message):
-    client = TestClient(app)
-    response = client.post("/api/v1/payments", json=request_body)
+    with TestClient(app) as client:
+        response = client.post("/api/v1/payments", json=request_body)
     assert response.status_code == 400
     assert response.json()["message"] == expected_message
 
@@ -53,8 +63,8 @@ def test_validation_error(request_body, expected_message):
       "cvv": "4567"}, "DECLINED")
 ])
 def test_process_success(request_body, status):
-    client = TestClient(app)
-    response = client.post("/api/v1/payments", json=request_body)
+    with TestClient(app) as client:
+        response = client.post("/api/v1/payments", json=request_body)
     assert response.status_code == 201
     assert response.json()["status"] == status
 
@@ -68,8 +78,8 @@ def test_process_success(request_body, status):
       "cvv": "7890"}, "Downstream bank server is unavailable, please retry later."),
 ])
 def test_process_error(request_body, message):
-    client = TestClient(app)
-    response = client.post("/api/v1/payments", json=request_body)
+    with TestClient(app) as client:
+        response = client.post("/api/v1/payments", json=request_body)
     assert response.status_code == 503
     assert response.json()["message"] == message
 
@@ -85,7 +95,418 @@ def test_process_error(request_body, message):
 def test_process_no_downstream(request_body, message):
     with patch('payment_gateway_api.settings.payment_settings.bank_url') as bank_url:
         bank_url.return_value = "http://localhost:12345"  # no such downstream
-        client = TestClient(app)
-        response = client.post("/api/v1/payments", json=request_body)
+        with TestClient(app) as client:
+            response = client.post("/api/v1/payments", json=request_body)
         assert response.status_code == 500
         assert response.json()["message"] == message
+
+
+def test_circuit_breaker_state():
+    with TestClient(app) as client:
+        response = client.get("/api/v1/bank/circuit-breaker")
+    assert response.status_code == 200
+    assert response.json() == {"default": {"state": "CLOSED", "calls": 0, "failure_rate": 0.0,
+                                           "slow_call_rate": 0.0}}
+
+
+def test_circuit_breaker_state_of_each_acquirer():
+    acquirers = [AcquirerSettings(name="primary", url="http://localhost:8080"),
+                 AcquirerSettings(name="secondary", url="http://localhost:8081")]
+    with patch('payment_gateway_api.settings.payment_settings.bank_acquirers', acquirers), TestClient(app) as client:
+        response = client.get("/api/v1/bank/circuit-breaker")
+        metrics = client.get("/metrics")
+    assert sorted(response.json()) == ["primary", "secondary"]
+    assert response.json()["secondary"]["state"] == "CLOSED"
+    assert 'bank_circuit_state{acquirer="primary"} 0.0' in metrics.text
+    assert 'bank_circuit_state{acquirer="secondary"} 0.0' in metrics.text
+
+
+def test_metrics():
+    with TestClient(app) as client:
+        client.get("/api/v1/payments/00000000-0000-0000-0000-000000000000")
+        client.post("/api/v1/payments", json={"card_number": "12345678901234",
+                                               "expiry_month": "12",
+                                               "expiry_year": "2000",
+                                               "currency": "GBP",
+                                               "amount": 100,
+                                               "cvv": "123"})
+        response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'bank_circuit_state{acquirer="default"} 0.0' in response.text
+    assert ('http_request_duration_seconds_count{method="GET",route="/api/v1/payments/{payment_id}",status="404"}'
+            in response.text)
+    assert 'payment_validation_rejected_total{rule="expiry_date"}' in response.text
+    assert "payment_repository_size" in response.text
+
+
+def test_process_idempotency_key():
+    request_body = {"card_number": "12345678901111",
+                    "expiry_month": "12",
+                    "expiry_year": "2036",
+                    "currency": "GBP",
+                    "amount": 123,
+                    "cvv": "123"}
+    with TestClient(app) as client:
+        first = client.post("/api/v1/payments", json=request_body, headers={"Idempotency-Key": "order-1"})
+        second = client.post("/api/v1/payments", json=request_body, headers={"Idempotency-Key": "order-1"})
+        mismatch = client.post("/api/v1/payments", json={**request_body, "amount": 456},
+                               headers={"Idempotency-Key": "order-1"})
+    assert first.status_code == 201
+    assert second.status_code == 201
+    assert first.json()["id"] == second.json()["id"]
+    assert mismatch.status_code == 422
+    assert mismatch.json()["message"] == "Idempotency-Key order-1 was already used with a different payment."
+
+
+def test_request_id():
+    with TestClient(app) as client:
+        given = client.get("/metrics", headers={"X-Request-ID": "abc-123"})
+        generated = client.get("/metrics")
+    assert given.headers["X-Request-ID"] == "abc-123"
+    assert len(generated.headers["X-Request-ID"]) == 32
+
+
+def test_payment_trace():
+    request_body = {"card_number": "12345678901111",
+                    "expiry_month": "12",
+                    "expiry_year": "2036",
+                    "currency": "GBP",
+                    "amount": 123,
+                    "cvv": "123"}
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+    with TestClient(app) as client:
+        response = client.post("/api/v1/payments", json=request_body,
+                               headers={"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"})
+        spans = tracer.exporter.trace(trace_id)
+    assert response.status_code == 201
+    assert [span.name for span in spans] == ["validate", "map", "bank.http", "bank", "store", "POST /api/v1/payments"]
+    assert spans[-1].attributes["http.status_code"] == 201
+
+
+def test_dependency_override():
+    payment = PaymentResponse(id=uuid.uuid4(), status=PaymentStatus.DECLINED, card_last4="1111", expiry_month="1",
+                              expiry_year="2030", currency="USD", amount=5)
+    service = AsyncMock()
+    service.get_encoded_payment.return_value = encode_payment(payment)
+    app.dependency_overrides[get_payment_service] = lambda: service
+    try:
+        with TestClient(app) as client:
+            response = client.get(f"/api/v1/payments/{payment.id}")
+    finally:
+        app.dependency_overrides.clear()
+    assert response.status_code == 200
+    assert response.json()["status"] == "DECLINED"
+    service.get_encoded_payment.assert_awaited_once_with(payment.id, None)
+
+
+def test_process_async():
+    request_body = {"card_number": "12345678902222",
+                    "expiry_month": "12",
+                    "expiry_year": "2046",
+                    "currency": "CNY",
+                    "amount": 456,
+                    "cvv": "4567"}
+    with TestClient(app) as client:
+        accepted = client.post("/api/v1/payments", json=request_body, headers={"Prefer": "respond-async, wait=5"})
+        # the queue is drained when the app stops
+    with TestClient(app) as client:
+        completed = client.get(accepted.headers["Location"])
+    assert accepted.status_code == 202
+    assert accepted.headers["Preference-Applied"] == "respond-async"
+    assert accepted.json()["status"] == "PENDING"
+    assert completed.json()["status"] == "DECLINED"
+
+
+def test_process_async_queue_full():
+    request_body = {"card_number": "12345678901111",
+                    "expiry_month": "12",
+                    "expiry_year": "2036",
+                    "currency": "GBP",
+                    "amount": 123,
+                    "cvv": "123"}
+    with patch('payment_gateway_api.settings.payment_settings.payment_async_queue_size', 0):
+        with TestClient(app) as client:
+            response = client.post("/api/v1/payments", json=request_body, headers={"Prefer": "respond-async"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert response.json()["message"] == "Too many payments queued, please retry later."
+
+
+def test_webhook_registration(tmp_path):
+    headers = {"Merchant-Id": "merchant-1"}
+    with patch('payment_gateway_api.settings.payment_settings.webhook_store_path', str(tmp_path / "webhooks.db")), \
+            patch('payment_gateway_api.settings.payment_settings.webhooks_enabled', True), \
+            patch('payment_gateway_api.settings.payment_settings.webhook_merchant_id_header', True):
+        with TestClient(app) as client:
+            missing = client.get("/api/v1/webhook", headers=headers)
+            anonymous = client.put("/api/v1/webhook", json={"url": "https://merchant-1.test/hook"})
+            invalid = client.put("/api/v1/webhook", json={"url": "ftp://merchant-1.test/hook"}, headers=headers)
+            registered = client.put("/api/v1/webhook", json={"url": "https://merchant-1.test/hook"}, headers=headers)
+        # kept across restarts
+        with TestClient(app) as client:
+            found = client.get("/api/v1/webhook", headers=headers)
+            deleted = client.delete("/api/v1/webhook", headers=headers)
+            deleted_again = client.delete("/api/v1/webhook", headers=headers)
+    assert missing.status_code == 404
+    assert anonymous.status_code == 400
+    assert anonymous.json()["message"] == "Merchant-Id header is required."
+    assert invalid.status_code == 400
+    assert registered.status_code == 200
+    assert registered.json()["merchant_id"] == "merchant-1"
+    assert len(registered.json()["secret"]) >= 32
+    assert found.json() == {"merchant_id": "merchant-1", "url": "https://merchant-1.test/hook"}
+    assert deleted.status_code == 204
+    assert deleted_again.status_code == 404
+
+
+@pytest.mark.parametrize("url", ["http://127.0.0.1:8080/hook", "http://localhost/hook", "http://169.254.169.254/latest",
+                                 "http://10.0.0.1/hook", "http://[::1]/hook", "http:///hook"])
+def test_webhook_to_an_internal_address_is_refused(tmp_path, url):
+    with patch('payment_gateway_api.settings.payment_settings.webhook_store_path', str(tmp_path / "webhooks.db")), \
+            patch('payment_gateway_api.settings.payment_settings.webhooks_enabled', True), \
+            patch('payment_gateway_api.settings.payment_settings.webhook_merchant_id_header', True):
+        with TestClient(app) as client:
+            response = client.put("/api/v1/webhook", json={"url": url}, headers={"Merchant-Id": "merchant-1"})
+    assert response.status_code == 400
+
+
+def test_webhooks_are_off_by_default(tmp_path):
+    with patch('payment_gateway_api.settings.payment_settings.webhook_store_path', str(tmp_path / "webhooks.db")), \
+            patch('payment_gateway_api.settings.payment_settings.webhook_merchant_id_header', True):
+        with TestClient(app) as client:
+            response = client.get("/api/v1/webhook", headers={"Merchant-Id": "merchant-1"})
+    assert response.status_code == 404
+    assert response.json()["message"] == "Webhooks are not enabled."
+    assert not (tmp_path / "webhooks.db").exists()
+
+
+def test_webhooks_need_an_api_key(tmp_path):
+    headers = {"Merchant-Id": "merchant-1"}
+    with patch('payment_gateway_api.settings.payment_settings.webhook_store_path', str(tmp_path / "webhooks.db")), \
+            patch('payment_gateway_api.settings.payment_settings.webhooks_enabled', True):
+        with TestClient(app) as client:
+            registered = client.put("/api/v1/webhook", json={"url": "https://attacker.test/hook"}, headers=headers)
+            found = client.get("/api/v1/webhook", headers=headers)
+            deleted = client.delete("/api/v1/webhook", headers=headers)
+    assert registered.status_code == 403
+    assert registered.json()["message"] == "Webhooks need an API key."
+    assert found.status_code == 403
+    assert deleted.status_code == 403
+
+
+def test_api_key_rate_limit(tmp_path):
+    api_keys = [ApiKeySettings(key="key-1", merchant_id="merchant-1", rate=0.01, burst=2)]
+    with patch('payment_gateway_api.settings.payment_settings.api_keys', api_keys), \
+            patch('payment_gateway_api.settings.payment_settings.webhook_store_path', str(tmp_path / "webhooks.db")), \
+            patch('payment_gateway_api.settings.payment_settings.webhooks_enabled', True):
+        with TestClient(app) as client:
+            missing = client.get("/api/v1/webhook")
+            unknown = client.get("/api/v1/webhook", headers={"X-API-Key": "key-2"})
+            # the merchant is the key's, not the header's
+            registered = client.put("/api/v1/webhook", json={"url": "https://merchant-1.test/hook"},
+                                    headers={"X-API-Key": "key-1", "Merchant-Id": "merchant-2"})
+            found = client.get("/api/v1/webhook", headers={"X-API-Key": "key-1"})
+            limited = client.get("/api/v1/webhook", headers={"X-API-Key": "key-1"})
+            metrics = client.get("/metrics")
+    assert missing.status_code == 401
+    assert missing.headers["WWW-Authenticate"] == "X-API-Key"
+    assert missing.json()["message"] == "Missing or unknown API key."
+    assert unknown.status_code == 401
+    assert registered.json()["merchant_id"] == "merchant-1"
+    assert registered.headers["X-RateLimit-Limit"] == "2"
+    assert registered.headers["X-RateLimit-Remaining"] == "1"
+    assert found.status_code == 200
+    assert found.headers["X-RateLimit-Remaining"] == "0"
+    assert limited.status_code == 429
+    assert limited.json()["message"] == "Rate limit exceeded, please retry later."
+    assert limited.headers["X-RateLimit-Remaining"] == "0"
+    assert limited.headers["Retry-After"] == "100"
+    assert metrics.status_code == 200
+    assert 'rate_limited_total{merchant="merchant-1"} 1' in metrics.text
+
+
+def test_idempotency_keys_are_per_api_key():
+    request_body = {"card_number": "12345678901111",
+                    "expiry_month": "12",
+                    "expiry_year": "2036",
+                    "currency": "GBP",
+                    "amount": 123,
+                    "cvv": "123"}
+    api_keys = [ApiKeySettings(key="key-1", merchant_id="merchant-1"),
+                ApiKeySettings(key="key-2", merchant_id="merchant-2")]
+    with patch('payment_gateway_api.settings.payment_settings.api_keys', api_keys):
+        with TestClient(app) as client:
+            first = client.post("/api/v1/payments", json=request_body,
+                                headers={"X-API-Key": "key-1", "Idempotency-Key": "order-1"})
+            replayed = client.post("/api/v1/payments", json=request_body,
+                                   headers={"X-API-Key": "key-1", "Idempotency-Key": "order-1"})
+            other = client.post("/api/v1/payments", json=request_body,
+                                headers={"X-API-Key": "key-2", "Idempotency-Key": "order-1"})
+    assert first.status_code == other.status_code == 201
+    assert replayed.json()["id"] == first.json()["id"]
+    # the other merchant's key does not return merchant-1's payment
+    assert other.json()["id"] != first.json()["id"]
+
+
+def test_payments_are_per_api_key():
+    request_body = {"card_number": "12345678901111",
+                    "expiry_month": "12",
+                    "expiry_year": "2036",
+                    "currency": "GBP",
+                    "amount": 123,
+                    "cvv": "123"}
+    api_keys = [ApiKeySettings(key="key-1", merchant_id="merchant-1"),
+                ApiKeySettings(key="key-2", merchant_id="merchant-2")]
+    with patch('payment_gateway_api.settings.payment_settings.api_keys', api_keys):
+        with TestClient(app) as client:
+            payment = client.post("/api/v1/payments", json=request_body, headers={"X-API-Key": "key-1"}).json()
+            own = client.get(f"/api/v1/payments/{payment['id']}", headers={"X-API-Key": "key-1"})
+            other = client.get(f"/api/v1/payments/{payment['id']}", headers={"X-API-Key": "key-2"})
+            own_list = client.get("/api/v1/payments", headers={"X-API-Key": "key-1"})
+            other_list = client.get("/api/v1/payments", headers={"X-API-Key": "key-2"})
+            other_export = client.get("/api/v1/payments/export", headers={"X-API-Key": "key-2"})
+    assert own.status_code == 200
+    assert other.status_code == 404
+    assert payment["id"] in [item["id"] for item in own_list.json()["items"]]
+    assert payment["id"] not in [item["id"] for item in other_list.json()["items"]]
+    assert other_export.status_code == 200
+    assert payment["id"] not in other_export.text
+
+
+def test_lookup_overloaded():
+    with patch('payment_gateway_api.settings.payment_settings.payment_lookup_concurrency', 0), \
+            patch('payment_gateway_api.settings.payment_settings.payment_lookup_queue_size', 0):
+        with TestClient(app) as client:
+            response = client.get("/api/v1/payments/00000000-0000-0000-0000-000000000000")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert response.json()["message"] == "Too many requests in progress, please retry later."
+
+
+def test_get_payment_etag():
+    request_body = {"card_number": "12345678901111",
+                    "expiry_month": "12",
+                    "expiry_year": "2036",
+                    "currency": "GBP",
+                    "amount": 123,
+                    "cvv": "123"}
+    with TestClient(app) as client:
+        payment = client.post("/api/v1/payments", json=request_body).json()
+        response = client.get(f"/api/v1/payments/{payment['id']}")
+        etag = response.headers["ETag"]
+        not_modified = client.get(f"/api/v1/payments/{payment['id']}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json() == payment
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    assert not_modified.headers["ETag"] == etag
+
+
+def test_get_expired_payment():
+    request_body = {"card_number": "12345678901111",
+                    "expiry_month": "12",
+                    "expiry_year": "2036",
+                    "currency": "GBP",
+                    "amount": 123,
+                    "cvv": "123"}
+    repository = PaymentRepository(MemoryPaymentStore(max_entries=10, ttl=0.2), ResponseCache(max_entries=10))
+    with patch('payment_gateway_api.services.repo', repository), TestClient(app) as client:
+        payment = client.post("/api/v1/payments", json=request_body).json()
+        cached = client.get(f"/api/v1/payments/{payment['id']}")
+        time.sleep(0.25)
+        expired = client.get(f"/api/v1/payments/{payment['id']}")
+    assert cached.status_code == 200
+    assert expired.status_code == 404
+    assert "ETag" not in expired.headers
+
+
+def test_list_and_export_payments():
+    request_body = {"card_number": "12345678901111",
+                    "expiry_month": "12",
+                    "expiry_year": "2036",
+                    "currency": "GBP",
+                    "amount": 123,
+                    "cvv": "123"}
+    created_from = datetime.now(UTC).isoformat()
+    with TestClient(app) as client:
+        ids = [client.post("/api/v1/payments", json=request_body).json()["id"] for _ in range(3)]
+        params = {"created_from": created_from, "status": "AUTHORIZED", "currency": "GBP", "limit": 2}
+        first = client.get("/api/v1/payments", params=params).json()
+        second = client.get("/api/v1/payments", params={**params, "cursor": first["next_cursor"]}).json()
+        ndjson = client.get("/api/v1/payments/export", params={"created_from": created_from})
+        csv = client.get("/api/v1/payments/export", params={"created_from": created_from, "format": "csv"})
+        invalid = client.get("/api/v1/payments", params={"cursor": "not-a-cursor"})
+    assert [item["id"] for item in first["items"] + second["items"]] == ids
+    assert second["next_cursor"] is None
+    assert [json.loads(line)["id"] for line in ndjson.text.splitlines()] == ids
+    assert ndjson.headers["content-type"] == "application/x-ndjson"
+    lines = csv.text.splitlines()
+    assert lines[0] == "id,status,card_last4,expiry_month,expiry_year,currency,amount,created_at"
+    assert [line.split(",")[0] for line in lines[1:]] == ids
+    assert invalid.status_code == 400
+    assert invalid.json()["message"] == "cursor is invalid."
+
+
+def test_process_batch_validation():
+    request_body = [{"card_number": "not-a-card",
+                     "expiry_month": "12",
+                     "expiry_year": "2036",
+                     "currency": "GBP",
+                     "amount": 123,
+                     "cvv": "123"},
+                    {"card_number": "12345678901111"},
+                    "not-an-object"]
+    with TestClient(app) as client:
+        response = client.post("/api/v1/payments/batch", json=request_body)
+    assert response.status_code == 200
+    results = sorted((json.loads(line) for line in response.text.splitlines()), key=lambda result: result["index"])
+    assert [result["status_code"] for result in results] == [400, 400, 400]
+    assert results[0]["message"] == "card_number must be a 14-19 length numeric."
+    assert results[1]["message"] == ("expiry_month: Field required; expiry_year: Field required; "
+                                     "currency: Field required; amount: Field required; cvv: Field required")
+    assert results[2]["message"] == "payment must be a JSON object."
+
+
+@pytest.mark.parametrize("request_body, message", [
+    ({}, "body must be a JSON array or NDJSON."),
+    ([], "batch must contain 1-10000 payments."),
+])
+def test_process_batch_invalid_body(request_body, message):
+    with TestClient(app) as client:
+        response = client.post("/api/v1/payments/batch", json=request_body)
+    assert response.status_code == 400
+    assert response.json()["message"] == message
+
+
+def test_process_batch_ndjson():
+    lines = [{"card_number": "12345678901111",
+              "expiry_month": "12",
+              "expiry_year": "2036",
+              "currency": "GBP",
+              "amount": 123,
+              "cvv": "123"},
+             {"card_number": "12345678902222",
+              "expiry_month": "12",
+              "expiry_year": "2036",
+              "currency": "GBP",
+              "amount": 456,
+              "cvv": "456"}]
+    body = "\n".join(json.dumps(line) for line in lines) + "\n"
+    with TestClient(app) as client:
+        response = client.post("/api/v1/payments/batch", content=body,
+                               headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    results = sorted((json.loads(line) for line in response.text.splitlines()), key=lambda result: result["index"])
+    assert [result["status_code"] for result in results] == [201, 201]
+    assert [result["payment"]["status"] for result in results] == ["AUTHORIZED", "DECLINED"]
+
+
+def test_store_is_closed_when_the_container_fails_to_close():
+    with patch('payment_gateway_api.containers.Container.close', side_effect=RuntimeError("close failed")), \
+            patch('payment_gateway_api.repositories.repo.close') as mock_repo_close:
+        with pytest.raises(RuntimeError):
+            with TestClient(app):
+                pass
+    mock_repo_close.assert_awaited_once()
@@ -0,0 +1,52 @@
+import sqlite3
+import uuid
+
+import pytest
+
+from payment_gateway_api.models import PaymentResponse, PaymentStatus
+
+
+class FakeClock:
+    # time only moves when a test sets now
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FailingCommit:
+    # a sqlite connection whose first COMMIT fails like a busy database
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self.failed = False
+
+    def execute(self, sql: str, *args):
+        if sql == "COMMIT" and not self.failed:
+            self.failed = True
+            raise sqlite3.OperationalError("database is locked")
+        return self.connection.execute(sql, *args)
+
+    def __getattr__(self, name: str):
+        return getattr(self.connection, name)
+
+
+def create_payment(status=PaymentStatus.AUTHORIZED, expiry_month="12", amount=100, currency="GBP") -> PaymentResponse:
+    return PaymentResponse(id=uuid.uuid4(), status=status, card_last4="1234", expiry_month=expiry_month,
+                           expiry_year="2036", currency=currency, amount=amount)
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
+
+
+@pytest.fixture
+def new_payment():
+    # a factory, a test makes as many payments as it needs
+    return create_payment
+
+
+@pytest.fixture
+def failing_commit():
+    return FailingCommit
@@ -0,0 +1,103 @@
+import uuid
+from collections import Counter
+from unittest.mock import AsyncMock
+
+import pytest
+
+from payment_gateway_api.acquirers import Acquirer, AcquirerRouter
+from payment_gateway_api.clients import BankClient
+from payment_gateway_api.exceptions import BankServerError, BankConnectionError, BankCircuitOpenError
+from payment_gateway_api.models import BankPaymentRequest, BankPaymentResponse
+
+
+def acquirer(name: str, currencies=("GBP", "USD", "CNY"), weight: float = 1.0, latency: float = 0.01) -> Acquirer:
+    client = AsyncMock(spec=BankClient)
+    client.process_payment.return_value = BankPaymentResponse(authorized=True, authorization_code=uuid.uuid4())
+    result = Acquirer(name, client, frozenset(currencies), weight, alpha=0.2)
+    result.record(latency, False)
+    return result
+
+
+def bank_payment(currency: str = "GBP") -> BankPaymentRequest:
+    return BankPaymentRequest(card_number="00001231", expiry_date="12/2036", currency=currency, amount=100, cvv="345")
+
+
+async def route(router: AcquirerRouter, acquirers: list[Acquirer], payments: int, currency: str = "GBP") -> Counter:
+    for _ in range(payments):
+        await router.process_payment(bank_payment(currency))
+    return Counter({a.name: a.client.process_payment.call_count for a in acquirers})
+
+
+class TestAcquirerRouter:
+    @pytest.mark.asyncio
+    async def test_routes_by_currency(self):
+        acquirers = [acquirer("gbp", currencies=("GBP",)), acquirer("usd", currencies=("USD",))]
+        router = AcquirerRouter(acquirers)
+
+        assert await route(router, acquirers, 3, "USD") == Counter(usd=3)
+
+    @pytest.mark.asyncio
+    async def test_weighted_round_robin(self):
+        acquirers = [acquirer("a", weight=3), acquirer("b", weight=1)]
+        router = AcquirerRouter(acquirers)
+        for a in acquirers:
+            a.record = lambda elapsed, failed: None
+
+        assert await route(router, acquirers, 8) == Counter(a=6, b=2)
+
+    @pytest.mark.asyncio
+    async def test_slow_acquirer_gets_fewer_payments(self):
+        acquirers = [acquirer("fast", latency=0.01), acquirer("slow", latency=0.04)]
+        router = AcquirerRouter(acquirers)
+        for a in acquirers:
+            a.record = lambda elapsed, failed: None
+
+        assert await route(router, acquirers, 10) == Counter(fast=8, slow=2)
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("error", [
+        BankServerError("Downstream bank server is unavailable, please retry later."),
+        BankCircuitOpenError("Downstream bank server is unavailable, please retry later."),
+    ])
+    async def test_fails_over_on_bank_server_error(self, error):
+        primary, secondary = acquirer("primary", weight=100), acquirer("secondary")
+        primary.client.process_payment.side_effect = error
+        router = AcquirerRouter([primary, secondary])
+
+        response = await router.process_payment(bank_payment())
+
+        assert response.authorized is True
+        assert primary.client.process_payment.call_count == 1
+        assert secondary.client.process_payment.call_count == 1
+        assert primary.error_rate > 0
+
+    @pytest.mark.asyncio
+    async def test_raises_when_every_acquirer_fails(self):
+        acquirers = [acquirer("a"), acquirer("b")]
+        for a in acquirers:
+            a.client.process_payment.side_effect = BankServerError("unavailable")
+        router = AcquirerRouter(acquirers)
+
+        with pytest.raises(BankServerError):
+            await router.process_payment(bank_payment())
+        assert all(a.client.process_payment.call_count == 1 for a in acquirers)
+
+    @pytest.mark.asyncio
+    async def test_connection_error_is_not_failed_over(self):
+        primary, secondary = acquirer("primary", weight=100), acquirer("secondary")
+        primary.client.process_payment.side_effect = BankConnectionError("Request error when calling downstream bank.")
+        router = AcquirerRouter([primary, secondary])
+
+        with pytest.raises(BankConnectionError):
+            await router.process_payment(bank_payment())
+        assert secondary.client.process_payment.call_count == 0
+
+    def test_errors_lower_the_weight(self):
+        a = acquirer("a")
+        weight = a.effective_weight
+        a.record(0.01, True)
+        assert a.effective_weight < weight
+        for _ in range(100):
+            a.record(0.01, True)
+        # a failing acquirer keeps a small share to notice its recovery
+        assert a.effective_weight > 0
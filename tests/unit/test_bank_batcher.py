@@ -0,0 +1,107 @@
+import asyncio
+import json
+import uuid
+
+import httpx
+import pytest
+
+from payment_gateway_api.batchers import BankBatcher
+from payment_gateway_api.clients import BankClient
+from payment_gateway_api.exceptions import BankServerError, PaymentServerError
+from payment_gateway_api.models import BankPaymentRequest
+
+
+def bank_answer(payment: dict) -> dict:
+    digit = payment["card_number"][-1]
+    if digit == "0":
+        return {"status_code": 503}
+    authorized = digit in "13579"
+    return {"status_code": 200, "authorized": authorized,
+            "authorization_code": str(uuid.uuid5(uuid.NAMESPACE_OID, digit)) if authorized else ""}
+
+
+def batch_client(batches: list, handler=None) -> httpx.AsyncClient:
+    def handle(request: httpx.Request) -> httpx.Response:
+        payments = json.loads(request.content)
+        batches.append((request.url.path, payments))
+        if handler is not None:
+            return handler(payments)
+        return httpx.Response(200, json=[bank_answer(payment) for payment in payments])
+    return httpx.AsyncClient(transport=httpx.MockTransport(handle))
+
+
+def bank_payment(card_number: str) -> BankPaymentRequest:
+    return BankPaymentRequest(card_number=card_number, expiry_date="12/2036", currency="GBP", amount=100, cvv="345")
+
+
+class TestBankBatcher:
+    @pytest.mark.asyncio
+    async def test_concurrent_payments_are_sent_in_one_batch(self):
+        batches = []
+        async with batch_client(batches) as http_client:
+            client = BankClient(http_client, batcher=BankBatcher(http_client, max_size=50, window=0.01))
+            results = await asyncio.gather(*(client.process_payment(bank_payment(f"0000123{digit}"))
+                                             for digit in "1234"))
+
+        assert len(batches) == 1
+        assert batches[0][0] == "/payments/batch"
+        assert [payment["card_number"] for payment in batches[0][1]] == ["00001231", "00001232", "00001233",
+                                                                         "00001234"]
+        assert [result.authorized for result in results] == [True, False, True, False]
+        assert [result.authorization_code for result in results] == [
+            uuid.uuid5(uuid.NAMESPACE_OID, "1"), None, uuid.uuid5(uuid.NAMESPACE_OID, "3"), None]
+
+    @pytest.mark.asyncio
+    async def test_batch_is_flushed_at_max_size(self):
+        batches = []
+        async with batch_client(batches) as http_client:
+            client = BankClient(http_client, batcher=BankBatcher(http_client, max_size=2, window=60))
+            await asyncio.gather(*(client.process_payment(bank_payment("00001231")) for _ in range(4)))
+
+        assert [len(payments) for _, payments in batches] == [2, 2]
+
+    @pytest.mark.asyncio
+    async def test_each_payment_gets_its_own_error(self):
+        batches = []
+        async with batch_client(batches) as http_client:
+            client = BankClient(http_client, batcher=BankBatcher(http_client, max_size=50, window=0.01))
+            results = await asyncio.gather(client.process_payment(bank_payment("00001231")),
+                                           client.process_payment(bank_payment("00001230")),
+                                           return_exceptions=True)
+
+        assert results[0].authorized is True
+        assert isinstance(results[1], BankServerError)
+
+    @pytest.mark.asyncio
+    async def test_failed_batch_fails_every_payment(self):
+        batches = []
+        async with batch_client(batches, lambda payments: httpx.Response(503, json={})) as http_client:
+            client = BankClient(http_client, batcher=BankBatcher(http_client, max_size=50, window=0.01))
+            results = await asyncio.gather(*(client.process_payment(bank_payment("00001231")) for _ in range(3)),
+                                           return_exceptions=True)
+
+        assert len(batches) == 1
+        assert all(isinstance(result, BankServerError) for result in results)
+
+    @pytest.mark.asyncio
+    async def test_result_count_mismatch(self):
+        batches = []
+        async with batch_client(batches, lambda payments: httpx.Response(200, json=[])) as http_client:
+            client = BankClient(http_client, batcher=BankBatcher(http_client, max_size=50, window=0.01))
+            with pytest.raises(PaymentServerError):
+                await client.process_payment(bank_payment("00001231"))
+
+    @pytest.mark.asyncio
+    async def test_cancelled_payment_is_not_sent(self):
+        batches = []
+        async with batch_client(batches) as http_client:
+            batcher = BankBatcher(http_client, max_size=50, window=0.01)
+            client = BankClient(http_client, batcher=batcher)
+            cancelled = asyncio.create_task(client.process_payment(bank_payment("00001232")))
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            result = await client.process_payment(bank_payment("00001231"))
+            await batcher.close()
+
+        assert result.authorized is True
+        assert [payment["card_number"] for payment in batches[0][1]] == ["00001231"]
@@ -1,11 +1,15 @@
+import asyncio
 import uuid
 from unittest.mock import Mock, AsyncMock, patch
 
 import httpx
 import pytest
 
-from payment_gateway_api.clients import BankClient
+from payment_gateway_api.breakers import CircuitBreaker
+from payment_gateway_api.clients import BankClient, create_http_client
+from payment_gateway_api.exceptions import BankServerError
 from payment_gateway_api.models import BankPaymentRequest
+from payment_gateway_api.retries import RetryPolicy, RetryBudget
 
 
 class TestBankClient:
@@ -22,15 +26,10 @@ class TestBankClient:
         mock_client = AsyncMock(spec=httpx.AsyncClient)
         mock_client.post.return_value = mock_response
 
-        mock_client.__aenter__.return_value = mock_client
-        mock_client.__aexit__.return_value = None
-
-        with patch('payment_gateway_api.settings.payment_settings.bank_url') as _, \
-            patch('payment_gateway_api.settings.payment_settings.bank_timeout') as _, \
-            patch('httpx.AsyncClient', return_value=mock_client):
+        with patch('payment_gateway_api.settings.payment_settings.bank_url') as _:
             payment = BankPaymentRequest(card_number="00001234", expiry_date="12/2036",
                                          currency="GBP", amount=100, cvv="345")
-            client = BankClient()
+            client = BankClient(mock_client)
             response = await client.process_payment(payment)
 
             assert response is not None
@@ -50,16 +49,11 @@ class TestBankClient:
         mock_client = AsyncMock(spec=httpx.AsyncClient)
         mock_client.post.return_value = mock_response
 
-        mock_client.__aenter__.return_value = mock_client
-        mock_client.__aexit__.return_value = None
-
         with patch('payment_gateway_api.settings.payment_settings.bank_url') as _, \
-            patch('payment_gateway_api.settings.payment_settings.bank_timeout') as _, \
-            patch('httpx.AsyncClient', return_value=mock_client), \
             pytest.raises(Exception) as ex_info:
             payment = BankPaymentRequest(card_number="00001234", expiry_date="12/2036",
                                          currency="GBP", amount=100, cvv="345")
-            client = BankClient()
+            client = BankClient(mock_client)
             await client.process_payment(payment)
 
             assert str(ex_info.value) == expected_message
@@ -70,17 +64,67 @@ class TestBankClient:
         mock_client = AsyncMock(spec=httpx.AsyncClient)
         mock_client.post.side_effect = httpx.RequestError("Network error")  # diff
 
-        mock_client.__aenter__.return_value = mock_client
-        mock_client.__aexit__.return_value = None
-
         with patch('payment_gateway_api.settings.payment_settings.bank_url') as _, \
-            patch('payment_gateway_api.settings.payment_settings.bank_timeout') as _, \
-            patch('httpx.AsyncClient', return_value=mock_client), \
             pytest.raises(Exception) as ex_info:
             payment = BankPaymentRequest(card_number="00001234", expiry_date="12/2036",
                                          currency="GBP", amount=100, cvv="345")
-            client = BankClient()
+            client = BankClient(mock_client)
             await client.process_payment(payment)
 
             assert str(ex_info.value) == "Request error: Network error"
             assert mock_client.post.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_create_http_client(self):
+        with patch('payment_gateway_api.settings.payment_settings.bank_max_connections', 7), \
+            patch('payment_gateway_api.settings.payment_settings.bank_max_keepalive_connections', 3):
+            async with create_http_client() as http_client:
+                pool = http_client._transport._pool
+                assert pool._max_connections == 7
+                assert pool._max_keepalive_connections == 3
+
+    @pytest.mark.asyncio
+    async def test_process_payment_reuses_client(self):
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {"authorized": True, "authorization_code": uuid.uuid4()}
+
+        mock_client = AsyncMock(spec=httpx.AsyncClient)
+        mock_client.post.return_value = mock_response
+
+        payment = BankPaymentRequest(card_number="00001234", expiry_date="12/2036",
+                                     currency="GBP", amount=100, cvv="345")
+        client = BankClient(mock_client)
+        await client.process_payment(payment)
+        await client.process_payment(payment)
+
+        assert mock_client.post.call_count == 2
+        assert mock_client.aclose.call_count == 0
+
+    @pytest.mark.asyncio
+    async def test_only_the_retry_deadline_counts_against_the_breaker(self):
+        async def hang(*args, **kwargs):
+            await asyncio.sleep(10)
+
+        mock_client = AsyncMock(spec=httpx.AsyncClient)
+        mock_client.post.side_effect = hang
+        breaker = CircuitBreaker(window_size=4, minimum_calls=4, failure_rate_threshold=0.5,
+                                 slow_call_rate_threshold=1.0, slow_call_duration=60.0, open_duration=10.0,
+                                 half_open_calls=1)
+        policy = RetryPolicy(max_retries=0, base_delay=0.001, max_delay=0.01, deadline=0.05,
+                             budget=RetryBudget(ratio=0.2, capacity=10))
+        client = BankClient(mock_client, policy, breaker, bank_url="http://bank.test")
+        payment = BankPaymentRequest(card_number="00001234", expiry_date="12/2036",
+                                     currency="GBP", amount=100, cvv="345")
+
+        with pytest.raises(BankServerError):
+            await client.process_payment(payment)
+        assert (breaker.calls, breaker.failure_rate) == (1, 1.0)
+
+        # the caller going away is not the bank's fault
+        task = asyncio.create_task(client.process_payment(payment))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert breaker.calls == 1
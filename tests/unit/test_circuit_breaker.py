@@ -0,0 +1,142 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+
+from payment_gateway_api.breakers import CircuitBreaker, CircuitState
+from payment_gateway_api.exceptions import BankServerError, BankCircuitOpenError, PaymentServerError
+from payment_gateway_api.models import BankPaymentResponse
+
+
+def new_breaker(clock, window_size=4, minimum_calls=4, half_open_calls=2):
+    return CircuitBreaker(window_size=window_size, minimum_calls=minimum_calls, failure_rate_threshold=0.5,
+                          slow_call_rate_threshold=0.5, slow_call_duration=1.0, open_duration=10.0,
+                          half_open_calls=half_open_calls, clock=clock)
+
+
+async def succeed(breaker):
+    return await breaker.call(AsyncMock(return_value=BankPaymentResponse(authorized=True, authorization_code=None)))
+
+
+async def fail(breaker):
+    with pytest.raises(BankServerError):
+        await breaker.call(AsyncMock(side_effect=BankServerError("Downstream error")))
+
+
+class TestCircuitBreaker:
+    @pytest.mark.asyncio
+    async def test_stays_closed_below_threshold(self, clock):
+        breaker = new_breaker(clock)
+        await succeed(breaker)
+        await succeed(breaker)
+        await succeed(breaker)
+        await fail(breaker)
+        assert breaker.state == CircuitState.CLOSED
+        assert breaker.failure_rate == 0.25
+
+    @pytest.mark.asyncio
+    async def test_opens_on_failure_rate(self, clock):
+        breaker = new_breaker(clock)
+        await succeed(breaker)
+        await succeed(breaker)
+        await fail(breaker)
+        await fail(breaker)
+        assert breaker.state == CircuitState.OPEN
+
+        attempt = AsyncMock()
+        with pytest.raises(BankCircuitOpenError) as ex_info:
+            await breaker.call(attempt)
+        assert attempt.call_count == 0
+        assert str(ex_info.value) == "Downstream bank server is unavailable, please retry later."
+
+    @pytest.mark.asyncio
+    async def test_opens_on_slow_calls(self, clock):
+        breaker = new_breaker(clock)
+
+        async def slow():
+            clock.now += 2
+            return BankPaymentResponse(authorized=True, authorization_code=None)
+
+        await succeed(breaker)
+        await succeed(breaker)
+        await breaker.call(slow)
+        await breaker.call(slow)
+        assert breaker.state == CircuitState.OPEN
+
+    @pytest.mark.asyncio
+    async def test_window_slides(self, clock):
+        breaker = new_breaker(clock, window_size=4, minimum_calls=4)
+        await fail(breaker)
+        for _ in range(4):
+            await succeed(breaker)
+        assert breaker.calls == 4
+        assert breaker.failure_rate == 0
+
+    @pytest.mark.asyncio
+    async def test_client_error_is_not_failure(self, clock):
+        breaker = new_breaker(clock)
+        for _ in range(4):
+            with pytest.raises(PaymentServerError):
+                await breaker.call(AsyncMock(side_effect=PaymentServerError("Internal server error")))
+        assert breaker.state == CircuitState.CLOSED
+
+    @pytest.mark.asyncio
+    async def test_half_open_probes_close(self, clock):
+        breaker = new_breaker(clock)
+        for _ in range(4):
+            await fail(breaker)
+        clock.now += 10
+        assert breaker.state == CircuitState.HALF_OPEN
+        await succeed(breaker)
+        await succeed(breaker)
+        assert breaker.state == CircuitState.CLOSED
+        assert breaker.calls == 0
+
+    @pytest.mark.asyncio
+    async def test_half_open_probe_failure_reopens(self, clock):
+        breaker = new_breaker(clock)
+        for _ in range(4):
+            await fail(breaker)
+        clock.now += 10
+        await fail(breaker)
+        assert breaker.state == CircuitState.OPEN
+
+    @pytest.mark.asyncio
+    async def test_half_open_limits_probes(self, clock):
+        breaker = new_breaker(clock, half_open_calls=1)
+        for _ in range(4):
+            await fail(breaker)
+        clock.now += 10
+
+        async def probe():
+            with pytest.raises(BankCircuitOpenError):
+                await breaker.call(AsyncMock())
+            return BankPaymentResponse(authorized=True, authorization_code=None)
+
+        # a second call while the only probe is in flight is rejected
+        await breaker.call(probe)
+        assert breaker.state == CircuitState.CLOSED
+
+    @pytest.mark.asyncio
+    async def test_deadline_is_failure(self, clock):
+        breaker = new_breaker(clock)
+        for _ in range(2):
+            with pytest.raises(TimeoutError):
+                await breaker.call(AsyncMock(side_effect=TimeoutError()))
+        assert breaker.failure_rate == 1.0
+
+    @pytest.mark.asyncio
+    async def test_cancelled_call_has_no_outcome(self, clock):
+        breaker = new_breaker(clock, half_open_calls=1)
+        for _ in range(4):
+            await fail(breaker)
+        clock.now += 10
+        # the only probe is cancelled by its caller, the slot goes to the next call
+        probe = asyncio.create_task(breaker.call(lambda: asyncio.sleep(10)))
+        await asyncio.sleep(0)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert breaker.state == CircuitState.HALF_OPEN
+        await succeed(breaker)
+        assert breaker.state == CircuitState.CLOSED
@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+from payment_gateway_api.exceptions import BankServerError, OverloadedError
+from payment_gateway_api.limiters import ConcurrencyLimiter, AdaptiveConcurrencyLimiter
+
+
+async def hold(limiter: ConcurrencyLimiter, release: asyncio.Event) -> None:
+    async with limiter.acquire():
+        await release.wait()
+
+
+def adaptive(initial_limit: int = 10) -> AdaptiveConcurrencyLimiter:
+    return AdaptiveConcurrencyLimiter("test", initial_limit=initial_limit, min_limit=2, max_limit=100,
+                                      queue_size=10, queue_timeout=1.0, tolerance=2.0, smoothing=1.0)
+
+
+class TestConcurrencyLimiter:
+    @pytest.mark.asyncio
+    async def test_queued_request_runs_when_a_slot_frees(self):
+        limiter = ConcurrencyLimiter("test", limit=1, queue_size=1, queue_timeout=1.0)
+        release = asyncio.Event()
+        first = asyncio.create_task(hold(limiter, release))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(hold(limiter, release))
+        await asyncio.sleep(0)
+
+        assert limiter.in_flight == 1
+        assert limiter.queued == 1
+        release.set()
+        await asyncio.gather(first, second)
+        assert limiter.in_flight == 0
+        assert limiter.queued == 0
+
+    @pytest.mark.asyncio
+    async def test_full_queue_is_rejected_at_once(self):
+        limiter = ConcurrencyLimiter("test", limit=1, queue_size=1, queue_timeout=1.0)
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold(limiter, release)) for _ in range(2)]
+        await asyncio.sleep(0)
+
+        with pytest.raises(OverloadedError):
+            async with limiter.acquire():
+                pass
+        release.set()
+        await asyncio.gather(*tasks)
+
+    @pytest.mark.asyncio
+    async def test_queue_timeout(self):
+        limiter = ConcurrencyLimiter("test", limit=1, queue_size=1, queue_timeout=0.01)
+        release = asyncio.Event()
+        task = asyncio.create_task(hold(limiter, release))
+        await asyncio.sleep(0)
+
+        with pytest.raises(OverloadedError):
+            async with limiter.acquire():
+                pass
+        assert limiter.queued == 0
+        release.set()
+        await task
+        assert limiter.in_flight == 0
+
+    @pytest.mark.asyncio
+    async def test_cancelled_waiter_gives_up_its_place(self):
+        limiter = ConcurrencyLimiter("test", limit=1, queue_size=1, queue_timeout=1.0)
+        release = asyncio.Event()
+        task = asyncio.create_task(hold(limiter, release))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(hold(limiter, release))
+        await asyncio.sleep(0)
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert limiter.queued == 0
+        release.set()
+        await task
+        assert limiter.in_flight == 0
+
+
+class TestAdaptiveConcurrencyLimiter:
+    def test_limit_grows_while_latency_is_stable(self):
+        limiter = adaptive()
+        limiter._in_flight = 9
+        for _ in range(5):
+            limiter._on_sample(0.01, False)
+        assert limiter.limit > 10
+
+    def test_limit_shrinks_when_latency_rises(self):
+        limiter = adaptive(50)
+        limiter._on_sample(0.01, False)
+        limiter._on_sample(0.1, False)
+        assert limiter.limit < 50
+
+    def test_limit_shrinks_on_bank_error(self):
+        limiter = adaptive(50)
+        limiter._on_sample(0.01, True)
+        assert limiter.limit == 45
+
+    def test_limit_is_bounded(self):
+        limiter = adaptive()
+        for _ in range(100):
+            limiter._on_sample(0.01, True)
+        assert limiter.limit == 2
+
+    @pytest.mark.asyncio
+    async def test_bank_error_is_a_drop(self):
+        limiter = adaptive(50)
+        with pytest.raises(BankServerError):
+            async with limiter.acquire():
+                raise BankServerError("unavailable")
+        assert limiter.limit == 45
+        assert limiter.in_flight == 0
@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+
+from payment_gateway_api.exceptions import BankServerError
+from payment_gateway_api.hedging import HedgePolicy, LatencyTracker, hedges_fired_total, hedges_won_total
+from payment_gateway_api.retries import RetryBudget
+
+
+def warm_tracker(latency: float = 0.01) -> LatencyTracker:
+    tracker = LatencyTracker(window=10, percentile=0.9, min_samples=10)
+    for _ in range(10):
+        tracker.observe(latency)
+    return tracker
+
+
+class TestLatencyTracker:
+    def test_no_threshold_before_min_samples(self):
+        tracker = LatencyTracker(window=100, percentile=0.95, min_samples=10)
+        for _ in range(9):
+            tracker.observe(0.01)
+        assert tracker.threshold is None
+
+    def test_threshold_is_the_percentile(self):
+        tracker = LatencyTracker(window=100, percentile=0.9, min_samples=10)
+        for latency in range(1, 101):
+            tracker.observe(latency / 1000)
+        assert tracker.threshold == pytest.approx(0.091)
+
+
+class TestHedgePolicy:
+    @pytest.mark.asyncio
+    async def test_fast_call_is_not_hedged(self):
+        calls = []
+
+        async def attempt():
+            calls.append(1)
+            return "ok"
+
+        policy = HedgePolicy(warm_tracker(), RetryBudget(ratio=1, capacity=10))
+
+        assert await policy.call(attempt) == "ok"
+        assert len(calls) == 1
+
+    @pytest.mark.asyncio
+    async def test_slow_call_is_hedged_and_loser_cancelled(self):
+        cancelled = []
+        calls = 0
+
+        async def attempt():
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.append(1)
+                    raise
+            return calls
+
+        fired, won = hedges_fired_total.value, hedges_won_total.value
+        policy = HedgePolicy(warm_tracker(0.01), RetryBudget(ratio=1, capacity=10))
+
+        assert await policy.call(attempt) == 2
+        await asyncio.sleep(0)
+        assert cancelled == [1]
+        assert hedges_fired_total.value == fired + 1
+        assert hedges_won_total.value == won + 1
+
+    @pytest.mark.asyncio
+    async def test_first_attempt_can_still_win(self):
+        calls = 0
+
+        async def attempt():
+            nonlocal calls
+            calls += 1
+            number = calls
+            await asyncio.sleep(0.03 if number == 1 else 10)
+            return number
+
+        policy = HedgePolicy(warm_tracker(0.01), RetryBudget(ratio=1, capacity=10))
+
+        assert await policy.call(attempt) == 1
+        assert calls == 2
+
+    @pytest.mark.asyncio
+    async def test_hedges_are_capped_by_the_budget(self):
+        calls = 0
+
+        async def attempt():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.02)
+            return "ok"
+
+        # the deposit of one call is not worth a hedge
+        policy = HedgePolicy(warm_tracker(0.001), RetryBudget(ratio=0.05, capacity=0))
+
+        assert await policy.call(attempt) == "ok"
+        assert calls == 1
+
+    @pytest.mark.asyncio
+    async def test_failed_attempt_waits_for_the_other(self):
+        calls = 0
+
+        async def attempt():
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                await asyncio.sleep(0.02)
+                raise BankServerError("unavailable")
+            await asyncio.sleep(0.05)
+            return "ok"
+
+        policy = HedgePolicy(warm_tracker(0.01), RetryBudget(ratio=1, capacity=10))
+
+        assert await policy.call(attempt) == "ok"
+
+    @pytest.mark.asyncio
+    async def test_raises_when_both_attempts_fail(self):
+        async def attempt():
+            await asyncio.sleep(0.02)
+            raise BankServerError("unavailable")
+
+        policy = HedgePolicy(warm_tracker(0.01), RetryBudget(ratio=1, capacity=10))
+
+        with pytest.raises(BankServerError):
+            await policy.call(attempt)
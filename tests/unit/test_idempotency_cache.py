@@ -0,0 +1,83 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+
+from payment_gateway_api.exceptions import IdempotencyKeyMismatchError, BankServerError
+from payment_gateway_api.idempotency import IdempotencyCache
+
+
+class TestIdempotencyCache:
+    @pytest.mark.asyncio
+    async def test_replay_completed(self, new_payment):
+        cache = IdempotencyCache(max_keys=10, ttl=60)
+        produce = AsyncMock(return_value=new_payment())
+        first = await cache.run("key", b"body", produce)
+        second = await cache.run("key", b"body", produce)
+        assert first == second
+        assert produce.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_keys_are_per_merchant(self, new_payment):
+        cache = IdempotencyCache(max_keys=10, ttl=60)
+        first = await cache.run("key", b"body", AsyncMock(return_value=new_payment()), "merchant-1")
+        second = await cache.run("key", b"other body", AsyncMock(return_value=new_payment()), "merchant-2")
+        assert first != second
+        assert await cache.run("key", b"body", AsyncMock(), "merchant-1") == first
+
+    @pytest.mark.asyncio
+    async def test_concurrent_in_flight(self, new_payment):
+        cache = IdempotencyCache(max_keys=10, ttl=60)
+        release = asyncio.Event()
+        calls = 0
+
+        async def produce():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return new_payment()
+
+        tasks = [asyncio.create_task(cache.run("key", b"body", produce)) for _ in range(5)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks)
+        assert calls == 1
+        assert len({result.id for result in results}) == 1
+
+    @pytest.mark.asyncio
+    async def test_mismatch(self, new_payment):
+        cache = IdempotencyCache(max_keys=10, ttl=60)
+        await cache.run("key", b"body", AsyncMock(return_value=new_payment()))
+        with pytest.raises(IdempotencyKeyMismatchError) as ex_info:
+            await cache.run("key", b"other body", AsyncMock(return_value=new_payment()))
+        assert str(ex_info.value) == "Idempotency-Key key was already used with a different payment."
+
+    @pytest.mark.asyncio
+    async def test_failure_not_cached(self, new_payment):
+        cache = IdempotencyCache(max_keys=10, ttl=60)
+        with pytest.raises(BankServerError):
+            await cache.run("key", b"body", AsyncMock(side_effect=BankServerError("Downstream error")))
+        produce = AsyncMock(return_value=new_payment())
+        await cache.run("key", b"body", produce)
+        assert produce.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_ttl_eviction(self, clock, new_payment):
+        cache = IdempotencyCache(max_keys=10, ttl=60, clock=clock)
+        produce = AsyncMock(side_effect=lambda: new_payment())
+        await cache.run("key", b"body", produce)
+        clock.now += 61
+        await cache.run("other", b"body", produce)
+        assert len(cache) == 1
+        await cache.run("key", b"body", produce)
+        assert produce.call_count == 3
+
+    @pytest.mark.asyncio
+    async def test_max_keys(self, new_payment):
+        cache = IdempotencyCache(max_keys=2, ttl=60)
+        produce = AsyncMock(side_effect=lambda: new_payment())
+        for key in ("a", "b", "c"):
+            await cache.run(key, b"body", produce)
+        assert len(cache) == 2
+        await cache.run("a", b"body", produce)
+        assert produce.call_count == 4
@@ -0,0 +1,102 @@
+import json
+import logging
+import threading
+
+import pytest
+
+from payment_gateway_api.logs import JsonFormatter, LogQueue, mask_card_numbers, correlation_id, debug_sampled, \
+    dropped_total
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.threads = []
+
+    def emit(self, record):
+        self.records.append(record)
+        self.threads.append(threading.current_thread().name)
+
+
+@pytest.fixture
+def test_logger():
+    logger = logging.getLogger("test_logs")
+    handler = RecordingHandler()
+    logger.handlers[:] = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    yield logger, handler
+    logger.handlers.clear()
+
+
+def start_queue(monkeypatch, max_size=100):
+    monkeypatch.setattr("payment_gateway_api.logs.QUEUED_LOGGERS", ("test_logs",))
+    log_queue = LogQueue(max_size)
+    log_queue.start()
+    return log_queue
+
+
+class TestMasking:
+    @pytest.mark.parametrize("text, masked", [
+        ("card 4111111111111111 declined", "card ************1111 declined"),
+        ("12345678901234567890", "12345678901234567890"),
+        ("amount 123456, id 0c9e3f1a-93f4-4d8e-a5b1-123456789012", "amount 123456, id 0c9e3f1a-93f4-4d8e-a5b1-123456789012"),
+    ])
+    def test_mask_card_numbers(self, text, masked):
+        assert mask_card_numbers(text) == masked
+
+    def test_json_formatter(self):
+        record = logging.makeLogRecord({"name": "bank", "levelno": logging.ERROR, "levelname": "ERROR",
+                                        "msg": "Client error %d : %s", "args": (400, "card 12345678901111"),
+                                        "correlation_id": "abc", "acquirer": "primary"})
+        entry = json.loads(JsonFormatter().format(record))
+        assert entry["message"] == "Client error 400 : card **********1111"
+        assert entry["level"] == "ERROR"
+        assert entry["logger"] == "bank"
+        assert entry["correlation_id"] == "abc"
+        assert entry["acquirer"] == "primary"
+
+
+class TestLogQueue:
+    def test_records_are_written_by_the_log_thread(self, test_logger, monkeypatch):
+        logger, handler = test_logger
+        log_queue = start_queue(monkeypatch)
+        token = correlation_id.set("request-1")
+        try:
+            logger.info("queued")
+        finally:
+            correlation_id.reset(token)
+        log_queue.stop()
+
+        assert [record.getMessage() for record in handler.records] == ["queued"]
+        assert handler.records[0].correlation_id == "request-1"
+        assert handler.threads == ["log-writer"]
+        # the original handlers are back once stopped
+        assert handler in logger.handlers
+        logger.info("direct")
+        assert handler.threads[-1] == threading.current_thread().name
+
+    def test_debug_lines_of_unsampled_requests_are_dropped(self, test_logger, monkeypatch):
+        logger, handler = test_logger
+        log_queue = start_queue(monkeypatch)
+        token = debug_sampled.set(False)
+        try:
+            logger.debug("dropped")
+            logger.warning("kept")
+        finally:
+            debug_sampled.reset(token)
+        log_queue.stop()
+        assert [record.getMessage() for record in handler.records] == ["kept"]
+
+    def test_full_queue_drops_records(self, test_logger, monkeypatch):
+        logger, handler = test_logger
+        block = threading.Event()
+        handler.emit = lambda record: block.wait()
+        log_queue = start_queue(monkeypatch, max_size=1)
+        dropped = dropped_total.value
+        for _ in range(5):
+            logger.info("flood")
+        block.set()
+        log_queue.stop()
+        assert dropped_total.value - dropped >= 3
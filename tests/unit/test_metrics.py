@@ -0,0 +1,57 @@
+from payment_gateway_api.metrics import Counter, Histogram, Gauge, MetricsRegistry
+
+
+class TestMetrics:
+    def test_counter(self):
+        counter = Counter("payments_total", "Payments.")
+        counter.inc()
+        counter.inc(2)
+        assert list(counter.render()) == [
+            "# HELP payments_total Payments.",
+            "# TYPE payments_total counter",
+            "payments_total 3.0",
+        ]
+
+    def test_counter_labels(self):
+        counter = Counter("rejected_total", "Rejected.", ("rule",))
+        counter.labels("amount").inc()
+        counter.labels("cvv").inc()
+        counter.labels("amount").inc()
+        assert list(counter.render())[2:] == [
+            'rejected_total{rule="amount"} 2.0',
+            'rejected_total{rule="cvv"} 1.0',
+        ]
+
+    def test_histogram(self):
+        histogram = Histogram("latency_seconds", "Latency.", ("outcome",), buckets=(0.1, 1.0))
+        series = histogram.labels("authorized")
+        for value in (0.05, 0.1, 0.5, 5.0):
+            series.observe(value)
+        assert list(histogram.render())[2:] == [
+            'latency_seconds_bucket{outcome="authorized",le="0.1"} 2',
+            'latency_seconds_bucket{outcome="authorized",le="1.0"} 3',
+            'latency_seconds_bucket{outcome="authorized",le="+Inf"} 4',
+            'latency_seconds_sum{outcome="authorized"} 5.65',
+            'latency_seconds_count{outcome="authorized"} 4',
+        ]
+
+    def test_gauge(self):
+        size = 0
+        gauge = Gauge("size", "Size.", lambda: size)
+        size = 7
+        assert list(gauge.render())[2] == "size 7.0"
+
+    def test_labelled_gauge(self):
+        registry = MetricsRegistry()
+        gauge = registry.gauge("state", "State.", label_names=("acquirer",))
+        gauge.labels("a", read=lambda: 0)
+        gauge.labels("b", read=lambda: 1)
+        # registered again by a new lifespan, the series are kept and replaced one by one
+        assert registry.gauge("state", "State.", label_names=("acquirer",)) is gauge
+        gauge.labels("a", read=lambda: 2)
+        assert list(gauge.render())[2:] == ['state{acquirer="a"} 2.0', 'state{acquirer="b"} 1.0']
+
+    def test_registry_returns_existing(self):
+        registry = MetricsRegistry()
+        assert registry.counter("a_total", "A.") is registry.counter("a_total", "A.")
+        assert registry.histogram("b_seconds", "B.") is registry.histogram("b_seconds", "B.")
@@ -0,0 +1,77 @@
+import os
+
+from payment_gateway_api.journals import PaymentJournal
+
+
+def open_journal(path, segment_size=1 << 20, compact_segments=2):
+    # records of a 2 byte key and a 5 byte value
+    journal = PaymentJournal(str(path), key_size=2, record_size=7, segment_size=segment_size,
+                             compact_segments=compact_segments)
+    return journal, journal.open()
+
+
+def segments(path):
+    return sorted(name for name in os.listdir(path) if name.endswith(".journal"))
+
+
+class TestPaymentJournal:
+    def test_replays_the_latest_value_of_each_key(self, tmp_path):
+        journal, records = open_journal(tmp_path)
+        assert records == {}
+        journal.append([b"k1first", b"k2secon"])
+        journal.append([b"k1third"])
+        journal.close()
+
+        journal, records = open_journal(tmp_path)
+        assert records == {b"k1": b"third", b"k2": b"secon"}
+        journal.close()
+
+    def test_torn_record_is_cut_off(self, tmp_path):
+        journal, _ = open_journal(tmp_path)
+        journal.append([b"k1first", b"k2secon"])
+        journal.close()
+        last = tmp_path / segments(tmp_path)[-1]
+        size = last.stat().st_size
+        # a crash in the middle of a write
+        with open(last, "ab") as file:
+            file.write(b"\x10\x00\x00\x00\x01\x02")
+
+        journal, records = open_journal(tmp_path)
+        assert records == {b"k1": b"first", b"k2": b"secon"}
+        assert last.stat().st_size == size
+        journal.append([b"k3third"])
+        journal.close()
+        assert open_journal(tmp_path)[1] == {b"k1": b"first", b"k2": b"secon", b"k3": b"third"}
+
+    def test_corrupt_record_is_skipped_with_the_rest_of_its_segment(self, tmp_path):
+        journal, _ = open_journal(tmp_path)
+        journal.append([b"k1first"])
+        journal.append([b"k2secon"])
+        journal.close()
+        journal, _ = open_journal(tmp_path)
+        journal.append([b"k3third"])
+        journal.close()
+        first = tmp_path / segments(tmp_path)[0]
+        data = bytearray(first.read_bytes())
+        data[-1] ^= 0xff
+        first.write_bytes(data)
+
+        journal, records = open_journal(tmp_path)
+        assert records == {b"k1": b"first", b"k3": b"third"}
+        journal.close()
+
+    def test_rotation_and_compaction(self, tmp_path):
+        journal, _ = open_journal(tmp_path, segment_size=20)
+        assert journal.append([b"k1one__"]) is False
+        assert journal.append([b"k1two__"]) is True
+        assert journal.append([b"k2old__", b"k3new__"]) is True
+        assert journal.compactable
+        journal.compact(lambda value: value != b"old__")
+        assert not journal.compactable
+        # the compacted sealed segment and the active one
+        assert len(segments(tmp_path)) == 2
+        journal.close()
+
+        journal, records = open_journal(tmp_path)
+        assert records == {b"k1": b"two__", b"k3": b"new__"}
+        journal.close()
@@ -1,12 +1,18 @@
+import asyncio
 import uuid
-from unittest.mock import patch, AsyncMock
+from unittest.mock import patch, AsyncMock, Mock
 
 import pytest
 
 from payment_gateway_api.clients import BankClient
-from payment_gateway_api.exceptions import PaymentNotFoundError, BankServerError
+from payment_gateway_api.exceptions import PaymentNotFoundError, BankServerError, OverloadedError, \
+    IdempotencyKeyMismatchError
+from payment_gateway_api.idempotency import IdempotencyCache
+from payment_gateway_api.limiters import ConcurrencyLimiter
 from payment_gateway_api.models import PaymentResponse, PaymentStatus, BankPaymentResponse, PaymentRequest
 from payment_gateway_api.services import PaymentService
+from payment_gateway_api.webhooks import WebhookDispatcher
+from payment_gateway_api.workers import WorkerPool
 
 
 class TestPaymentService:
@@ -35,6 +41,19 @@ class TestPaymentService:
             assert mock_bank_client.process_payment.call_count == 1
             assert mock_repo_add.call_count == 1
 
+    @pytest.mark.asyncio
+    async def test_process_payment_notifies_the_merchant_webhook(self):
+        with patch('payment_gateway_api.repositories.repo.add'):
+            mock_bank_client = AsyncMock(spec=BankClient)
+            mock_bank_client.process_payment.return_value = BankPaymentResponse(
+                authorized=True, authorization_code=uuid.uuid4())
+            webhooks = Mock(spec=WebhookDispatcher)
+            service = PaymentService(mock_bank_client, webhooks=webhooks)
+            payment = PaymentRequest(card_number="00001234", expiry_month="12", expiry_year="2036",
+                                     currency="GBP", amount=100, cvv="345")
+            result = await service.process_payment(payment, merchant_id="merchant-1")
+            webhooks.notify.assert_called_once_with("merchant-1", result)
+
     @pytest.mark.asyncio
     async def test_process_payment_negative(self):
         with patch('payment_gateway_api.repositories.repo.add') as mock_repo_add:
@@ -48,18 +67,20 @@ class TestPaymentService:
                 assert mock_repo_add.call_count == 0
                 assert str(ex_info.value) == "Downstream error"
 
-    def test_get_payment_not_found(self):
+    @pytest.mark.asyncio
+    async def test_get_payment_not_found(self):
         with patch('payment_gateway_api.repositories.repo.get') as mock_repo_get:
             mock_repo_get.return_value = None
             mock_bank_client = AsyncMock(spec=BankClient)
             service = PaymentService(mock_bank_client)
             with pytest.raises(PaymentNotFoundError) as ex_info:
                 new_id = uuid.uuid4()
-                service.get_payment(new_id)
+                await service.get_payment(new_id)
                 assert mock_repo_get.call_count == 1
                 assert str(ex_info.value) == f"Payment with id {new_id} not found"
 
-    def test_get_payment_found(self):
+    @pytest.mark.asyncio
+    async def test_get_payment_found(self):
         with patch('payment_gateway_api.repositories.repo.get') as mock_repo_get:
             new_id = uuid.uuid4()
             payment = PaymentResponse(
@@ -73,6 +94,156 @@ class TestPaymentService:
             mock_repo_get.return_value = payment
             mock_bank_client = AsyncMock(spec=BankClient)
             service = PaymentService(mock_bank_client)
-            result = service.get_payment(new_id)
+            result = await service.get_payment(new_id)
             assert mock_repo_get.call_count == 1
             assert payment == result
+
+    @pytest.mark.asyncio
+    async def test_process_payment_idempotency_key(self):
+        with patch('payment_gateway_api.repositories.repo.add') as mock_repo_add:
+            mock_bank_client = AsyncMock(spec=BankClient)
+            mock_bank_client.process_payment.return_value = BankPaymentResponse(
+                authorized=True, authorization_code=uuid.uuid4())
+            service = PaymentService(mock_bank_client, IdempotencyCache(max_keys=10, ttl=60))
+            payment = PaymentRequest(card_number="00001234", expiry_month="12", expiry_year="2036",
+                                     currency="GBP", amount=100, cvv="345")
+            first = await service.process_payment(payment, "key")
+            second = await service.process_payment(payment, "key")
+            assert first.id == second.id
+            assert mock_bank_client.process_payment.call_count == 1
+            assert mock_repo_add.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_process_payments(self):
+        with patch('payment_gateway_api.repositories.repo.add') as mock_repo_add:
+            in_flight = 0
+            max_in_flight = 0
+
+            async def process_payment(bank_request):
+                nonlocal in_flight, max_in_flight
+                in_flight += 1
+                max_in_flight = max(max_in_flight, in_flight)
+                await asyncio.sleep(0.01)
+                in_flight -= 1
+                if bank_request.amount == 3:
+                    raise BankServerError("Downstream error")
+                return BankPaymentResponse(authorized=True, authorization_code=uuid.uuid4())
+
+            mock_bank_client = AsyncMock(spec=BankClient)
+            mock_bank_client.process_payment.side_effect = process_payment
+            service = PaymentService(mock_bank_client)
+            payments = [(index, PaymentRequest(card_number="00001234", expiry_month="12", expiry_year="2036",
+                                               currency="GBP", amount=index, cvv="345")) for index in range(1, 7)]
+            results = dict([result async for result in service.process_payments(payments, concurrency=2)])
+            assert sorted(results) == [1, 2, 3, 4, 5, 6]
+            assert isinstance(results[3], BankServerError)
+            assert results[5].status == PaymentStatus.AUTHORIZED
+            assert max_in_flight == 2
+            assert mock_repo_add.call_count == 5
+
+    @pytest.mark.asyncio
+    async def test_process_payments_take_the_limiter(self):
+        with patch('payment_gateway_api.repositories.repo.add') as mock_repo_add:
+            in_flight = 0
+            max_in_flight = 0
+
+            async def process_payment(bank_request):
+                nonlocal in_flight, max_in_flight
+                in_flight += 1
+                max_in_flight = max(max_in_flight, in_flight)
+                await asyncio.sleep(0.01)
+                in_flight -= 1
+                return BankPaymentResponse(authorized=True, authorization_code=uuid.uuid4())
+
+            mock_bank_client = AsyncMock(spec=BankClient)
+            mock_bank_client.process_payment.side_effect = process_payment
+            service = PaymentService(mock_bank_client)
+            # one payment runs and one waits, the others are refused as a single payment would be
+            limiter = ConcurrencyLimiter("test", limit=1, queue_size=1, queue_timeout=1.0)
+            payments = [(index, PaymentRequest(card_number="00001234", expiry_month="12", expiry_year="2036",
+                                               currency="GBP", amount=100, cvv="345")) for index in range(4)]
+            results = dict([result async for result in service.process_payments(payments, concurrency=4,
+                                                                                 limiter=limiter)])
+            assert [isinstance(results[index], OverloadedError) for index in range(4)] == [False, False, True, True]
+            assert max_in_flight == 1
+            assert mock_repo_add.call_count == 2
+
+
+class TestAsyncPayments:
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("bank_outcome, expected_status", [
+        (BankPaymentResponse(authorized=True, authorization_code=uuid.uuid4()), PaymentStatus.AUTHORIZED),
+        (BankServerError("Downstream error"), PaymentStatus.FAILED),
+        (ValueError("unexpected bank answer"), PaymentStatus.FAILED),
+    ])
+    async def test_accepted_payment_is_completed_by_a_worker(self, bank_outcome, expected_status):
+        with patch('payment_gateway_api.repositories.repo.add') as mock_repo_add, \
+                patch('payment_gateway_api.repositories.repo.update') as mock_repo_update:
+            mock_bank_client = AsyncMock(spec=BankClient)
+            if isinstance(bank_outcome, Exception):
+                mock_bank_client.process_payment.side_effect = bank_outcome
+            else:
+                mock_bank_client.process_payment.return_value = bank_outcome
+            pool = WorkerPool("test", workers=1, queue_size=10, drain_timeout=1.0)
+            pool.start()
+            webhooks = Mock(spec=WebhookDispatcher)
+            service = PaymentService(mock_bank_client, worker_pool=pool, webhooks=webhooks)
+            payment = PaymentRequest(card_number="00001234", expiry_month="12", expiry_year="2036",
+                                     currency="GBP", amount=100, cvv="345")
+
+            pending = await service.accept_payment(payment, merchant_id="merchant-1")
+            assert pending.status == PaymentStatus.PENDING
+            mock_repo_add.assert_awaited_once_with(pending, "merchant-1")
+            await pool.close()
+
+            completed = mock_repo_update.call_args.args[0]
+            assert completed.id == pending.id
+            assert completed.status == expected_status
+            webhooks.notify.assert_called_once_with("merchant-1", completed)
+
+    @pytest.mark.asyncio
+    async def test_idempotency_key_replay_returns_the_completed_payment(self):
+        with patch('payment_gateway_api.repositories.repo.add') as mock_repo_add, \
+                patch('payment_gateway_api.repositories.repo.get') as mock_repo_get:
+            mock_bank_client = AsyncMock(spec=BankClient)
+            mock_bank_client.process_payment.return_value = BankPaymentResponse(
+                authorized=True, authorization_code=uuid.uuid4())
+            pool = WorkerPool("test", workers=1, queue_size=10, drain_timeout=1.0)
+            pool.start()
+            service = PaymentService(mock_bank_client, IdempotencyCache(max_keys=10, ttl=60), worker_pool=pool)
+            payment = PaymentRequest(card_number="00001234", expiry_month="12", expiry_year="2036",
+                                     currency="GBP", amount=100, cvv="345")
+            pending = await service.accept_payment(payment, "key", "merchant-1")
+            await pool.close()
+            completed = pending.model_copy(update={"status": PaymentStatus.AUTHORIZED})
+            mock_repo_get.return_value = completed
+
+            assert await service.accept_payment(payment, "key", "merchant-1") == completed
+            mock_repo_get.assert_awaited_once_with(pending.id, "merchant-1")
+            assert mock_repo_add.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_idempotency_key_is_not_replayed_in_another_mode(self):
+        with patch('payment_gateway_api.repositories.repo.add'):
+            pool = WorkerPool("test", workers=1, queue_size=10, drain_timeout=1.0)
+            pool.start()
+            service = PaymentService(AsyncMock(spec=BankClient), IdempotencyCache(max_keys=10, ttl=60),
+                                     worker_pool=pool)
+            payment = PaymentRequest(card_number="00001234", expiry_month="12", expiry_year="2036",
+                                     currency="GBP", amount=100, cvv="345")
+            await service.accept_payment(payment, "key")
+            # a PENDING payment would otherwise be answered as created
+            with pytest.raises(IdempotencyKeyMismatchError):
+                await service.process_payment(payment, "key")
+            await pool.close()
+
+    @pytest.mark.asyncio
+    async def test_full_queue_stores_nothing(self):
+        with patch('payment_gateway_api.repositories.repo.add') as mock_repo_add:
+            pool = WorkerPool("test", workers=1, queue_size=0, drain_timeout=1.0)
+            service = PaymentService(AsyncMock(spec=BankClient), worker_pool=pool)
+            payment = PaymentRequest(card_number="00001234", expiry_month="12", expiry_year="2036",
+                                     currency="GBP", amount=100, cvv="345")
+            with pytest.raises(OverloadedError):
+                await service.accept_payment(payment)
+            assert mock_repo_add.call_count == 0
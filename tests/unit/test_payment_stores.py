@@ -0,0 +1,339 @@
+import asyncio
+import sqlite3
+import time
+import uuid
+from unittest.mock import patch
+
+import pytest
+
+from payment_gateway_api.models import PaymentStatus
+from payment_gateway_api.exceptions import PaymentServerError
+from payment_gateway_api.stores import MemoryPaymentStore, JournaledPaymentStore, SqlitePaymentStore, PaymentFilter, \
+    PaymentCursor
+
+
+class TestMemoryPaymentStore:
+    @pytest.mark.asyncio
+    async def test_add_get(self, new_payment):
+        store = MemoryPaymentStore(max_entries=10, ttl=60)
+        for payment in (new_payment(), new_payment(PaymentStatus.DECLINED, "1", 999999999999)):
+            await store.add(payment)
+            assert await store.get(payment.id) == payment
+
+    @pytest.mark.asyncio
+    async def test_get_not_found(self):
+        store = MemoryPaymentStore(max_entries=10, ttl=60)
+        assert await store.get(uuid.uuid4()) is None
+
+    @pytest.mark.asyncio
+    async def test_lru_eviction(self, new_payment):
+        store = MemoryPaymentStore(max_entries=2, ttl=60)
+        first, second, third = new_payment(), new_payment(), new_payment()
+        await store.add(first)
+        await store.add(second)
+        await store.get(first.id)
+        await store.add(third)
+        assert len(store) == 2
+        assert await store.get(first.id) == first
+        assert await store.get(second.id) is None
+        assert await store.get(third.id) == third
+
+    @pytest.mark.asyncio
+    async def test_ttl_expiry(self, new_payment):
+        store = MemoryPaymentStore(max_entries=10, ttl=60)
+        with patch('time.time', return_value=1000.0):
+            payment = new_payment()
+            await store.add(payment)
+        with patch('time.time', return_value=1059.0):
+            assert await store.get(payment.id) == payment
+        with patch('time.time', return_value=1060.0):
+            assert await store.get(payment.id) is None
+            assert len(store) == 0
+
+    @pytest.mark.asyncio
+    async def test_ttl_expiry_on_add(self, new_payment):
+        store = MemoryPaymentStore(max_entries=10, ttl=60)
+        with patch('time.time', return_value=1000.0):
+            await store.add(new_payment())
+        with patch('time.time', return_value=1100.0):
+            await store.add(new_payment())
+        assert len(store) == 1
+
+
+class TestSqlitePaymentStore:
+    @pytest.mark.asyncio
+    async def test_add_get(self, tmp_path, new_payment):
+        store = SqlitePaymentStore(str(tmp_path / "payments.db"), batch_size=10)
+        payment = new_payment(PaymentStatus.DECLINED, "1")
+        await store.add(payment)
+        assert await store.get(payment.id) == payment
+        assert await store.get(uuid.uuid4()) is None
+        await store.close()
+
+    @pytest.mark.asyncio
+    async def test_batched_writes(self, tmp_path, new_payment):
+        store = SqlitePaymentStore(str(tmp_path / "payments.db"), batch_size=3)
+        payments = [new_payment() for _ in range(10)]
+        with patch.object(store, '_insert', wraps=store._insert) as mock_insert:
+            await asyncio.gather(*(store.add(payment) for payment in payments))
+            assert mock_insert.call_count == 4
+        for payment in payments:
+            assert await store.get(payment.id) == payment
+        await store.close()
+
+    @pytest.mark.asyncio
+    async def test_shared_between_stores(self, tmp_path, new_payment):
+        path = str(tmp_path / "payments.db")
+        worker_a = SqlitePaymentStore(path, batch_size=10)
+        worker_b = SqlitePaymentStore(path, batch_size=10)
+        payment = new_payment()
+        await worker_a.add(payment)
+        assert await worker_b.get(payment.id) == payment
+        await worker_a.close()
+        await worker_b.close()
+
+    @pytest.mark.asyncio
+    async def test_failed_commit_is_rolled_back(self, tmp_path, new_payment, failing_commit):
+        store = SqlitePaymentStore(str(tmp_path / "payments.db"), batch_size=10)
+        await store.add(new_payment())
+        store._write_connection = failing_commit(store._write_connection)
+        lost, kept = new_payment(), new_payment()
+        with pytest.raises(PaymentServerError):
+            await store.add(lost)
+        # the connection is usable again
+        await store.add(kept)
+        assert await store.get(lost.id) is None
+        assert await store.get(kept.id) == kept
+        await store.close()
+
+    @pytest.mark.asyncio
+    async def test_reopen_after_close(self, tmp_path, new_payment):
+        path = str(tmp_path / "payments.db")
+        store = SqlitePaymentStore(path, batch_size=10)
+        payment = new_payment()
+        await store.add(payment)
+        await store.close()
+        reopened = SqlitePaymentStore(path, batch_size=10)
+        assert await reopened.get(payment.id) == payment
+        await reopened.close()
+
+
+class TestJournaledPaymentStore:
+    @staticmethod
+    async def open_store(path, ttl=86400, segment_size=1 << 20):
+        store = JournaledPaymentStore(max_entries=100, ttl=ttl, path=str(path), segment_size=segment_size,
+                                      compact_segments=2)
+        await store.open()
+        return store
+
+    @pytest.mark.asyncio
+    async def test_replayed_after_restart(self, tmp_path, new_payment):
+        store = await self.open_store(tmp_path)
+        first, second = new_payment(PaymentStatus.PENDING), new_payment(PaymentStatus.DECLINED, "1")
+        with patch('time.time', return_value=time.time() - 10):
+            await store.add(first)
+        await store.add(second)
+        updated = first.model_copy(update={"status": PaymentStatus.AUTHORIZED})
+        await store.update(updated)
+        await store.close()
+
+        reopened = await self.open_store(tmp_path)
+        assert len(reopened) == 2
+        assert await reopened.get(first.id) == updated
+        assert await reopened.get(second.id) == second
+        page = await reopened.scan(PaymentFilter(), None, 10)
+        assert [payment for _, payment in page] == [updated, second]
+        await reopened.close()
+
+    @pytest.mark.asyncio
+    async def test_group_commit(self, tmp_path, new_payment):
+        store = await self.open_store(tmp_path)
+        payments = [new_payment() for _ in range(10)]
+        with patch.object(store._journal, 'append', wraps=store._journal.append) as mock_append:
+            await asyncio.gather(*(store.add(payment) for payment in payments))
+        # one write and fsync for the payments added while none was in progress
+        assert mock_append.call_count == 1
+        for payment in payments:
+            assert await store.get(payment.id) == payment
+        await store.close()
+
+    @pytest.mark.asyncio
+    async def test_failed_append_is_not_stored(self, tmp_path, new_payment):
+        store = await self.open_store(tmp_path)
+        payment = new_payment()
+        with patch.object(store._journal, 'append', side_effect=OSError("disk full")):
+            with pytest.raises(PaymentServerError):
+                await store.add(payment)
+        assert await store.get(payment.id) is None
+        await store.close()
+
+    @pytest.mark.asyncio
+    async def test_journaled_payment_of_a_cancelled_caller_is_stored(self, tmp_path, new_payment):
+        store = await self.open_store(tmp_path)
+        payment = new_payment()
+        task = asyncio.create_task(store.add(payment))
+        await asyncio.sleep(0)
+        # cancelled while its group is being fsynced
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await store.close()
+        assert await store.get(payment.id) == payment
+
+    @pytest.mark.asyncio
+    async def test_expired_payments_are_not_replayed(self, tmp_path, new_payment):
+        store = await self.open_store(tmp_path, ttl=60)
+        expired, kept = new_payment(), new_payment()
+        with patch('time.time', return_value=time.time() - 61):
+            await store.add(expired)
+        await store.add(kept)
+        await store.close()
+
+        reopened = await self.open_store(tmp_path, ttl=60)
+        assert len(reopened) == 1
+        assert await reopened.get(kept.id) == kept
+        await reopened.close()
+
+    @pytest.mark.asyncio
+    async def test_rotated_segments_are_compacted(self, tmp_path, new_payment):
+        # every append fills a segment
+        store = await self.open_store(tmp_path, segment_size=1)
+        payment = new_payment(PaymentStatus.PENDING)
+        await store.add(payment)
+        for status in (PaymentStatus.AUTHORIZED, PaymentStatus.DECLINED):
+            payment = payment.model_copy(update={"status": status})
+            await store.update(payment)
+            if store._compact_task is not None:
+                await store._compact_task
+        await store.close()
+        assert len(list(tmp_path.iterdir())) <= 3
+
+        reopened = await self.open_store(tmp_path)
+        assert await reopened.get(payment.id) == payment
+        await reopened.close()
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def scan_store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryPaymentStore(max_entries=100, ttl=86400)
+    return SqlitePaymentStore(str(tmp_path / "payments.db"), batch_size=10)
+
+
+async def add_payments(store, new_payment):
+    # one payment a second from 1000, alternately authorized GBP and declined USD
+    payments = []
+    for i in range(10):
+        payment = new_payment(PaymentStatus.AUTHORIZED, currency="GBP") if i % 2 == 0 \
+            else new_payment(PaymentStatus.DECLINED, currency="USD")
+        with patch('time.time', return_value=1000.0 + i):
+            await store.add(payment)
+        payments.append(payment)
+    return payments
+
+
+class TestPaymentStoreScan:
+    @pytest.mark.asyncio
+    async def test_pages_in_creation_order(self, scan_store, new_payment):
+        store = scan_store
+        payments = await add_payments(store, new_payment)
+        listed = []
+        after = None
+        with patch('time.time', return_value=2000.0):
+            while page := await store.scan(PaymentFilter(), after, 3):
+                listed.extend(page)
+                after = PaymentCursor(page[-1][0], page[-1][1].id)
+        await store.close()
+        assert [payment for _, payment in listed] == payments
+        assert [created_at for created_at, _ in listed] == [1000.0 + i for i in range(10)]
+
+    @pytest.mark.asyncio
+    async def test_filters(self, scan_store, new_payment):
+        store = scan_store
+        payments = await add_payments(store, new_payment)
+        payment_filter = PaymentFilter(status=PaymentStatus.DECLINED, currency="USD", created_from=1003.0,
+                                       created_to=1007.0)
+        with patch('time.time', return_value=2000.0):
+            page = await store.scan(payment_filter, None, 10)
+        assert [payment for _, payment in page] == [payments[3], payments[5]]
+        with patch('time.time', return_value=2000.0):
+            assert await store.scan(PaymentFilter(currency="CNY"), None, 10) == []
+        await store.close()
+
+    @pytest.mark.asyncio
+    async def test_payments_of_a_merchant(self, scan_store, new_payment):
+        store = scan_store
+        mine, theirs = new_payment(PaymentStatus.PENDING), new_payment()
+        with patch('time.time', return_value=1000.0):
+            await store.add(mine, "merchant-1")
+            await store.add(theirs, "merchant-2")
+            # an update keeps the merchant of the payment
+            mine = mine.model_copy(update={"status": PaymentStatus.AUTHORIZED})
+            await store.update(mine)
+            assert await store.get(mine.id, "merchant-1") == mine
+            assert await store.get(mine.id, "merchant-2") is None
+            assert await store.get(mine.id) == mine
+            page = await store.scan(PaymentFilter(merchant_id="merchant-1"), None, 10)
+            assert [payment for _, payment in page] == [mine]
+            assert len(await store.scan(PaymentFilter(), None, 10)) == 2
+        await store.close()
+
+    @pytest.mark.asyncio
+    async def test_same_creation_time_is_ordered_by_id(self, new_payment):
+        store = MemoryPaymentStore(max_entries=100, ttl=86400)
+        payments = [new_payment() for _ in range(5)]
+        with patch('time.time', return_value=1000.0):
+            for payment in payments:
+                await store.add(payment)
+            first = await store.scan(PaymentFilter(), None, 2)
+            rest = await store.scan(PaymentFilter(), PaymentCursor(first[-1][0], first[-1][1].id), 10)
+        assert [payment.id for _, payment in first + rest] == sorted(payment.id for payment in payments)
+
+    def test_cursor_round_trip(self):
+        cursor = PaymentCursor(1000.25, uuid.uuid4())
+        assert PaymentCursor.decode(cursor.encode()) == cursor
+        with pytest.raises(ValueError):
+            PaymentCursor.decode("not-a-cursor")
+
+
+class TestPaymentStoreUpdate:
+    @pytest.mark.asyncio
+    async def test_update_keeps_the_creation_time(self, scan_store, new_payment):
+        store = scan_store
+        payment = new_payment(PaymentStatus.PENDING)
+        with patch('time.time', return_value=1000.0):
+            await store.add(payment)
+        updated = payment.model_copy(update={"status": PaymentStatus.AUTHORIZED})
+        with patch('time.time', return_value=1005.0):
+            await store.update(updated)
+            assert await store.get(payment.id) == updated
+            page = await store.scan(PaymentFilter(), None, 10)
+        assert page == [(1000.0, updated)]
+        assert len(store) == 1
+        await store.close()
+
+
+class TestMemoryPaymentStoreIndex:
+    @pytest.mark.asyncio
+    async def test_scan_skips_evicted_and_expired(self, new_payment):
+        store = MemoryPaymentStore(max_entries=3, ttl=60)
+        payments = [new_payment() for _ in range(5)]
+        for i, payment in enumerate(payments):
+            with patch('time.time', return_value=1000.0 + i * 10):
+                await store.add(payment)
+        with patch('time.time', return_value=1061.0):
+            page = await store.scan(PaymentFilter(), None, 10)
+        # the first two were evicted, the third created at 1020 expires at 1080
+        assert [payment for _, payment in page] == payments[2:]
+        with patch('time.time', return_value=1085.0):
+            page = await store.scan(PaymentFilter(), None, 10)
+        assert [payment for _, payment in page] == payments[3:]
+
+    @pytest.mark.asyncio
+    async def test_index_is_compacted(self, new_payment):
+        store = MemoryPaymentStore(max_entries=10, ttl=86400)
+        for _ in range(5000):
+            await store.add(new_payment())
+        assert len(store._index_keys) <= 2 * len(store) + 1024
+        with patch('time.time', return_value=time.time() + 1):
+            assert len(await store.scan(PaymentFilter(), None, 100)) == 10
@@ -1,10 +1,11 @@
 from datetime import datetime, timedelta
+from unittest.mock import patch
 
 import pytest
 
 from payment_gateway_api.exceptions import BusinessValidationError
 from payment_gateway_api.models import PaymentRequest
-from payment_gateway_api.validators import PaymentValidator
+from payment_gateway_api.validators import PaymentValidator, _CurrentMonth
 
 
 class TestPaymentValidator:
@@ -36,6 +37,44 @@ class TestPaymentValidator:
         validator = PaymentValidator()
         assert validator.validate_payment(payment) is None
 
+    def test_validate_payment_valid_fast_path(self):
+        payment = PaymentRequest(card_number='123456789012345', expiry_month='1', expiry_year='2036',
+                                 currency='GBP', amount=123, cvv='1234')
+        validator = PaymentValidator()
+        with patch.object(validator, '_validate_card_number') as mock_validate_card_number:
+            assert validator.validate_payment(payment) is None
+            assert mock_validate_card_number.call_count == 0
+
+    @pytest.mark.parametrize("card_number,expiry_month,expiry_year,cvv", [
+        ('123456789012345\n', '1', '2036', '1234'),
+        ('１２３４５６７８９０１２３４５', '1', '2036', '1234'),
+        ('123456789012345', '01', '2036', '1234'),
+        ('123456789012345', '1', '２０３６', '1234'),
+        ('123456789012345', '1', '2036', '123\n'),
+    ])
+    def test_validate_payment_not_ascii_digits(self, card_number, expiry_month, expiry_year, cvv):
+        payment = PaymentRequest(card_number=card_number, expiry_month=expiry_month, expiry_year=expiry_year,
+                                 currency='GBP', amount=123, cvv=cvv)
+        validator = PaymentValidator()
+        with pytest.raises(BusinessValidationError):
+            validator.validate_payment(payment)
+
+    def test_current_month_refresh(self):
+        current_month = _CurrentMonth()
+        with patch('payment_gateway_api.validators.datetime') as mock_datetime:
+            mock_datetime.side_effect = datetime
+            mock_datetime.now.return_value = datetime(2026, 12, 31, 23, 59)
+            current_month.refresh()
+            current_month.refresh()
+            assert mock_datetime.now.call_count == 1
+            assert (current_month.year, current_month.month) == ("2026", 12)
+
+            mock_datetime.now.return_value = datetime(2027, 1, 1)
+            with patch('time.time', return_value=datetime(2027, 1, 1).timestamp()):
+                current_month.refresh()
+            assert mock_datetime.now.call_count == 2
+            assert current_month.value == 2027 * 12 + 1
+
     @pytest.mark.parametrize("card_number,expected_message", [
         (None, "card_number must be a 14-19 length numeric."),
         ("abc", "card_number must be a 14-19 length numeric."),
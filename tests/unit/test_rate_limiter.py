@@ -0,0 +1,129 @@
+import sqlite3
+from unittest.mock import patch
+
+import pytest
+from pydantic import ValidationError
+
+from payment_gateway_api.ratelimits import MemoryRateLimiter, SqliteRateLimiter, create_api_keys
+from payment_gateway_api.settings import ApiKeySettings
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def limiter_factory(request, tmp_path):
+    limiters = []
+
+    def create(clock, sweep_interval: float = 60.0):
+        if request.param == "memory":
+            limiter = MemoryRateLimiter(sweep_interval, clock)
+        else:
+            limiter = SqliteRateLimiter(str(tmp_path / "ratelimits.db"), sweep_interval, clock)
+        limiters.append(limiter)
+        return limiter
+
+    yield create
+    for limiter in limiters:
+        if isinstance(limiter, SqliteRateLimiter):
+            limiter._close()
+            limiter._executor.shutdown()
+
+
+class TestRateLimiter:
+    @pytest.mark.asyncio
+    async def test_burst_then_rate(self, limiter_factory, clock):
+        limiter = limiter_factory(clock)
+        results = [await limiter.acquire("key-1", rate=10, burst=3) for _ in range(4)]
+
+        assert [result.allowed for result in results] == [True, True, True, False]
+        assert [result.remaining for result in results] == [2, 1, 0, 0]
+        assert results[0].limit == 3
+        assert results[2].reset_after == pytest.approx(0.3)
+        assert results[3].retry_after == pytest.approx(0.1)
+
+        # one interval later one more request is allowed
+        clock.now += 0.1
+        assert (await limiter.acquire("key-1", rate=10, burst=3)).allowed
+        assert not (await limiter.acquire("key-1", rate=10, burst=3)).allowed
+        # and the whole burst once it is refilled
+        clock.now += 0.3
+        assert (await limiter.acquire("key-1", rate=10, burst=3)).remaining == 2
+
+    @pytest.mark.asyncio
+    async def test_keys_are_limited_separately(self, limiter_factory, clock):
+        limiter = limiter_factory(clock)
+        assert (await limiter.acquire("key-1", rate=1, burst=1)).allowed
+        assert not (await limiter.acquire("key-1", rate=1, burst=1)).allowed
+        assert (await limiter.acquire("key-2", rate=1, burst=1)).allowed
+
+    @pytest.mark.asyncio
+    async def test_rejected_requests_do_not_count(self, limiter_factory, clock):
+        limiter = limiter_factory(clock)
+        await limiter.acquire("key-1", rate=1, burst=1)
+        for _ in range(10):
+            await limiter.acquire("key-1", rate=1, burst=1)
+        clock.now += 1.0
+        assert (await limiter.acquire("key-1", rate=1, burst=1)).allowed
+
+
+class TestMemoryRateLimiter:
+    @pytest.mark.asyncio
+    async def test_idle_keys_are_swept(self, clock):
+        limiter = MemoryRateLimiter(sweep_interval=10.0, clock=clock)
+        await limiter.acquire("idle", rate=1, burst=5)
+        clock.now += 9.0
+        await limiter.acquire("busy", rate=1, burst=5)
+        await limiter.acquire("busy", rate=1, burst=5)
+        assert len(limiter) == 2
+
+        clock.now += 1.0
+        await limiter.acquire("busy", rate=1, burst=5)
+        assert len(limiter) == 1
+
+
+class TestSqliteRateLimiter:
+    @pytest.mark.asyncio
+    async def test_limit_is_shared_by_the_workers(self, tmp_path, clock):
+        path = str(tmp_path / "ratelimits.db")
+        workers = [SqliteRateLimiter(path, 60.0, clock) for _ in range(2)]
+        results = [await workers[i % 2].acquire("key-1", rate=1, burst=4) for i in range(6)]
+        for worker in workers:
+            await worker.close()
+        assert [result.allowed for result in results] == [True] * 4 + [False] * 2
+
+    @pytest.mark.asyncio
+    async def test_idle_keys_are_swept(self, tmp_path, clock):
+        path = str(tmp_path / "ratelimits.db")
+        limiter = SqliteRateLimiter(path, 10.0, clock)
+        await limiter.acquire("idle", rate=1, burst=5)
+        clock.now += 10.0
+        await limiter.acquire("busy", rate=1, burst=5)
+        await limiter.close()
+        with sqlite3.connect(path) as connection:
+            assert connection.execute("SELECT key FROM rate_limits").fetchall() == [("busy",)]
+
+    @pytest.mark.asyncio
+    async def test_failed_commit_is_rolled_back(self, tmp_path, clock, failing_commit):
+        limiter = SqliteRateLimiter(str(tmp_path / "ratelimits.db"), 60.0, clock)
+        limiter._connection = failing_commit(limiter._connect())
+        # fails open
+        assert (await limiter.acquire("key-1", rate=1, burst=1)).allowed
+        # the connection is usable again, and the failed request was not counted
+        assert (await limiter.acquire("key-1", rate=1, burst=1)).allowed
+        assert not (await limiter.acquire("key-1", rate=1, burst=1)).allowed
+        await limiter.close()
+
+
+class TestApiKeys:
+    def test_missing_rate_and_burst_default(self):
+        api_keys = [ApiKeySettings(key="key-1", merchant_id="merchant-1"),
+                    ApiKeySettings(key="key-2", merchant_id="merchant-2", rate=0.5, burst=1)]
+        with patch('payment_gateway_api.settings.payment_settings.api_keys', api_keys), \
+                patch('payment_gateway_api.settings.payment_settings.rate_limit_rate', 10.0), \
+                patch('payment_gateway_api.settings.payment_settings.rate_limit_burst', 20):
+            keys = create_api_keys()
+        assert (keys["key-1"].rate, keys["key-1"].burst) == (10.0, 20)
+        assert (keys["key-2"].rate, keys["key-2"].burst) == (0.5, 1)
+
+    @pytest.mark.parametrize("limits", [{"rate": 0}, {"rate": -1.0}, {"burst": 0}, {"burst": -5}])
+    def test_rate_and_burst_must_be_positive(self, limits):
+        with pytest.raises(ValidationError, match="greater than 0"):
+            ApiKeySettings(key="key-1", merchant_id="merchant-1", **limits)
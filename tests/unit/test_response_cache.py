@@ -0,0 +1,127 @@
+import asyncio
+import math
+import time
+import uuid
+from unittest.mock import AsyncMock
+
+import pytest
+
+from payment_gateway_api.caches import ResponseCache, encode_payment
+from payment_gateway_api.models import PaymentStatus
+from payment_gateway_api.repositories import PaymentRepository
+from payment_gateway_api.responses import etag_matches, encoded_payment_response
+from payment_gateway_api.stores import MemoryPaymentStore, PaymentStore
+
+
+class TestResponseCache:
+    def test_lru_eviction(self, new_payment):
+        cache = ResponseCache(max_entries=2)
+        first, second, third = new_payment(), new_payment(), new_payment()
+        cache.put(first.id, encode_payment(first))
+        cache.put(second.id, encode_payment(second))
+        cache.get(first.id)
+        cache.put(third.id, encode_payment(third))
+        assert len(cache) == 2
+        assert cache.get(first.id) == encode_payment(first)
+        assert cache.get(second.id) is None
+
+    def test_other_merchant_misses(self, new_payment):
+        cache = ResponseCache(max_entries=2)
+        payment = new_payment()
+        cache.put(payment.id, encode_payment(payment), "merchant-1")
+        assert cache.get(payment.id, "merchant-1") == encode_payment(payment)
+        assert cache.get(payment.id, "merchant-2") is None
+
+    def test_expired_entry_misses(self, new_payment):
+        cache = ResponseCache(max_entries=2)
+        payment = new_payment()
+        cache.put(payment.id, encode_payment(payment), expires_at=time.time() - 1)
+        assert cache.get(payment.id) is None
+        assert len(cache) == 0
+
+    def test_etag_depends_on_the_body(self, new_payment):
+        payment = new_payment()
+        assert encode_payment(payment).etag == encode_payment(payment).etag
+        assert encode_payment(payment).etag != encode_payment(payment.model_copy(update={"amount": 101})).etag
+
+    @pytest.mark.parametrize("if_none_match, matches", [
+        (None, False),
+        ("", False),
+        ("*", True),
+        ('"abc"', True),
+        ('W/"abc"', True),
+        ('"xyz", "abc"', True),
+        ('"xyz"', False),
+    ])
+    def test_etag_matches(self, if_none_match, matches):
+        assert etag_matches(if_none_match, '"abc"') is matches
+
+    def test_not_modified_has_no_body(self, new_payment):
+        encoded = encode_payment(new_payment())
+        response = encoded_payment_response(encoded, encoded.etag)
+        assert response.status_code == 304
+        assert response.body == b""
+        assert response.headers["ETag"] == encoded.etag
+
+
+class TestPaymentRepository:
+    @pytest.mark.asyncio
+    async def test_get_encoded_reads_through(self, new_payment):
+        payment = new_payment()
+        store = AsyncMock(spec=PaymentStore)
+        store.get.return_value = payment
+        store.expires_at.return_value = math.inf
+        repository = PaymentRepository(store, ResponseCache(max_entries=10))
+
+        assert await repository.get_encoded(payment.id) == encode_payment(payment)
+        assert await repository.get_encoded(payment.id) == encode_payment(payment)
+        store.get.assert_awaited_once_with(payment.id, None)
+
+    @pytest.mark.asyncio
+    async def test_add_caches_the_encoded_payment(self, new_payment):
+        cache = ResponseCache(max_entries=10)
+        repository = PaymentRepository(MemoryPaymentStore(max_entries=10, ttl=60), cache)
+        payment = new_payment()
+        await repository.add(payment)
+        assert cache.get(payment.id) == encode_payment(payment)
+
+    @pytest.mark.asyncio
+    async def test_pending_payment_is_not_cached(self, new_payment):
+        cache = ResponseCache(max_entries=10)
+        store = MemoryPaymentStore(max_entries=10, ttl=60)
+        repository = PaymentRepository(store, cache)
+        pending = new_payment(status=PaymentStatus.PENDING)
+        await repository.add(pending)
+        assert await repository.get_encoded(pending.id) == encode_payment(pending)
+        assert cache.get(pending.id) is None
+
+        # completed by another worker sharing the store, the next read sees it
+        completed = pending.model_copy(update={"status": PaymentStatus.AUTHORIZED})
+        await store.update(completed)
+        assert await repository.get_encoded(pending.id) == encode_payment(completed)
+        assert cache.get(pending.id) == encode_payment(completed)
+
+    @pytest.mark.asyncio
+    async def test_payment_expired_by_the_store_is_not_served(self, new_payment):
+        repository = PaymentRepository(MemoryPaymentStore(max_entries=10, ttl=0.05), ResponseCache(max_entries=10))
+        payment = new_payment()
+        await repository.add(payment)
+        assert await repository.get_encoded(payment.id) == encode_payment(payment)
+        await asyncio.sleep(0.06)
+        assert await repository.get_encoded(payment.id) is None
+
+    @pytest.mark.asyncio
+    async def test_payment_evicted_by_the_store_is_not_served(self, new_payment):
+        cache = ResponseCache(max_entries=10)
+        repository = PaymentRepository(MemoryPaymentStore(max_entries=1, ttl=60), cache)
+        first, second = new_payment(), new_payment()
+        await repository.add(first)
+        await repository.add(second)
+        assert cache.get(first.id) is None
+        assert await repository.get_encoded(first.id) is None
+        assert await repository.get_encoded(second.id) == encode_payment(second)
+
+    @pytest.mark.asyncio
+    async def test_get_encoded_not_found(self):
+        repository = PaymentRepository(MemoryPaymentStore(max_entries=10, ttl=60), None)
+        assert await repository.get_encoded(uuid.uuid4()) is None
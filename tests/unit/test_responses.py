@@ -0,0 +1,34 @@
+import uuid
+
+import pytest
+from fastapi.responses import JSONResponse
+
+from payment_gateway_api.models import PaymentResponse, PaymentStatus, ErrorResponse
+from payment_gateway_api.responses import ModelResponse, error_response
+
+
+class TestResponses:
+    @pytest.mark.parametrize("status", [PaymentStatus.AUTHORIZED, PaymentStatus.DECLINED])
+    def test_model_response_matches_json_response(self, status):
+        payment = PaymentResponse(id=uuid.uuid4(), status=status, card_last4="8877", expiry_month="4",
+                                  expiry_year="2030", currency="GBP", amount=100)
+
+        response = ModelResponse(payment, status_code=201)
+
+        assert response.body == JSONResponse(payment.model_dump(mode="json")).body
+        assert response.status_code == 201
+        assert response.headers["content-type"] == "application/json"
+        assert response.headers["content-length"] == str(len(response.body))
+
+    @pytest.mark.parametrize("message", [
+        "Internal server error",
+        "Downstream bank server is unavailable, please retry later.",
+        "currency £$€ is not supported.",
+        'card_number: "quoted"\nline',
+    ])
+    def test_error_response_matches_json_response(self, message):
+        response = error_response(503, message, {"Retry-After": "1"})
+
+        assert response.body == JSONResponse(ErrorResponse(message=message).model_dump()).body
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "1"
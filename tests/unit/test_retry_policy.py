@@ -0,0 +1,90 @@
+import asyncio
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+from payment_gateway_api.exceptions import BankServerError, BankConnectionError, PaymentServerError
+from payment_gateway_api.models import BankPaymentResponse
+from payment_gateway_api.retries import RetryPolicy, RetryBudget, retries_total
+
+
+def new_policy(max_retries=3, deadline=5.0, budget=None):
+    return RetryPolicy(max_retries=max_retries, base_delay=0.001, max_delay=0.01, deadline=deadline,
+                       budget=budget or RetryBudget(ratio=0.2, capacity=10))
+
+
+class TestRetryBudget:
+    def test_withdraw_until_empty(self):
+        budget = RetryBudget(ratio=0.5, capacity=2)
+        assert budget.try_withdraw()
+        assert budget.try_withdraw()
+        assert not budget.try_withdraw()
+
+    def test_deposit_is_capped(self):
+        budget = RetryBudget(ratio=0.5, capacity=2)
+        budget.try_withdraw()
+        for _ in range(10):
+            budget.deposit()
+        assert budget.tokens == 2
+
+
+class TestRetryPolicy:
+    @pytest.mark.asyncio
+    async def test_success_no_retry(self):
+        attempt = AsyncMock(return_value=BankPaymentResponse(authorized=True, authorization_code=None))
+        result = await new_policy().call(attempt)
+        assert result.authorized
+        assert attempt.call_count == 1
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("error", [
+        BankServerError("Downstream error"),
+        BankConnectionError("Network error"),
+    ])
+    async def test_retry_then_success(self, error):
+        attempt = AsyncMock(side_effect=[error, error, BankPaymentResponse(authorized=True, authorization_code=None)])
+        before = retries_total.value
+        result = await new_policy().call(attempt)
+        assert result.authorized
+        assert attempt.call_count == 3
+        assert retries_total.value - before == 2
+
+    @pytest.mark.asyncio
+    async def test_retry_exhausted(self):
+        attempt = AsyncMock(side_effect=BankServerError("Downstream error"))
+        with pytest.raises(BankServerError):
+            await new_policy(max_retries=2).call(attempt)
+        assert attempt.call_count == 3
+
+    @pytest.mark.asyncio
+    async def test_no_retry_on_client_error(self):
+        attempt = AsyncMock(side_effect=PaymentServerError("Internal server error"))
+        with pytest.raises(PaymentServerError):
+            await new_policy().call(attempt)
+        assert attempt.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_budget_exhausted(self):
+        attempt = AsyncMock(side_effect=BankServerError("Downstream error"))
+        with pytest.raises(BankServerError):
+            await new_policy(budget=RetryBudget(ratio=0, capacity=1)).call(attempt)
+        assert attempt.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_deadline_exceeded(self):
+        async def slow(deadline):
+            async with asyncio.timeout_at(deadline):
+                await asyncio.sleep(1)
+
+        with pytest.raises(BankServerError) as ex_info:
+            await new_policy(deadline=0.05).call(slow)
+        assert str(ex_info.value) == "Downstream bank server is unavailable, please retry later."
+
+    def test_backoff_full_jitter(self):
+        policy = RetryPolicy(max_retries=3, base_delay=0.1, max_delay=0.3, deadline=5,
+                             budget=RetryBudget(ratio=0.2, capacity=10))
+        with patch('random.uniform', side_effect=lambda low, high: high) as mock_uniform:
+            assert policy.backoff(0) == 0.1
+            assert policy.backoff(1) == 0.2
+            assert policy.backoff(5) == 0.3
+            assert mock_uniform.call_args.args[0] == 0
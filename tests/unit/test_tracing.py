@@ -0,0 +1,95 @@
+import json
+import uuid
+from unittest.mock import Mock, AsyncMock
+
+import httpx
+import pytest
+
+from payment_gateway_api.clients import BankClient
+from payment_gateway_api.models import BankPaymentRequest
+from payment_gateway_api.tracing import Tracer, MemorySpanExporter, FileSpanExporter, parse_traceparent, tracer
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+class TestTracer:
+    @pytest.mark.parametrize("header, parsed", [
+        (f"00-{TRACE_ID}-{PARENT_ID}-01", (TRACE_ID, PARENT_ID, True)),
+        (f"00-{TRACE_ID.upper()}-{PARENT_ID}-00", (TRACE_ID, PARENT_ID, False)),
+        (None, None),
+        ("garbage", None),
+        (f"00-{'0' * 32}-{PARENT_ID}-01", None),
+        (f"00-{TRACE_ID}-{'0' * 16}-01", None),
+    ])
+    def test_parse_traceparent(self, header, parsed):
+        assert parse_traceparent(header) == parsed
+
+    def test_spans_of_a_sampled_trace(self):
+        exporter = MemorySpanExporter(100)
+        test_tracer = Tracer(0.0, exporter)
+        with test_tracer.start_trace("POST", f"00-{TRACE_ID}-{PARENT_ID}-01") as root:
+            with test_tracer.span("bank") as bank:
+                bank.set_attribute("payment.currency", "GBP")
+                assert test_tracer.traceparent() == f"00-{TRACE_ID}-{bank.span_id}-01"
+            with pytest.raises(ValueError), test_tracer.span("store"):
+                raise ValueError("failed")
+
+        assert [span.name for span in exporter.spans] == ["bank", "store", "POST"]
+        assert all(span.trace_id == TRACE_ID for span in exporter.spans)
+        assert root.parent_id == PARENT_ID
+        assert exporter.spans[0].parent_id == root.span_id
+        assert exporter.spans[0].attributes == {"payment.currency": "GBP"}
+        assert exporter.spans[1].error == "ValueError"
+        assert test_tracer.current_span is None
+
+    def test_unsampled_trace_is_not_recorded(self):
+        exporter = MemorySpanExporter(100)
+        test_tracer = Tracer(0.0, exporter)
+        with test_tracer.start_trace("POST") as root:
+            with test_tracer.span("bank") as bank:
+                bank.set_attribute("payment.currency", "GBP")
+                # the ids are still propagated, flagged as not sampled
+                assert test_tracer.traceparent() == f"00-{root.trace_id}-{root.span_id}-00"
+        assert len(exporter.spans) == 0
+
+    def test_span_outside_a_trace(self):
+        test_tracer = Tracer(1.0, MemorySpanExporter(100))
+        with test_tracer.span("bank") as span:
+            span.set_attribute("ignored", True)
+        assert len(test_tracer.exporter.spans) == 0
+
+    def test_file_exporter(self, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        exporter = FileSpanExporter(str(path))
+        test_tracer = Tracer(1.0, exporter)
+        with test_tracer.start_trace("GET"):
+            with test_tracer.span("store"):
+                pass
+        exporter.close()
+        lines = [json.loads(line) for line in path.read_text().splitlines()]
+        assert [line["name"] for line in lines] == ["store", "GET"]
+        assert lines[0]["parent_id"] == lines[1]["span_id"]
+
+
+class TestBankClientTracing:
+    @pytest.mark.asyncio
+    async def test_traceparent_is_sent_to_the_bank(self, monkeypatch):
+        exporter = MemorySpanExporter(100)
+        monkeypatch.setattr(tracer, "exporter", exporter)
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {"authorized": True, "authorization_code": uuid.uuid4()}
+        mock_client = AsyncMock(spec=httpx.AsyncClient)
+        mock_client.post.return_value = mock_response
+        payment = BankPaymentRequest(card_number="00001234", expiry_date="12/2036", currency="GBP", amount=100,
+                                     cvv="345")
+
+        with tracer.start_trace("POST", f"00-{TRACE_ID}-{PARENT_ID}-01"):
+            await BankClient(mock_client, bank_url="http://bank").process_payment(payment)
+
+        attempt = exporter.spans[0]
+        assert attempt.name == "bank.http"
+        assert attempt.attributes["http.status_code"] == 200
+        headers = mock_client.post.call_args.kwargs["headers"]
+        assert headers["traceparent"] == f"00-{TRACE_ID}-{attempt.span_id}-01"
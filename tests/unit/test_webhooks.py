@@ -0,0 +1,226 @@
+import asyncio
+import json
+import time
+
+import sqlite3
+
+import httpx
+import pytest
+
+from payment_gateway_api.webhooks import WebhookDispatcher, WebhookStore, PublicAddressTransport, SIGNATURE_HEADER, \
+    sign, verify
+
+SECRET = "0123456789abcdef0123"
+
+
+class Receiver:
+    # answers the webhook POSTs with the next of statuses, the last one repeats
+    def __init__(self, *statuses: int, latency: float = 0.0):
+        self.statuses = list(statuses) or [200]
+        self.latency = latency
+        self.requests = list[httpx.Request]()
+        self.in_flight = self.max_in_flight = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            self.requests.append(request)
+            status = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+            return httpx.Response(status)
+        finally:
+            self.in_flight -= 1
+
+    def delivered(self) -> list[str]:
+        return [payment["id"] for request in self.requests for payment in json.loads(request.content)]
+
+
+def create_dispatcher(path, receiver, batch_max_size=100, destination_concurrency=4, max_attempts=3, retry_delay=0.01,
+                      timeout=5.0):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(receiver))
+    return WebhookDispatcher(WebhookStore(str(path / "webhooks.db")), client, batch_max_size=batch_max_size,
+                             destination_concurrency=destination_concurrency, max_attempts=max_attempts,
+                             retry_delay=retry_delay, retry_max_delay=retry_delay, poll_interval=0.02, timeout=timeout,
+                             lease=5.0)
+
+
+async def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+class TestSignature:
+    def test_sign_and_verify(self):
+        body = b'[{"id": 1}]'
+        signature = sign(SECRET, int(time.time()), body)
+        assert verify(SECRET, signature, body, tolerance=300)
+        assert not verify(SECRET, signature, body + b" ", tolerance=300)
+        assert not verify("another-secret-value", signature, body, tolerance=300)
+        assert not verify(SECRET, "not-a-signature", body, tolerance=300)
+
+    def test_old_signature_is_refused(self):
+        body = b"[]"
+        assert not verify(SECRET, sign(SECRET, int(time.time()) - 600, body), body, tolerance=300)
+
+
+class TestWebhookDispatcher:
+    @pytest.mark.asyncio
+    async def test_results_are_batched_and_signed(self, tmp_path, new_payment):
+        receiver = Receiver()
+        dispatcher = create_dispatcher(tmp_path, receiver, batch_max_size=2)
+        await dispatcher.start()
+        await dispatcher.register("merchant-1", "http://merchant-1.test/hook", SECRET)
+        payments = [new_payment() for _ in range(5)]
+        for payment in payments:
+            dispatcher.notify("merchant-1", payment)
+        await wait_for(lambda: len(receiver.delivered()) == 5)
+        await dispatcher.close()
+
+        assert sorted(receiver.delivered()) == sorted(str(payment.id) for payment in payments)
+        assert all(len(json.loads(request.content)) <= 2 for request in receiver.requests)
+        for request in receiver.requests:
+            assert str(request.url) == "http://merchant-1.test/hook"
+            assert verify(SECRET, request.headers[SIGNATURE_HEADER], request.content, tolerance=300)
+
+    @pytest.mark.asyncio
+    async def test_merchant_without_webhook_is_not_notified(self, tmp_path, new_payment):
+        receiver = Receiver()
+        dispatcher = create_dispatcher(tmp_path, receiver)
+        await dispatcher.start()
+        dispatcher.notify("merchant-1", new_payment())
+        dispatcher.notify(None, new_payment())
+        await asyncio.sleep(0.1)
+        await dispatcher.close()
+        assert receiver.requests == []
+
+    @pytest.mark.asyncio
+    async def test_nothing_is_leased_without_webhooks(self, tmp_path, new_payment):
+        receiver = Receiver()
+        dispatcher = create_dispatcher(tmp_path, receiver)
+        leases = 0
+        lease = dispatcher._store.lease
+
+        def counted_lease(*args):
+            nonlocal leases
+            leases += 1
+            return lease(*args)
+
+        dispatcher._store.lease = counted_lease
+        await dispatcher.start()
+        await asyncio.sleep(0.1)
+        assert leases == 0
+        await dispatcher.register("merchant-1", "http://merchant-1.test/hook", SECRET)
+        dispatcher.notify("merchant-1", new_payment())
+        await wait_for(lambda: len(receiver.requests) == 1)
+        await dispatcher.close()
+        assert leases > 0
+
+    @pytest.mark.asyncio
+    async def test_slow_receiver_is_cut_off(self, tmp_path, new_payment):
+        calls = 0
+
+        async def receiver(request: httpx.Request) -> httpx.Response:
+            # the first POST hangs, as a receiver trickling bytes within the client's timeouts would
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                await asyncio.sleep(10)
+            return httpx.Response(200)
+
+        dispatcher = create_dispatcher(tmp_path, receiver, timeout=0.05)
+        await dispatcher.start()
+        await dispatcher.register("merchant-1", "http://merchant-1.test/hook", SECRET)
+        dispatcher.notify("merchant-1", new_payment())
+        # cut off and retried well before the lease ends
+        await wait_for(lambda: calls == 2 and dispatcher.in_flight == 0, timeout=2.0)
+        await dispatcher.close()
+
+    @pytest.mark.asyncio
+    async def test_failed_delivery_is_retried(self, tmp_path, new_payment):
+        receiver = Receiver(500, 503, 200)
+        dispatcher = create_dispatcher(tmp_path, receiver)
+        await dispatcher.start()
+        await dispatcher.register("merchant-1", "http://merchant-1.test/hook", SECRET)
+        payment = new_payment()
+        dispatcher.notify("merchant-1", payment)
+        await wait_for(lambda: len(receiver.requests) == 3)
+        await dispatcher.close()
+        assert receiver.delivered() == [str(payment.id)] * 3
+
+    @pytest.mark.asyncio
+    async def test_dropped_after_max_attempts(self, tmp_path, new_payment):
+        receiver = Receiver(500)
+        dispatcher = create_dispatcher(tmp_path, receiver, max_attempts=2)
+        await dispatcher.start()
+        await dispatcher.register("merchant-1", "http://merchant-1.test/hook", SECRET)
+        dispatcher.notify("merchant-1", new_payment())
+        await wait_for(lambda: len(receiver.requests) == 2)
+        await asyncio.sleep(0.1)
+        await dispatcher.close()
+        assert len(receiver.requests) == 2
+
+    @pytest.mark.asyncio
+    async def test_destination_concurrency(self, tmp_path, new_payment):
+        slow = Receiver(latency=0.05)
+        fast = Receiver()
+        transports = {"slow.test": slow, "fast.test": fast}
+
+        async def route(request):
+            return await transports[request.url.host](request)
+
+        dispatcher = create_dispatcher(tmp_path, route, batch_max_size=1, destination_concurrency=2)
+        await dispatcher.start()
+        await dispatcher.register("slow", "http://slow.test/hook", SECRET)
+        await dispatcher.register("fast", "http://fast.test/hook", SECRET)
+        for _ in range(10):
+            dispatcher.notify("slow", new_payment())
+        dispatcher.notify("fast", new_payment())
+        # the slow merchant's backlog does not hold up the others
+        await wait_for(lambda: len(fast.requests) == 1, timeout=0.2)
+        await wait_for(lambda: len(slow.requests) == 10)
+        await dispatcher.close()
+        assert slow.max_in_flight == 2
+
+    @pytest.mark.asyncio
+    async def test_queued_results_survive_a_restart(self, tmp_path, new_payment):
+        down = Receiver(503)
+        # not retried before it stops
+        dispatcher = create_dispatcher(tmp_path, down, retry_delay=60.0)
+        await dispatcher.start()
+        await dispatcher.register("merchant-1", "http://merchant-1.test/hook", SECRET)
+        payment = new_payment()
+        dispatcher.notify("merchant-1", payment)
+        await wait_for(lambda: len(down.requests) == 1)
+        await dispatcher.close()
+
+        up = Receiver()
+        restarted = create_dispatcher(tmp_path, up)
+        await restarted.start()
+        # due again at once
+        await restarted._call(restarted._store.reschedule, [(0.0, 1)], [])
+        await wait_for(lambda: len(up.requests) == 1)
+        await restarted.close()
+        assert up.delivered() == [str(payment.id)]
+
+
+class TestPublicAddressTransport:
+    @pytest.mark.asyncio
+    async def test_name_of_an_internal_address_is_refused(self):
+        async with httpx.AsyncClient(transport=PublicAddressTransport()) as client:
+            with pytest.raises(httpx.ConnectError, match="non public address"):
+                await client.post("http://localhost:9/hook", content=b"[]")
+
+
+class TestWebhookStore:
+    def test_failed_commit_is_rolled_back(self, tmp_path, failing_commit):
+        store = WebhookStore(str(tmp_path / "webhooks.db"))
+        store._connection = failing_commit(store._connect())
+        with pytest.raises(sqlite3.OperationalError):
+            store.push([("merchant-1", b"lost")], due_at=0.0)
+        # the connection is usable again
+        store.push([("merchant-1", b"kept")], due_at=0.0)
+        assert store._connect().execute("SELECT event FROM webhook_events").fetchall() == [(b"kept",)]
+        store.close()
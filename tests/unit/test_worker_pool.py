@@ -0,0 +1,78 @@
+import asyncio
+import contextvars
+
+import pytest
+
+from payment_gateway_api.exceptions import OverloadedError
+from payment_gateway_api.workers import WorkerPool
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+
+class TestWorkerPool:
+    @pytest.mark.asyncio
+    async def test_jobs_run_in_the_submitter_context(self):
+        pool = WorkerPool("test", workers=2, queue_size=10, drain_timeout=1.0)
+        pool.start()
+        seen = []
+
+        async def job():
+            seen.append(request_id.get())
+
+        for i in range(3):
+            request_id.set(f"request-{i}")
+            pool.reserve()
+            pool.submit(job)
+        await pool.close()
+        assert sorted(seen) == ["request-0", "request-1", "request-2"]
+        assert pool.depth == 0
+
+    @pytest.mark.asyncio
+    async def test_full_queue_is_rejected(self):
+        pool = WorkerPool("test", workers=1, queue_size=2, drain_timeout=1.0)
+        pool.reserve()
+        pool.reserve()
+        with pytest.raises(OverloadedError):
+            pool.reserve()
+        pool.release()
+        pool.reserve()
+        assert pool.depth == 2
+
+    @pytest.mark.asyncio
+    async def test_failed_job_does_not_stop_the_worker(self):
+        pool = WorkerPool("test", workers=1, queue_size=10, drain_timeout=1.0)
+        pool.start()
+        done = asyncio.Event()
+
+        async def failing():
+            raise ValueError("failed")
+
+        async def succeeding():
+            done.set()
+
+        for job in (failing, succeeding):
+            pool.reserve()
+            pool.submit(job)
+        await asyncio.wait_for(done.wait(), 1.0)
+        await pool.close()
+
+    @pytest.mark.asyncio
+    async def test_close_abandons_jobs_after_the_drain_timeout(self):
+        pool = WorkerPool("test", workers=1, queue_size=10, drain_timeout=0.01)
+        pool.start()
+        cancelled = asyncio.Event()
+
+        async def stuck():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        pool.reserve()
+        pool.submit(stuck)
+        await asyncio.sleep(0)
+        await pool.close()
+        assert cancelled.is_set()
+        with pytest.raises(OverloadedError):
+            pool.reserve()